@@ -5,7 +5,9 @@ from dotenv import load_dotenv
 # app.py is in backend/, so .env is in ../.env
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env'))
 
-from flask import Flask, jsonify, request, send_file
+import json
+import concurrent.futures
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 
@@ -14,7 +16,9 @@ import file_processor # Added
 import metadata_manager # Added
 from werkzeug.utils import secure_filename # Added
 import background
+import ingest
 import supabase_client as supabase
+from json_grammar import JSONConstraint
 
 app = Flask(__name__)
 CORS(app)
@@ -69,7 +73,7 @@ def route_request(feature, payload):
                      return {"error": f"Invalid provider {provider}"}, 400
 
                 from ml_utils import rag_pipeline
-                return rag_pipeline.run_chat_rag(message, bucket_name, provider, payload.get('provider_options', {}))
+                return rag_pipeline.run_chat_rag(message, bucket_name, provider, payload.get('provider_options', {}), user_id=payload.get('userId'))
 
             # [STRICT] Chat + AI Only -> AI Pipeline ONLY
             else:
@@ -112,9 +116,36 @@ def route_request(feature, payload):
         traceback.print_exc()
         return {"error": str(e)}, 500
 
+def stream_chat(payload):
+    """Chat as Server-Sent Events: the same Mode-Source contract as route_request('chat'),
+    yielding pipeline events ({"type": "token" | "done" | "error", ...}) as they happen."""
+    provider = payload.get('provider', 'local')
+    message = payload.get('message')
+    options = payload.get('provider_options', {})
+    try:
+        # [STRICT] Chat + Use Notes -> RAG Pipeline ONLY
+        if payload.get('useNotes', False):
+            if provider not in ['local', 'gemini', 'openai']:
+                yield {"type": "error", "error": f"Invalid provider {provider}"}
+                return
+            from ml_utils import rag_pipeline
+            yield from rag_pipeline.stream_chat_rag(message, payload.get('bucketName'), provider, options, user_id=payload.get('userId'))
+        # [STRICT] Chat + AI Only -> AI Pipeline ONLY
+        else:
+            from ml_utils import ai_pipeline
+            yield from ai_pipeline.stream_chat_ai(message, provider, options)
+    except Exception as e:
+        print(f"Stream Router Error: {e}")
+        yield {"type": "error", "error": str(e)}
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     data = request.json
+    # {"stream": true} (or Accept: text/event-stream) returns tokens as they are generated
+    if data.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+        events = (f"data: {json.dumps(event)}\n\n" for event in stream_chat(data))
+        return Response(stream_with_context(events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     response, status = route_request('chat', data)
     return jsonify(response), status
 
@@ -130,6 +161,8 @@ def add_note():
     title = data.get('title')
     content = data.get('content')
     bucket = data.get('bucket')
+    note_id = data.get('noteId')
+    user_id = data.get('userId')
     
     if not all([title, content, bucket]):
         return jsonify({"error": "Missing fields"}), 400
@@ -156,12 +189,34 @@ def add_note():
     from ml_utils import rag_system
     try:
         # We use 'original_filename' as a way to track source in RAG
-        count = rag_system.add_document(content, subject=bucket, original_filename=title)
+        count = rag_system.add_document(content, subject=bucket, original_filename=title, doc_id=note_id, user_id=user_id)
         return jsonify({"message": "Note saved and indexed successfully", "chunks": count}), 200
     except Exception as e:
         print(f"Indexing failed: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/notes/<note_id>', methods=['DELETE'])
+def delete_note(note_id):
+    user_id = request.args.get('userId')
+
+    # 1. Drop the note's vectors so RAG stops serving its chunks
+    from ml_utils import rag_system
+    try:
+        removed = rag_system.delete_document(note_id, user_id=user_id)
+    except Exception as e:
+        print(f"[DeleteNote] Index removal failed: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    # 2. Delete the row (the frontend may already have done this with the user's session)
+    db_deleted = True
+    try:
+        supabase.delete_note(note_id)
+    except Exception as e:
+        print(f"[DeleteNote] Supabase delete failed: {e}")
+        db_deleted = False
+
+    return jsonify({"message": "Note removed from index", "chunks_removed": removed, "db_deleted": db_deleted}), 200
+
 @app.route('/api/files', methods=['GET'])
 def list_files():
     bucket_name = request.args.get('bucket')
@@ -203,6 +258,19 @@ def list_files():
         print(f"Error listing files from Supabase: {e}")
         return jsonify({"error": str(e)}), 500
 
+# /api/summarize output; the local model is held to it token by token.
+# Lengths keep the whole object inside the 800-token budget.
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "key_themes": {"type": "array", "items": {"type": "string", "maxLength": 60}, "minItems": 1, "maxItems": 5},
+        "detailed_summary": {"type": "string", "maxLength": 1500},
+        "ai_insight": {"type": "string", "maxLength": 300},
+    },
+}
+# The prompt starts the assistant's reply with this
+SUMMARY_PREFIX = '{\n  "key_themes": [\n'
+
 @app.route('/api/summarize', methods=['POST'])
 def summarize_text():
     data = request.json
@@ -296,16 +364,17 @@ def summarize_text():
             f"CONTENT:\n{text[:12000]}\n"
             "</s>\n"
             "<|assistant|>\n"
-            "{\n"
-            '  "key_themes": [\n'
+            + SUMMARY_PREFIX
         )
         
         print(f"[Summarizer] Sending JSON prompt to LLM...")
-        raw_response = llm.generate(prompt, max_tokens=800)
+        from response_cache import cached_generate
+        raw_response = cached_generate(llm, prompt, 800, 'summary', keep=lambda r: '"detailed_summary"' in r,
+                                       constraint=JSONConstraint(SUMMARY_SCHEMA, prefix=SUMMARY_PREFIX))
         
         # 3. Parse JSON Response
         # Prepend the forced start
-        full_json_str = '{\n  "key_themes": [\n' + raw_response.strip()
+        full_json_str = SUMMARY_PREFIX + raw_response.strip()
         
         # Cleanup: Remove any markdown fences if the model ignored instructions
         if "```json" in full_json_str:
@@ -385,10 +454,11 @@ def ask_notes():
     subject = data.get('subject', 'All Notes')
     provider = data.get('provider', 'local')
     provider_opts = data.get('provider_options', {}) or {}
+    user_id = data.get('userId')
     from ml_utils import rag_system
     from llm_providers import get_provider
     llm = get_provider(provider, **provider_opts)
-    answer, sources = rag_system.query(question, subject_filter=subject, llm_module=llm)
+    answer, sources = rag_system.query(question, subject_filter=subject, llm_module=llm, user_id=user_id)
     
     return jsonify({
         "answer": answer,
@@ -402,9 +472,11 @@ def get_evidence():
     question = data.get('question', '')
     subject = data.get('subject', None)
     top_k = int(data.get('top_k', 5))
+    user_id = data.get('userId')
 
+    # Retrieval only: no LLM call, so this returns in milliseconds
     from ml_utils import rag_system
-    candidates = rag_system.retrieve(question, subject_filter=subject, top_k=top_k)
+    candidates = rag_system.retrieve(question, subject_filter=subject, top_k=top_k, user_id=user_id)
 
     # Return candidates with offsets and short excerpt
     out = []
@@ -421,6 +493,27 @@ def get_evidence():
     return jsonify({'evidence': out})
 
 
+@app.route('/api/rag/index-stats', methods=['GET'])
+def rag_index_stats():
+    # ?benchmark=1 adds a recall@k vs latency sweep per shard (can take a few seconds)
+    user_id = request.args.get('userId')
+    benchmark = request.args.get('benchmark') in ('1', 'true')
+    try:
+        from ml_utils import rag_system
+        return jsonify(rag_system.index_report(user_id=user_id, benchmark=benchmark))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/llm/stats', methods=['GET'])
+def llm_stats():
+    # Local LLM scheduler: queue depth, batch size, preemptions, wait per feature; reply cache hits
+    from llm_providers import local_llm
+    from response_cache import get_response_cache
+    cache = get_response_cache()
+    return jsonify({"scheduler": local_llm.stats(), "response_cache": cache.stats() if cache else None})
+
+
 @app.route('/api/tasks', methods=['GET'])
 def list_background_tasks():
     try:
@@ -447,6 +540,8 @@ def upload_file():
     
     file = request.files['file']
     bucket_name = request.form.get('bucketName', 'Uncategorized')
+    user_id = request.form.get('userId')
+    note_id = request.form.get('noteId')  # the Supabase note row, so DELETE /api/notes/<id> finds these chunks
     
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
@@ -465,8 +560,21 @@ def upload_file():
             # 1. Save locally temporarily for processing
             file.save(temp_filepath)
             
-            # 2. Extract Text
-            text_content = file_processor.extract_text_from_file(temp_filepath)
+            # 2. Extract Text (ingest process pool; the pipeline deletes the temp file afterwards)
+            job = ingest.get_pipeline().submit_file(temp_filepath, bucket_name, file.filename, doc_id=note_id, user_id=user_id, cleanup=True)
+            try:
+                text_content = job.extracted.result(timeout=300)
+            except ValueError:
+                text_content = None
+            except concurrent.futures.TimeoutError:
+                # Still extracting; the pipeline indexes it (and deletes the temp file) when done
+                task_id = background.register_future(job.done)
+                print(f"Upload extraction timed out for {filename} (task {task_id})")
+                return jsonify({"error": "Text extraction timed out; the file will be indexed when it finishes",
+                                "indexing_task_id": task_id}), 504
+            except Exception as e:
+                print(f"Upload extraction failed for {filename}: {e}")
+                return jsonify({"error": f"Could not extract text from file: {e}"}), 500
             
             # 3. Upload to Supabase Storage - REMOVED (Frontend handles this)
             # We strictly use this endpoint for RAG Indexing now.
@@ -475,14 +583,10 @@ def upload_file():
             if not text_content:
                 return jsonify({"error": "Could not extract text from file"}), 400
 
-            # 4. Add to RAG System (Background)
-            from ml_utils import rag_system
-            task_id = background.submit_task(rag_system.add_document, text_content, bucket_name, file.filename)
+            # 4. Chunk, embed (batched with other uploads) and index in the background
+            task_id = background.register_future(job.done)
             print(f"Scheduled background indexing for {filename} (task {task_id})")
             
-            # 5. Cleanup Temp File
-            os.remove(temp_filepath)
-            
             return jsonify({
                 "message": "File uploaded and indexed successfully",
                 "filename": filename,
@@ -505,6 +609,7 @@ def reprocess_document():
     data = request.json
     file_path = data.get('filePath') # path in bucket
     note_id = data.get('noteId')
+    user_id = data.get('userId')
     
     if not file_path or not note_id:
         return jsonify({"error": "Missing filePath or noteId"}), 400
@@ -538,9 +643,16 @@ def reprocess_document():
         from supabase_client import update_note_content
         update_note_content(note_id, text_content)
         
-        # 4. Re-index in RAG
+        # 4. Re-index in RAG, in the note's own bucket (rehydration leaves file-backed notes alone)
         from ml_utils import rag_system
-        rag_system.add_document(text_content, subject='Reprocessed', original_filename=local_filename)
+        indexed = rag_system.indexed_document(note_id, user_id=user_id) or {}
+        bucket_name = indexed.get('bucket')
+        note = supabase.get_note_details(note_id)
+        if note and note.get('bucket_id'):
+            bucket_names = {b['id']: b['name'] for b in supabase.fetch_note_buckets()}
+            bucket_name = bucket_names.get(note['bucket_id'], bucket_name)
+        rag_system.add_document(text_content, subject=bucket_name or 'Uncategorized',
+                                original_filename=indexed.get('filename', local_filename), doc_id=note_id, user_id=user_id)
         
         # Cleanup
         if os.path.exists(local_path): os.remove(local_path)
@@ -636,33 +748,11 @@ if __name__ == '__main__':
             if not notes:
                 print("No notes found in Supabase DB.")
             else:
-                queued = 0
-                BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-                temp_rehydrate_dir = os.path.join(BASE_DIR, 'data', 'temp_rehydrate')
-                os.makedirs(temp_rehydrate_dir, exist_ok=True)
-                
-                for n in notes:
-                    note_id = n['id']
-                    title = n['title']
-                    bucket_id = n.get('bucket_id')
-                    resolved_bucket_name = bucket_id_to_name.get(bucket_id, "Uncategorized")
-                    
-                    # Content Source: prefer DB content if available (faster)
-                    content = n.get('content')
-                    
-                    # If content missing in DB, try storage (legacy) - but fetch_notes select includes content
-                    if not content:
-                         print(f"Skipping {title} (no content in DB)")
-                         continue
-                         
-                    print(f"DTO processing: {title} -> {resolved_bucket_name}")
-                    
-                    # Re-index
-                    # subject arg in add_document is the 'bucket' metadata used for filtering
-                    rag_system.add_document(content, subject=resolved_bucket_name, original_filename=title)
-                    queued += 1
+                # Notes the snapshot lacks (or holds an older version of) go through the ingest pipeline
+                jobs, unchanged, skipped = ingest.get_pipeline().rehydrate(notes, bucket_id_to_name)
+                queued = len(jobs)
                 
-                print(f"--- RAG Rehydration queued {queued} documents from Supabase. ---")
+                print(f"--- RAG Rehydration queued {queued} documents from Supabase ({unchanged} unchanged in snapshot, {skipped} skipped). ---")
 
         except Exception as e:
             print(f"Supabase List/Rehydrate failed: {e}")
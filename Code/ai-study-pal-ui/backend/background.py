@@ -26,6 +26,12 @@ def submit_task(fn, *args, **kwargs):
     _TASKS[task_id] = future
     return task_id
 
+def register_future(future: concurrent.futures.Future):
+    """Track work running elsewhere (e.g. the ingest pipeline) as a task. Returns a task_id."""
+    task_id = str(uuid.uuid4())
+    _TASKS[task_id] = future
+    return task_id
+
 def get_task_status(task_id: str):
     future = _TASKS.get(task_id)
     if not future:
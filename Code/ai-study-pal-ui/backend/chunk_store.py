@@ -0,0 +1,214 @@
+from typing import List, Dict, Any, Iterator, Tuple
+import os
+import re
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# Idle read connections kept per store; extra concurrent readers open one and close it after
+READ_POOL_SIZE = int(os.environ.get('CHUNK_READ_POOL_SIZE', '4'))
+
+# Fields with their own column (indexed where we filter on them); anything else goes in `extra`
+COLUMNS = ('doc_id', 'bucket', 'filename', 'text')
+
+# Keeps the full-text index in step with `chunks` (REPLACE fires the delete trigger via recursive_triggers)
+FTS_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN "
+    "INSERT INTO chunks_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN "
+    "INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS chunks_fts_update AFTER UPDATE OF text ON chunks BEGIN "
+    "INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO chunks_fts (rowid, text) VALUES (new.id, new.text); END",
+)
+
+
+class ChunkStore:
+    """Chunk metadata for one FaissStore, in SQLite keyed by the integer vector id.
+
+    Rows are read on demand (point lookups for search hits, doc_id/bucket filters),
+    so opening a shard does not parse or hold every chunk's text in memory.
+    Writes are batched into a transaction until commit(). Chunk text is also kept
+    in an FTS5 inverted index for BM25 keyword search, updated by triggers.
+
+    Searches read through a pooled read connection (committed=True), which sees only
+    committed rows and does not wait on the writer's connection (WAL mode).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.RLock()
+        self._idle = []  # idle read connections, at most READ_POOL_SIZE
+        self._closed = False
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            'id INTEGER PRIMARY KEY, doc_id TEXT, bucket TEXT, filename TEXT, text TEXT, extra TEXT)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS chunks_bucket ON chunks (bucket)')
+        self.fts = self._init_fts()
+        self._conn.commit()
+
+    def _init_fts(self) -> bool:
+        exists = self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone()
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5("
+                "text, content='chunks', content_rowid='id', tokenize='porter unicode61')"
+            )
+        except sqlite3.OperationalError as e:
+            print(f"Warning: SQLite FTS5 unavailable ({e}); keyword search disabled.")
+            return False
+        self._conn.execute('PRAGMA recursive_triggers = ON')
+        for trigger in FTS_TRIGGERS:
+            self._conn.execute(trigger)
+        if not exists:
+            # Index chunks stored before keyword search existed
+            self._conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        return True
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """Check out a read connection for one search and return it to the pool after."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA query_only = ON')
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                keep = not self._closed and len(self._idle) < READ_POOL_SIZE
+                if keep:
+                    self._idle.append(conn)
+            if not keep:
+                conn.close()
+
+    @staticmethod
+    def _row(meta: Dict[str, Any]) -> Tuple:
+        extra = {k: v for k, v in meta.items() if k not in COLUMNS}
+        return tuple(meta.get(c) for c in COLUMNS) + (json.dumps(extra) if extra else None,)
+
+    @staticmethod
+    def _meta(row) -> Dict[str, Any]:
+        meta = {c: v for c, v in zip(COLUMNS, row) if v is not None}
+        if row[len(COLUMNS)]:
+            meta.update(json.loads(row[len(COLUMNS)]))
+        return meta
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def __contains__(self, i) -> bool:
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM chunks WHERE id = ?', (int(i),)).fetchone() is not None
+
+    def get(self, i) -> Dict[str, Any]:
+        return self.get_many([i]).get(int(i))
+
+    def get_many(self, ids, committed: bool = False) -> Dict[int, Dict[str, Any]]:
+        """{id: metadata} for the ids that exist; committed=True skips rows not yet committed."""
+        ids = [int(i) for i in ids]
+        if committed:
+            with self._reader() as conn:
+                return self._select(conn, ids)
+        with self._lock:
+            return self._select(self._conn, ids)
+
+    def _select(self, conn: sqlite3.Connection, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        found = {}
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows = conn.execute(
+                f"SELECT id, {', '.join(COLUMNS)}, extra FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            found.update((row[0], self._meta(row[1:])) for row in rows)
+        return found
+
+    def ids(self) -> np.ndarray:
+        """Every stored id, sorted."""
+        with self._lock:
+            rows = self._conn.execute('SELECT id FROM chunks ORDER BY id').fetchall()
+        return np.array([r[0] for r in rows], dtype='int64')
+
+    def where(self, **filters) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """(id, metadata) for rows matching column filters, e.g. where(doc_id=...)."""
+        unknown = set(filters) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Cannot filter chunks on {sorted(unknown)}")
+        clause = ' AND '.join(f'{c} = ?' for c in filters) or '1'
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, {', '.join(COLUMNS)}, extra FROM chunks WHERE {clause} ORDER BY id", list(filters.values())
+            ).fetchall()
+        for row in rows:
+            yield row[0], self._meta(row[1:])
+
+    def keyword_search(self, query: str, k: int = 5) -> List[Tuple[int, float]]:
+        """[(id, bm25 score)] over committed rows, best first; any query term may match. Higher is better."""
+        terms = set(re.findall(r'\w+', query.lower()))
+        if not self.fts or not terms:
+            return []
+        match = ' OR '.join(f'"{t}"' for t in sorted(terms))
+        with self._reader() as conn:
+            rows = conn.execute(
+                'SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts) LIMIT ?',
+                (match, k),
+            ).fetchall()
+        # SQLite's bm25() is lower-is-better
+        return [(row[0], -row[1]) for row in rows]
+
+    def put_many(self, ids, metadatas: List[Dict[str, Any]]):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO chunks (id, doc_id, bucket, filename, text, extra) VALUES (?, ?, ?, ?, ?, ?)',
+                [(int(i),) + self._row(m) for i, m in zip(ids, metadatas)],
+            )
+
+    def delete_many(self, ids) -> List[int]:
+        """Delete rows by id. Returns the ids that existed."""
+        with self._lock:
+            existing = list(self.get_many(ids))
+            self._conn.executemany('DELETE FROM chunks WHERE id = ?', [(i,) for i in existing])
+        return existing
+
+    def update_many(self, ids, fields: Dict[str, Any]) -> int:
+        """Merge fields into existing rows. Returns how many rows changed."""
+        changed = 0
+        with self._lock:
+            for i, meta in self.get_many(ids).items():
+                if any(meta.get(k) != v for k, v in fields.items()):
+                    meta.update(fields)
+                    self.put_many([i], [meta])
+                    changed += 1
+        return changed
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM chunks')
+            self._conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def remove(self):
+        """Close and delete the database files."""
+        with self._lock:
+            self._closed = True
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+            self._conn.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
@@ -1,5 +1,14 @@
-from typing import List
+from typing import List, Dict, Any
 import os
+import re
+import time
+import queue
+import hashlib
+import itertools
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict
+import numpy as np
 
 try:
     from sentence_transformers import SentenceTransformer
@@ -7,34 +16,418 @@ try:
 except Exception:
     ST_AVAILABLE = False
 
+try:
+    import onnxruntime as ort
+    ORT_AVAILABLE = True
+except Exception:
+    ORT_AVAILABLE = False
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Persistent (model, chunk sha256) -> vector store; RAG_EMBED_CACHE=0 disables it
+EMBED_CACHE = os.environ.get('RAG_EMBED_CACHE', '1') == '1'
+EMBED_CACHE_DIR = os.environ.get('RAG_EMBED_CACHE_DIR', os.path.join(BACKEND_DIR, 'data', 'embedding_cache'))
+
+# Encoder backend: 'torch' (SentenceTransformer) or 'onnx' (int8-quantized ONNX Runtime export,
+# falling back to torch if it cannot be built). RAG_ONNX_THREADS sets intra-op threads.
+EMBED_BACKEND = os.environ.get('RAG_EMBED_BACKEND', 'torch').lower()
+ONNX_DIR = os.path.join(BACKEND_DIR, 'data', 'onnx')
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+ONNX_THREADS = int(os.environ.get('RAG_ONNX_THREADS', str(_available_cpus())))
+
+# Micro-batching: encode calls from concurrent requests are merged for up to
+# RAG_EMBED_BATCH_WAIT_MS or RAG_EMBED_BATCH_MAX texts, whichever comes first
+EMBED_BATCHING = os.environ.get('RAG_EMBED_BATCHING', '1') == '1'
+EMBED_BATCH_WAIT_MS = float(os.environ.get('RAG_EMBED_BATCH_WAIT_MS', '5'))
+EMBED_BATCH_MAX = int(os.environ.get('RAG_EMBED_BATCH_MAX', '64'))
+
+# Batcher priorities: questions are encoded ahead of queued ingest chunks
+PRIORITY_QUERY = 0
+PRIORITY_DOCUMENTS = 1
+
+QUERY_CACHE_SIZE = int(os.environ.get('RAG_QUERY_CACHE_SIZE', '1024'))
+QUERY_CACHE_TTL = float(os.environ.get('RAG_QUERY_CACHE_TTL', '3600'))
+
+
+def normalize_query(text: str) -> str:
+    """Cache key for a question: case- and whitespace-insensitive."""
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+class QueryCache:
+    """Bounded LRU of normalized query -> embedding, with entries expiring after ttl seconds."""
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, vector)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, vector):
+        if self.max_size <= 0:
+            return
+        vector.flags.writeable = False  # shared between callers
+        with self._lock:
+            self._entries[key] = (time.time(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class EmbeddingCache:
+    """Content-addressed chunk embeddings for one model, persisted across restarts.
+
+    vectors.f32 holds one float32 row per entry (read through a memmap) and keys.txt
+    the matching chunk sha256, one per line. Both are append-only; vectors are
+    written before their keys, so a crash can only leave unreferenced rows, which
+    are trimmed on open.
+    """
+
+    def __init__(self, cache_dir: str, dim: int):
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.vectors_path = os.path.join(cache_dir, 'vectors.f32')
+        self.keys_path = os.path.join(cache_dir, 'keys.txt')
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._map = None
+        self.hits = 0
+        self.misses = 0
+        self.rows = {}  # sha256 -> row
+        self.count = 0  # rows in vectors.f32 that have a key
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    key = line.strip()
+                    if len(key) == 64:
+                        # Line n is row n, even for a key repeated by older caches
+                        self.rows.setdefault(key, self.count)
+                        self.count += 1
+        stored = os.path.getsize(self.vectors_path) // self.row_bytes if os.path.exists(self.vectors_path) else 0
+        if stored < self.count:
+            print(f"Warning: embedding cache {cache_dir} is inconsistent; starting empty.")
+            self.rows = {}
+            self.count = 0
+            stored = -1
+        if stored != self.count:
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(self.count * self.row_bytes)
+            if not self.rows:
+                open(self.keys_path, 'w').close()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            found = [(k, self.rows[k]) for k in keys if k in self.rows]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if not found:
+                return {}
+            if self._map is None or self._map.shape[0] < self.count:
+                self._map = np.memmap(self.vectors_path, dtype='float32', mode='r', shape=(self.count, self.dim))
+            vectors = self._map
+        return {k: np.array(vectors[row]) for k, row in found}
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        with self._lock:
+            # One row per new key, even if a chunk repeats within the call
+            fresh = {}
+            for k, v in zip(keys, vectors):
+                if k not in self.rows:
+                    fresh.setdefault(k, v)
+            fresh = list(fresh.items())
+            if not fresh:
+                return
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.vstack([v for _, v in fresh]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.keys_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(k + '\n' for k, _ in fresh))
+                f.flush()
+                os.fsync(f.fileno())
+            for k, _ in fresh:
+                self.rows[k] = self.count
+                self.count += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.rows),
+                'size_mb': round(self.count * self.row_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class EmbeddingBatcher:
+    """Merges encode requests from concurrent threads into single model.encode calls.
+
+    A worker thread takes the highest-priority request, keeps collecting for up to
+    max_wait_ms or until max_batch texts are queued, encodes them together and
+    resolves each caller's Future with its rows. Only the worker touches the model.
+    """
+
+    def __init__(self, encode_fn, max_wait_ms: float = EMBED_BATCH_WAIT_MS, max_batch: int = EMBED_BATCH_MAX):
+        self._encode_fn = encode_fn
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()  # FIFO within a priority
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+
+    def submit(self, texts: List[str], priority: int = PRIORITY_DOCUMENTS) -> Future:
+        future = Future()
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+                self._worker.start()
+        self._queue.put((priority, next(self._seq), list(texts), future))
+        return future
+
+    def encode(self, texts: List[str], priority: int = PRIORITY_DOCUMENTS):
+        return self.submit(texts, priority).result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][2])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[2])
+
+            texts = [t for item in batch for t in item[2]]
+            try:
+                vectors = self._encode_fn(texts)
+            except Exception as e:
+                for item in batch:
+                    item[3].set_exception(e)
+                continue
+            offset = 0
+            for _, _, item_texts, future in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+            with self._stats_lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.texts += len(texts)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'texts': self.texts,
+                'requests_per_batch': round(self.requests / self.batches, 2) if self.batches else 0.0,
+                'queued': self._queue.qsize(),
+            }
+
+
+class OnnxEncoder:
+    """A SentenceTransformer's transformer exported to ONNX with dynamic int8 weights.
+
+    Tokenization stays with the SentenceTransformer's tokenizer; mean pooling and
+    (if the model has a Normalize module) L2 normalization are done in numpy, which
+    matches all-MiniLM-L6-v2's pipeline. The export is built once and reused.
+    """
+
+    def __init__(self, st_model, model_dir: str, threads: int = ONNX_THREADS):
+        self.path = os.path.join(model_dir, 'model-int8.onnx')
+        if not os.path.exists(self.path):
+            self._export(st_model, model_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = st_model.tokenizer
+        self.max_seq_length = st_model.max_seq_length
+        self.normalize = any(type(module).__name__ == 'Normalize' for module in st_model)
+
+    def _export(self, st_model, model_dir: str):
+        import torch
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        os.makedirs(model_dir, exist_ok=True)
+        transformer = st_model[0].auto_model.eval()
+        sample = st_model.tokenizer(['export sample'], return_tensors='pt')
+        # BertModel's positional order
+        names = [n for n in ('input_ids', 'attention_mask', 'token_type_ids') if n in sample]
+        fp32_path = os.path.join(model_dir, 'model-fp32.onnx')
+        started = time.time()
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer, tuple(sample[n] for n in names), fp32_path,
+                input_names=names, output_names=['last_hidden_state'],
+                dynamic_axes={n: {0: 'batch', 1: 'seq'} for n in names + ['last_hidden_state']},
+                opset_version=14,
+            )
+        tmp_path = self.path + '.tmp'
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, self.path)
+        os.remove(fp32_path)
+        print(f"[Embeddings] Exported int8 ONNX model to {self.path} in {time.time() - started:.1f}s")
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        out = []
+        for start in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors='np')
+            hidden = self.session.run(None, {n: enc[n].astype('int64') for n in self.input_names})[0]
+            mask = enc['attention_mask'][..., None].astype('float32')
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            out.append(pooled.astype('float32'))
+        return np.vstack(out)
+
+
 # Simple wrapper for sentence-transformers embeddings with batching
 class Embeddings:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', backend: str = None):
         self.model_name = model_name
         self.model = None
+        self.onnx = None
+        self.backend = 'torch'
+        # Every hit is a transformer forward pass saved
+        self.query_cache = QueryCache()
+        self.document_cache = None
+        self.batcher = None
         if ST_AVAILABLE:
             try:
                 self.model = SentenceTransformer(model_name)
             except Exception as e:
                 print(f"Warning: failed to load SentenceTransformer '{model_name}': {e}")
 
+            safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+            if (backend or EMBED_BACKEND) == 'onnx' and self.model is not None:
+                if ORT_AVAILABLE:
+                    try:
+                        self.onnx = OnnxEncoder(self.model, os.path.join(ONNX_DIR, safe_name))
+                        self.backend = 'onnx'
+                    except Exception as e:
+                        print(f"Warning: ONNX backend unavailable ({e}); using PyTorch.")
+                else:
+                    print("Warning: onnxruntime not installed; using PyTorch embeddings.")
+
+            if EMBED_CACHE and self.model is not None:
+                # int8 vectors differ slightly from the PyTorch ones: keep them apart
+                cache_name = safe_name + ('-onnx-int8' if self.backend == 'onnx' else '')
+                cache_dir = os.path.join(EMBED_CACHE_DIR, cache_name)
+                try:
+                    self.document_cache = EmbeddingCache(cache_dir, self.dimension())
+                except Exception as e:
+                    print(f"Warning: embedding cache unavailable ({e})")
+
+            if EMBED_BATCHING and self.model is not None:
+                self.batcher = EmbeddingBatcher(self._encode_now)
+
+    def _encode_now(self, texts: List[str], batch_size: int = 32):
+        if self.onnx is not None:
+            return self.onnx.encode(texts, batch_size=batch_size)
+        return self.model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+
+    def _encode(self, texts: List[str], priority: int = PRIORITY_DOCUMENTS, batch_size: int = 32):
+        """Encode through the shared micro-batcher (or directly when batching is off)."""
+        if not texts:
+            return np.zeros((0, self.dimension()), dtype='float32')
+        if self.batcher is None:
+            return self._encode_now(texts, batch_size)
+        return self.batcher.encode(texts, priority)
+
     def embed_documents(self, texts: List[str], batch_size: int = 32):
+        """Embed chunks, encoding only text not already in the persistent chunk cache."""
         if not self.model:
             raise RuntimeError('SentenceTransformer model not available')
-        embeddings = self.model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
-        return embeddings
+        if self.document_cache is None:
+            return self._encode(texts, batch_size=batch_size)
+
+        keys = [hashlib.sha256(t.encode('utf-8')).hexdigest() for t in texts]
+        cached = self.document_cache.get_many(keys)
+        missing = {}
+        for k, t in zip(keys, texts):
+            if k not in cached:
+                missing.setdefault(k, t)
+        if missing:
+            encoded = self._encode(list(missing.values()), batch_size=batch_size)
+            self.document_cache.put_many(list(missing), encoded)
+            cached.update(zip(missing, np.asarray(encoded, dtype='float32')))
+        return np.vstack([cached[k] for k in keys]) if keys else np.zeros((0, self.dimension()), dtype='float32')
 
     def embed_query(self, text: str):
+        """Embedding of a question, served from the query cache when it was asked recently.
+
+        The returned array is shared with the cache and read-only.
+        """
+        if not self.model:
+            raise RuntimeError('SentenceTransformer model not available')
+        key = normalize_query(text)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            # Encode the normalized text so a hit returns exactly what a miss would
+            vector = np.array(self._encode([key], priority=PRIORITY_QUERY)[0])
+            self.query_cache.put(key, vector)
+        return vector
+
+    def dimension(self) -> int:
         if not self.model:
             raise RuntimeError('SentenceTransformer model not available')
-        return self.model.encode([text], convert_to_numpy=True)[0]
+        return self.model.get_sentence_embedding_dimension()
 
 
-# Convenience singleton
-_GLOBAL = None
+# Convenience singletons, one per model name
+_INSTANCES = {}
 
-def get_embeddings_instance():
-    global _GLOBAL
-    if _GLOBAL is None:
-        _GLOBAL = Embeddings()
-    return _GLOBAL
+def get_embeddings_instance(model_name: str = 'all-MiniLM-L6-v2'):
+    if model_name not in _INSTANCES:
+        _INSTANCES[model_name] = Embeddings(model_name)
+    return _INSTANCES[model_name]
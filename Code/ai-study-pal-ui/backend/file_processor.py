@@ -2,6 +2,12 @@ import os
 import pypdf
 import docx
 
+# extract_text_from_file reports failures as text starting with one of these
+EXTRACTION_ERRORS = ("Error reading file", "Error: Unsupported file type")
+
+def is_extraction_error(text):
+    return text.startswith(EXTRACTION_ERRORS)
+
 def extract_text_from_file(file_path):
     """
     Extracts text from PDF, DOCX, or TXT/MD files.
@@ -0,0 +1,221 @@
+"""Staged ingestion pipeline: extract -> chunk -> embed -> index.
+
+- extract: file_processor.extract_text_from_file in a process pool (PDF parsing is
+  CPU-bound and would otherwise serialize on the GIL)
+- chunk + embed: one thread takes every document that is ready, splits them and
+  embeds the chunks their index does not already hold in batched calls across
+  documents
+- index: a single writer thread applies the upserts, so shard writes never
+  contend with each other or with the embed stage
+
+API:
+ - get_pipeline() -> IngestPipeline (shared, uses ml_utils.rag_system)
+ - IngestPipeline.submit_file(path, subject, filename, doc_id=None, user_id=None, cleanup=False) -> IngestJob
+ - IngestPipeline.submit_text(text, subject, filename, doc_id=None, user_id=None) -> IngestJob
+    job.extracted resolves to the text, job.done to the number of chunks embedded.
+ - IngestPipeline.rehydrate(notes, bucket_names) -> (jobs, unchanged, skipped)
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Any
+import os
+import re
+import queue
+import threading
+import numpy as np
+
+import file_processor
+from vector_store import content_hash
+
+INGEST_PROCESSES = int(os.environ.get('RAG_INGEST_PROCESSES', str(os.cpu_count() or 1)))
+# Chunks per embedding call when batching across documents
+INGEST_EMBED_BATCH = int(os.environ.get('RAG_INGEST_EMBED_BATCH', '256'))
+
+# Content the frontend stores for an uploaded file's note; the index holds the file's text instead
+FILE_NOTE_PLACEHOLDER = re.compile(r'^\[(Indexed for AI|Document:)')
+
+
+class IngestJob:
+    def __init__(self, subject: str, filename: str, doc_id=None, user_id=None):
+        self.subject = subject
+        self.filename = filename
+        self.doc_id = str(doc_id) if doc_id is not None else f"{subject}/{filename}"
+        self.user_id = user_id
+        self.text = None
+        self.extracted = Future()
+        self.done = Future()
+
+    def fail(self, error: Exception):
+        if not self.extracted.done():
+            self.extracted.set_exception(error)
+        if not self.done.done():
+            self.done.set_exception(error)
+
+
+class IngestPipeline:
+    def __init__(self, rag, processes: int = INGEST_PROCESSES, embed_batch: int = INGEST_EMBED_BATCH):
+        self.rag = rag
+        self.processes = processes
+        self.embed_batch = embed_batch
+        self._extractors = None
+        self._ready = queue.Queue()   # IngestJob with text, waiting to be chunked + embedded
+        self._writes = queue.Queue()  # (job, split, {chunk_hash: vector}) for the writer
+        self._start_lock = threading.Lock()
+        self._threads = []
+        self.documents = 0
+        self.embedded = 0
+        self.batches = 0
+
+    def _start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            if self._extractors is None:
+                self._extractors = ProcessPoolExecutor(max_workers=self.processes)
+            for name, target in (('ingest-embed', self._embed_loop), ('ingest-writer', self._write_loop)):
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit_file(self, path: str, subject: str, filename: str, doc_id=None, user_id=None, cleanup: bool = False) -> IngestJob:
+        """Extract text from a file in the process pool, then index it. cleanup deletes the file after extraction."""
+        self._start()
+        job = IngestJob(subject, filename, doc_id, user_id)
+
+        def _extracted(future):
+            if cleanup and os.path.exists(path):
+                os.remove(path)
+            try:
+                text = future.result()
+                if text and file_processor.is_extraction_error(text):
+                    raise ValueError(text)
+                self._accept(job, text)
+            except Exception as e:
+                job.fail(e)
+
+        self._extractors.submit(file_processor.extract_text_from_file, path).add_done_callback(_extracted)
+        return job
+
+    def submit_text(self, text: str, subject: str, filename: str, doc_id=None, user_id=None) -> IngestJob:
+        self._start()
+        job = IngestJob(subject, filename, doc_id, user_id)
+        self._accept(job, text)
+        return job
+
+    def rehydrate(self, notes, bucket_names: Dict[str, str]):
+        """Re-index Supabase notes the index is missing or holds an older version of.
+
+        Notes backed by an uploaded file (file_path, or placeholder content) are indexed
+        from the file by /api/upload and /api/reprocess; their DB content is only used
+        when the index has nothing for them and it is real text. Returns (jobs, unchanged, skipped).
+        """
+        jobs, unchanged, skipped = [], 0, 0
+        for n in notes:
+            note_id = n['id']
+            user_id = n.get('user_id')
+            title = n['title']
+            content = n.get('content')
+            bucket_name = bucket_names.get(n.get('bucket_id'), "Uncategorized")
+
+            if not content:
+                print(f"Skipping {title} (no content in DB)")
+                skipped += 1
+                continue
+            if n.get('file_path') or FILE_NOTE_PLACEHOLDER.match(content):
+                if FILE_NOTE_PLACEHOLDER.match(content) or self.rag.indexed_document(note_id, user_id=user_id):
+                    skipped += 1
+                    continue
+            # Snapshot already holds this exact content -> nothing to embed
+            elif self.rag.is_current(note_id, content, user_id=user_id):
+                unchanged += 1
+                continue
+
+            print(f"DTO processing: {title} -> {bucket_name}")
+            jobs.append(self.submit_text(content, subject=bucket_name, filename=title, doc_id=note_id, user_id=user_id))
+        return jobs, unchanged, skipped
+
+    def _accept(self, job: IngestJob, text: str):
+        if not text:
+            job.fail(ValueError('No text extracted'))
+            return
+        job.text = text
+        job.extracted.set_result(text)
+        self._ready.put(job)
+
+    def _embed_loop(self):
+        while True:
+            jobs = [self._ready.get()]
+            while True:
+                try:
+                    jobs.append(self._ready.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Chunk every ready document; only chunks their index lacks need the model
+            prepared, needed = [], {}
+            for job in jobs:
+                try:
+                    split = self.rag._split(job.text)
+                    known = self.rag.indexed_chunks(job.doc_id, user_id=job.user_id)
+                    for h, t in split[0].items():
+                        if h not in known:
+                            needed.setdefault(h, t)
+                    prepared.append((job, split))
+                except Exception as e:
+                    job.fail(e)
+
+            vectors = {}
+            try:
+                hashes = list(needed)
+                for start in range(0, len(hashes), self.embed_batch):
+                    batch = hashes[start:start + self.embed_batch]
+                    vectors.update(zip(batch, self.rag.embeddings.embed_documents([needed[h] for h in batch])))
+                    self.batches += 1
+            except Exception as e:
+                for job, _ in prepared:
+                    job.fail(e)
+                continue
+
+            print(f"[Ingest] Embedded {len(needed)} chunks for {len(prepared)} documents")
+            for job, split in prepared:
+                self._writes.put((job, split, vectors))
+
+    def _write_loop(self):
+        while True:
+            job, split, vectors = self._writes.get()
+
+            def embed_fn(texts):
+                # Vectors from the embed stage; anything else (index changed meanwhile) is embedded here
+                missing = [t for t in texts if content_hash(t) not in vectors]
+                if missing:
+                    vectors.update(zip(map(content_hash, missing), self.rag.embeddings.embed_documents(missing)))
+                return np.vstack([vectors[content_hash(t)] for t in texts])
+
+            try:
+                count = self.rag.add_document(job.text, job.subject, job.filename, doc_id=job.doc_id,
+                                              user_id=job.user_id, split=split, embed_fn=embed_fn)
+                self.documents += 1
+                self.embedded += count
+                job.done.set_result(count)
+            except Exception as e:
+                job.fail(e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'documents': self.documents,
+            'chunks_embedded': self.embedded,
+            'embed_batches': self.batches,
+            'waiting_embed': self._ready.qsize(),
+            'waiting_write': self._writes.qsize(),
+        }
+
+
+_PIPELINE = None
+_PIPELINE_LOCK = threading.Lock()
+
+def get_pipeline() -> IngestPipeline:
+    global _PIPELINE
+    with _PIPELINE_LOCK:
+        if _PIPELINE is None:
+            from ml_utils import rag_system
+            _PIPELINE = IngestPipeline(rag_system)
+    return _PIPELINE
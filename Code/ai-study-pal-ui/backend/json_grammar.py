@@ -0,0 +1,180 @@
+"""JSON-schema constraint for local decoding.
+
+A character-level matcher for a small JSON-schema subset, used by the local LLM
+engines (llm_scheduler) to only sample tokens that keep the output a valid
+prefix of a document matching the schema, and to stop as soon as the root
+object closes.
+
+Supported: object (properties, all required, in the schema's order; no others),
+array (items, minItems, maxItems), string (maxLength), integer, boolean.
+Runs of whitespace between tokens are capped so the model cannot pad forever.
+
+API:
+ - JSONConstraint(schema, prefix='')  prefix: JSON the prompt already ends with
+ - JSONConstraint.start() -> state
+ - JSONConstraint.feed(state, text) -> state | None (None if text cannot follow)
+ - JSONConstraint.complete(state) -> bool
+"""
+from typing import Any, Dict, Optional, Tuple
+
+WHITESPACE = ' \t\n\r'
+MAX_WHITESPACE = 16
+ESCAPES = '"\\/bfnrt'
+HEX = '0123456789abcdefABCDEF'
+DIGITS = '0123456789'
+
+
+def _compile(schema: Dict[str, Any]) -> Tuple:
+    kind = schema.get('type')
+    if kind == 'object':
+        return ('object', tuple((name, _compile(sub)) for name, sub in schema.get('properties', {}).items()))
+    if kind == 'array':
+        return ('array', _compile(schema['items']), schema.get('minItems', 0), schema.get('maxItems'))
+    if kind == 'string':
+        return ('string', schema.get('maxLength'))
+    if kind in ('integer', 'boolean'):
+        return (kind,)
+    raise ValueError(f"Unsupported schema type for constrained decoding: {kind}")
+
+
+def _open(stack: Tuple, node: Tuple, c: str):
+    """Stack after the first character c of a value for node, or None."""
+    kind = node[0]
+    if kind == 'object' and c == '{':
+        return stack + (('obj', node, 0, 'open'),)
+    if kind == 'array' and c == '[':
+        return stack + (('arr', node, 0, 'open'),)
+    if kind == 'string' and c == '"':
+        return stack + (('str', node[1], 0, 0),)
+    if kind == 'integer' and (c == '-' or c in DIGITS):
+        # (finished, leading zero): '-' needs a digit; nothing may follow a leading 0
+        return stack + (('int', c != '-', c == '0'),)
+    if kind == 'boolean' and c in 'tf':
+        return stack + (('lit', 'rue' if c == 't' else 'alse'),)
+    return None
+
+
+def _string(stack: Tuple, c: str):
+    # escape: 0 plain, -1 after a backslash, n > 0 hex digits of \\u left
+    _, limit, length, escape = stack[-1]
+    if escape == -1:
+        if c == 'u':
+            return stack[:-1] + (('str', limit, length, 4),)
+        if c not in ESCAPES:
+            return None
+        escape = 0
+    elif escape > 0:
+        if c not in HEX:
+            return None
+        escape -= 1
+        if escape:
+            return stack[:-1] + (('str', limit, length, escape),)
+    elif c == '"':
+        return stack[:-1]
+    elif c == '\\':
+        return stack[:-1] + (('str', limit, length, -1),)
+    elif c < ' ':
+        return None
+    if limit is not None and length >= limit:
+        return None
+    return stack[:-1] + (('str', limit, length + 1, 0),)
+
+
+def _step(stack: Tuple, ws: int, c: str):
+    """(stack, whitespace run) after character c, or None."""
+    while True:
+        if not stack:
+            break
+        frame = stack[-1]
+        kind = frame[0]
+        if kind == 'str':
+            stack = _string(stack, c)
+            return None if stack is None else (stack, 0)
+        if kind == 'lit':
+            rest = frame[1]
+            if c != rest[0]:
+                return None
+            return stack[:-1] + ((('lit', rest[1:]),) if len(rest) > 1 else ()), 0
+        if kind == 'int':
+            if c in DIGITS:
+                if frame[2]:
+                    return None  # JSON has no leading zeros
+                return stack[:-1] + (('int', True, c == '0' and not frame[1]),), 0
+            if not frame[1]:
+                return None
+            # The number ended; c belongs to the enclosing value
+            stack = stack[:-1]
+            continue
+        break
+
+    if c in WHITESPACE:
+        return (stack, ws + 1) if ws < MAX_WHITESPACE else None
+    if not stack:
+        return None  # nothing may follow the root value
+    frame = stack[-1]
+    kind = frame[0]
+    rest = stack[:-1]
+
+    if kind == 'value':
+        stack = _open(rest, frame[1], c)
+    elif kind == 'obj':
+        _, node, i, phase = frame
+        props = node[1]
+        if phase == 'open' and c == '"' and i < len(props):
+            # The key is forced: the next property, quotes included
+            stack = rest + (('obj', node, i, 'colon'), ('lit', props[i][0] + '"'))
+        elif phase == 'open' and c == '}' and not props:
+            stack = rest
+        elif phase == 'colon' and c == ':':
+            stack = rest + (('obj', node, i + 1, 'after'), ('value', props[i][1]))
+        elif phase == 'after' and c == ',' and i < len(props):
+            stack = rest + (('obj', node, i, 'open'),)
+        elif phase == 'after' and c == '}' and i == len(props):
+            stack = rest
+        else:
+            stack = None
+    elif kind == 'arr':
+        _, node, count, phase = frame
+        _, items, least, most = node
+        if phase in ('open', 'comma') and not (phase == 'open' and c == ']'):
+            if most is not None and count >= most:
+                return None
+            stack = _open(rest + (('arr', node, count + 1, 'after'),), items, c)
+        elif phase == 'open':
+            stack = rest if least == 0 else None
+        elif c == ',':
+            stack = rest + (('arr', node, count, 'comma'),) if most is None or count < most else None
+        elif c == ']':
+            stack = rest if count >= least else None
+        else:
+            stack = None
+    else:
+        stack = None
+    return None if stack is None else (stack, 0)
+
+
+class JSONConstraint:
+    def __init__(self, schema: Dict[str, Any], prefix: str = ''):
+        self.schema = schema
+        self.prefix = prefix
+        self._start = self.feed(((('value', _compile(schema)),), 0), prefix)
+        if self._start is None:
+            raise ValueError(f"Prefix {prefix!r} does not match the schema")
+
+    def start(self):
+        return self._start
+
+    def feed(self, state, text: str) -> Optional[Tuple]:
+        stack, ws = state
+        for c in text:
+            state = _step(stack, ws, c)
+            if state is None:
+                return None
+            stack, ws = state
+        return stack, ws
+
+    @staticmethod
+    def complete(state) -> bool:
+        stack = state[0]
+        # A root integer has no closing character; it is complete once it has a digit
+        return not stack or (len(stack) == 1 and stack[0][0] == 'int' and stack[0][1])
@@ -1,6 +1,9 @@
 import os
+import threading
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer, pipeline
+from llm_scheduler import (LLMScheduler, TransformersEngine, GGUFEngine, GenerationRequest, decode, stop_pieces, FEATURE_STOP,
+                           LLM_SCHEDULER, LLM_MAX_BATCH, LLM_GGUF_WORKERS)
 
 # Try importing CTransformers for GGUF support
 try:
@@ -9,20 +12,49 @@ try:
 except ImportError:
     CT_AVAILABLE = False
 
+# The local model (GGUF build or HF fallback) and its context window; RAG prompts are budgeted in its tokens
+LOCAL_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+CONTEXT_TOKENS = 2048
+
+_TOKENIZER = None
+
+def get_tokenizer():
+    """TinyLlama's tokenizer (shared; loading it does not load the model)."""
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        _TOKENIZER = AutoTokenizer.from_pretrained(LOCAL_MODEL_NAME)
+    return _TOKENIZER
+
 # Abstract Base
 class LLMProvider:
-    def generate(self, prompt, max_tokens=200):
+    # What the reply depends on besides the prompt (response cache key)
+    model_id = None
+    sampling = {}
+
+    # feature ('chat', 'notes', 'quiz', 'tips', 'summary', 'plan') sets the request's
+    # priority in the local scheduler; other providers ignore it.
+    # constraint (json_grammar.JSONConstraint) makes local decoding follow a JSON
+    # schema; cloud providers ignore it and callers still validate their reply.
+    # Local providers also stop decoding where FEATURE_STOP says the feature's reply is over.
+    def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
         raise NotImplementedError
 
+    def stream(self, prompt, max_tokens=200, feature=None):
+        """Yield the reply in pieces as it is generated. Providers without
+        token streaming yield the whole reply once."""
+        yield self.generate(prompt, max_tokens, feature)
+
 # --- 1. Cloud Providers ---
 class GeminiProvider(LLMProvider):
+    model_id = 'gemini-pro'
+
     def __init__(self, api_key):
         import google.generativeai as genai
         self.api_key = api_key
         genai.configure(api_key=self.api_key)
         self.model = genai.GenerativeModel('gemini-pro')
     
-    def generate(self, prompt, max_tokens=500):
+    def generate(self, prompt, max_tokens=500, feature=None, constraint=None):
         try:
             clean_prompt = prompt.replace("<|system|>", "").replace("</s>", "").replace("<|user|>", "").replace("<|assistant|>", "")
             response = self.model.generate_content(clean_prompt)
@@ -31,12 +63,14 @@ class GeminiProvider(LLMProvider):
             return f"Gemini Error: {str(e)}"
 
 class OpenAIProvider(LLMProvider):
+    model_id = 'gpt-3.5-turbo'
+
     def __init__(self, api_key):
         self.api_key = api_key
         import openai
         self.client = openai.OpenAI(api_key=api_key)
     
-    def generate(self, prompt, max_tokens=500):
+    def generate(self, prompt, max_tokens=500, feature=None, constraint=None):
         try:
             clean_prompt = prompt.replace("<|system|>", "").replace("</s>", "").replace("<|user|>", "").replace("<|assistant|>", "")
             response = self.client.chat.completions.create(
@@ -54,20 +88,41 @@ class OpenAIProvider(LLMProvider):
 # --- 2. Local Optimized Providers ---
 
 class CTransformersProvider(LLMProvider):
-    def __init__(self, model_path, model_type="llama", gpu_layers=0):
+    sampling = {'temperature': 0.3, 'top_p': 0.9}
+
+    def __init__(self, model_path, model_type="llama", gpu_layers=0, threads=-1):
         print(f"[SmartLoader] Initializing GGUF Backend (GPU Layers: {gpu_layers})...")
-        self.llm = GGUFModel.from_pretrained(
-            model_path, 
-            model_type=model_type, 
-            gpu_layers=gpu_layers,
-            context_length=2048
-        )
+        self.model_path = model_path
+        self.model_id = os.path.basename(model_path)
+        self.model_type = model_type
+        self.gpu_layers = gpu_layers
+        self.threads = threads
+        self.llm = self.new_model()
+        self.engine = None  # GGUFEngine for constrained requests
         print("[SmartLoader] GGUF Model Loaded.")
 
-    def generate(self, prompt, max_tokens=200):
+    def new_model(self):
+        """Another instance of the model (a GGUF model holds one context at a time)."""
+        return GGUFModel.from_pretrained(
+            self.model_path, 
+            model_type=self.model_type, 
+            gpu_layers=self.gpu_layers,
+            context_length=CONTEXT_TOKENS,
+            threads=self.threads
+        )
+
+    def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
         # CTransformers prompt handling
         # It handles GenerationConfig inside the call
         try:
+           if constraint is not None:
+               # The high-level call cannot mask tokens; decode step by step instead
+               self.engine = self.engine or GGUFEngine(self.llm)
+               return decode(self.engine, GenerationRequest(prompt, max_tokens, feature, constraint))
+           if feature in FEATURE_STOP:
+               # Streamed, so generation ends where the reply is over
+               return "".join(self.stream(prompt, max_tokens, feature))
+
            # Clean prompt tags if needed, or keep them if model was trained on them
            # TinyLlama Chat expects ChatML/Standard format usually. 
            # CTransformers might need raw text completion style.
@@ -85,11 +140,31 @@ class CTransformersProvider(LLMProvider):
         except Exception as e:
             return f"GGUF Error: {e}"
 
+    def stream(self, prompt, max_tokens=200, feature=None):
+        # Same settings as generate(); ctransformers yields text as tokens are sampled
+        # and stops as soon as the consumer stops iterating
+        try:
+            pieces = self.llm(
+                prompt,
+                max_new_tokens=max_tokens,
+                temperature=0.3,
+                top_p=0.9,
+                stop=["</s>", "<|user|>", "User:"],
+                stream=True
+            )
+            stopping = FEATURE_STOP.get(feature)
+            yield from stop_pieces(pieces, stopping) if stopping else pieces
+        except Exception as e:
+            yield f"GGUF Error: {e}"
+
 class HFTransformersProvider(LLMProvider):
+    model_id = LOCAL_MODEL_NAME
+    sampling = {'temperature': 0.3, 'top_k': 50}
+
     def __init__(self):
         print("[SmartLoader] Initializing Standard Transformers Backend (CPU Fallback)...")
-        self.model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.model_name = LOCAL_MODEL_NAME
+        self.tokenizer = get_tokenizer()
         self.model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
         self.generator = pipeline(
             "text-generation", 
@@ -97,28 +172,95 @@ class HFTransformersProvider(LLMProvider):
             tokenizer=self.tokenizer,
             max_new_tokens=200
         )
+        self.engine = None  # TransformersEngine for constrained requests
         print("[SmartLoader] Standard Model Loaded.")
 
-    def generate(self, prompt, max_tokens=200):
+    def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
         try:
+            if constraint is not None:
+                self.engine = self.engine or TransformersEngine(self.model, self.tokenizer)
+                return decode(self.engine, GenerationRequest(prompt, max_tokens, feature, constraint))
+            stopping = FEATURE_STOP.get(feature)
+            criteria = [_StopCriteria(self.tokenizer, stopping, len(self.tokenizer(prompt).input_ids))] if stopping else []
             outputs = self.generator(
                 prompt, 
                 max_new_tokens=max_tokens, 
                 do_sample=True, 
                 temperature=0.3,
-                return_full_text=False
+                return_full_text=False,
+                stopping_criteria=StoppingCriteriaList(criteria)
             )
-            return outputs[0]['generated_text'].strip()
+            text = outputs[0]['generated_text']
+            return (stopping.apply(text) if stopping else text).strip()
         except Exception as e:
             return f"HF Error: {e}"
 
+    def stream(self, prompt, max_tokens=200, feature=None):
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=120)
+        cancelled = threading.Event()
+        inputs = self.tokenizer(prompt, return_tensors="pt")
+        worker = threading.Thread(target=self.model.generate, kwargs=dict(
+            inputs,
+            streamer=streamer,
+            max_new_tokens=max_tokens,
+            do_sample=True,
+            temperature=0.3,
+            # Stop the model once the consumer has stopped reading
+            stopping_criteria=StoppingCriteriaList([_CancelCriteria(cancelled)]),
+        ), daemon=True)
+        worker.start()
+        stopping = FEATURE_STOP.get(feature)
+        if stopping:
+            # Closing the stream at the stop sets `cancelled` below
+            yield from stop_pieces(self._pieces(streamer, cancelled), stopping)
+        else:
+            yield from self._pieces(streamer, cancelled)
+
+    @staticmethod
+    def _pieces(streamer, cancelled):
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        except Exception as e:
+            yield f"HF Error: {e}"
+        finally:
+            cancelled.set()
+
+
+class _CancelCriteria(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+class _StopCriteria(StoppingCriteria):
+    """Ends generation once the text after the prompt meets a StopCondition."""
+
+    def __init__(self, tokenizer, stopping, prompt_tokens):
+        self.tokenizer = tokenizer
+        self.stopping = stopping
+        self.prompt_tokens = prompt_tokens
+
+    def __call__(self, input_ids, scores, **kwargs):
+        text = self.tokenizer.decode(input_ids[0, self.prompt_tokens:], skip_special_tokens=True)
+        return self.stopping.cut(text) is not None
+
 # --- 3. Smart Auto-Loader ---
 
 class SmartLoader:
     def __init__(self):
         self.provider = None
+        self.scheduler = None
         self.model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'models', 'tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf')
 
+    @property
+    def backend(self):
+        """The loaded local provider (loading it on first use)."""
+        return self.provider or self.load()
+
     def _check_nvidia_smi(self):
         """Check for NVIDIA GPU via system command, independent of PyTorch"""
         import subprocess
@@ -159,27 +301,39 @@ class SmartLoader:
         
         print(f"GPU Detected: {gpu_name if gpu_name else 'None'}")
         
+        # Several GGUF workers split the cores instead of each using all of them
+        threads = max(1, (os.cpu_count() or 1) // LLM_GGUF_WORKERS) if LLM_SCHEDULER and LLM_GGUF_WORKERS > 1 else -1
         if CT_AVAILABLE and has_gguf:
             if has_cuda:
                 print(">> OPTIMIZATION: TURBO GPU MODE ACTIVATED")
                 print(f"   Offloading layers to {gpu_name}")
                 # Offload 50 layers (all) to GPU
-                self.provider = CTransformersProvider(self.model_path, gpu_layers=50)
+                self.provider = CTransformersProvider(self.model_path, gpu_layers=50, threads=threads)
             else:
                 print(">> OPTIMIZATION: FAST CPU AVX MODE ACTIVATED")
                 # CPU optimized
-                self.provider = CTransformersProvider(self.model_path, gpu_layers=0)
+                self.provider = CTransformersProvider(self.model_path, gpu_layers=0, threads=threads)
         else:
             print(">> MODE: STANDARD COMPATIBILITY (CPU)")
             if not has_gguf: print(f"   (GGUF model not found at {self.model_path})")
             if not CT_AVAILABLE: print("   (ctransformers lib not installed)")
             self.provider = HFTransformersProvider()
-            
+
+        if LLM_SCHEDULER:
+            self.scheduler = self._scheduler()
         return self.provider
 
-    def generate(self, prompt, max_tokens=200):
-        if not self.provider: self.load()
-        
+    def _scheduler(self):
+        """Queue local requests by feature priority: continuous batching on Transformers,
+        LLM_GGUF_WORKERS single-sequence model instances on GGUF."""
+        if isinstance(self.provider, CTransformersProvider):
+            models = [self.provider.llm] + [self.provider.new_model() for _ in range(LLM_GGUF_WORKERS - 1)]
+            print(f"[SmartLoader] Scheduler: {len(models)} GGUF worker(s)")
+            return LLMScheduler([GGUFEngine(m) for m in models], max_batch=1)
+        print(f"[SmartLoader] Scheduler: continuous batching (up to {LLM_MAX_BATCH} sequences)")
+        return LLMScheduler([TransformersEngine(self.provider.model, self.provider.tokenizer)], max_batch=LLM_MAX_BATCH)
+
+    def _format(self, prompt):
         # Consistent prompt formatting for all local backend
         if "<|system|>" not in prompt:
              prompt = (
@@ -189,8 +343,29 @@ class SmartLoader:
                 f"{prompt}</s>\n"
                 "<|assistant|>\n"
             )
-            
-        return self.provider.generate(prompt, max_tokens)
+        return prompt
+
+    def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
+        if not self.provider: self.load()
+        if not self.scheduler:
+            return self.provider.generate(self._format(prompt), max_tokens, feature, constraint)
+        try:
+            return self.scheduler.generate(self._format(prompt), max_tokens, feature, constraint)
+        except Exception as e:
+            return f"LLM Error: {e}"
+
+    def stream(self, prompt, max_tokens=200, feature=None):
+        if not self.provider: self.load()
+        if not self.scheduler:
+            yield from self.provider.stream(self._format(prompt), max_tokens, feature)
+            return
+        try:
+            yield from self.scheduler.stream(self._format(prompt), max_tokens, feature)
+        except Exception as e:
+            yield f"LLM Error: {e}"
+
+    def stats(self):
+        return self.scheduler.stats() if self.scheduler else None
 
 # Singleton
 local_llm = SmartLoader()
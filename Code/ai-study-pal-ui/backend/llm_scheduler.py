@@ -0,0 +1,713 @@
+"""Request scheduling for the local LLM (SmartLoader).
+
+Every local generation (chat, notes Q&A, quiz questions, tips, summaries, study
+plans) is a request in one priority queue, ordered by feature priority and then
+arrival:
+
+- Transformers backend: continuous batching. Running sequences decode together,
+  one token per forward pass over the batch; new requests are prefilled and join
+  between steps and finished ones leave, up to LLM_MAX_BATCH at a time.
+- GGUF backend (ctransformers): a model holds a single context, so each of
+  LLM_GGUF_WORKERS model instances (default 1) decodes one sequence at a time.
+
+When a more urgent request is waiting and every slot is busy, the least urgent
+running sequence is preempted: it goes back to the queue keeping the tokens it
+has produced and resumes (re-reading prompt + output) once a slot frees up, so
+chat does not wait behind a bulk quiz run.
+
+Decoding stops as soon as the reply is over for its feature (FEATURE_STOP: chat
+at a paragraph break or role marker, notes at NOT_IN_NOTES, quiz after the
+Correct: line, tips after five tips) instead of generating text callers cut.
+Each feature's max_tokens adapts to the lengths its outputs actually reach.
+
+Requests may carry a json_grammar.JSONConstraint: only tokens that keep the
+output a valid prefix of the schema are sampled, and decoding ends when the
+root object closes.
+
+Prefill reuses the KV state of the fixed system prompts: the Transformers engine
+caches it per system prompt, and a GGUF model keeps the prefix its context
+shares with the next prompt. Only the user turn and context are evaluated.
+
+API:
+ - LLMScheduler(engines, max_batch).generate(prompt, max_tokens=200, feature=None, constraint=None) -> str
+ - LLMScheduler.stream(prompt, max_tokens=200, feature=None) -> iterator of text pieces
+ - LLMScheduler.stats() -> dict
+ - decode(engine, request) -> str: one request on the calling thread, without a scheduler
+ - stop_pieces(pieces, stopping) -> streamed text cut where a StopCondition ends it
+"""
+from concurrent.futures import Future
+from typing import Dict, Any, List
+from collections import OrderedDict, deque
+import os
+import re
+import math
+import time
+import heapq
+import queue
+import random
+import itertools
+import threading
+import numpy as np
+import torch
+
+LLM_SCHEDULER = os.environ.get('LLM_SCHEDULER', '1') == '1'
+# Sequences decoded together on the Transformers backend
+LLM_MAX_BATCH = int(os.environ.get('LLM_MAX_BATCH', '4'))
+# GGUF model instances (each loads its own copy of the weights and gets a share of the cores)
+LLM_GGUF_WORKERS = int(os.environ.get('LLM_GGUF_WORKERS', '1'))
+# System prompts whose KV cache the Transformers backend keeps (about 4.5MB per 100 tokens for TinyLlama)
+LLM_PREFIX_CACHE_SIZE = int(os.environ.get('LLM_PREFIX_CACHE_SIZE', '16'))
+# Per-feature max_tokens: headroom x the 95th percentile of the last outputs, once there are enough
+LLM_ADAPTIVE_TOKENS = os.environ.get('LLM_ADAPTIVE_TOKENS', '1') == '1'
+LLM_TOKEN_HEADROOM = float(os.environ.get('LLM_TOKEN_HEADROOM', '1.5'))
+LLM_TOKEN_SAMPLES = int(os.environ.get('LLM_TOKEN_SAMPLES', '20'))
+
+# SentencePiece byte-fallback tokens, e.g. <0x0A>
+BYTE_TOKEN = re.compile(r'<0x([0-9A-Fa-f]{2})>')
+# Stands in for a token holding part of a multi-byte character (only valid inside JSON strings)
+NON_ASCII = '\x80'
+
+# Lower runs first; interactive features preempt bulk ones
+FEATURE_PRIORITY = {
+    'chat': 0,
+    'notes': 0,
+    'summary': 1,
+    'tips': 1,
+    'plan': 1,
+    'quiz': 2,
+}
+DEFAULT_PRIORITY = 1
+
+_SEQ = itertools.count()
+
+
+def system_prefix(prompt: str) -> str:
+    """The fixed part of a ChatML prompt: the <|system|> block up to the user turn ('' if none)."""
+    if not prompt.startswith('<|system|>'):
+        return ''
+    end = prompt.find('<|user|>')
+    return prompt[:end + len('<|user|>\n')] if end > 0 else ''
+
+
+def held_tail(text: str, markers) -> int:
+    """Length of the longest end of text that could be the start of a marker.
+
+    Streaming holds those characters back until the next piece shows whether
+    the marker really follows.
+    """
+    return max((k for m in markers for k in range(min(len(m) - 1, len(text)), 0, -1) if text.endswith(m[:k])), default=0)
+
+
+class StopCondition:
+    """Where a reply is over, checked on the decoded text as it grows.
+
+    stop: strings that end it and are cut off (paragraph breaks, role markers)
+    end: a regex whose first match ends it and is kept (a final line, a verdict)
+    """
+
+    def __init__(self, stop=(), end: str = None):
+        self.stop = tuple(stop)
+        self.end = re.compile(end) if end else None
+
+    def cut(self, text: str):
+        """Length of text that belongs to the reply, or None while it goes on."""
+        # Leading whitespace is not a paragraph break
+        start = len(text) - len(text.lstrip())
+        cuts = [text.find(s, start) for s in self.stop if s in text[start:]]
+        match = self.end.search(text) if self.end else None
+        if match:
+            cuts.append(match.end())
+        return min(cuts) if cuts else None
+
+    def apply(self, text: str) -> str:
+        end = self.cut(text)
+        return text if end is None else text[:end]
+
+
+# What each feature's caller would cut from a reply anyway
+FEATURE_STOP = {
+    'chat': StopCondition(stop=("\n\n", "User:", "<|user|>", "Assistant:", "<|assistant|>")),
+    'notes': StopCondition(end=r'NOT_IN_NOTES'),
+    'quiz': StopCondition(end=r'Correct:[^\n]*\S[^\n]*\n'),
+    # NLPTipsGenerator keeps the first five lines long enough to be a tip
+    'tips': StopCondition(end=r'(?:[ \t]*\S[^\n]{14,}\n(?:[ \t]*\n)*){5}'),
+}
+
+
+def stop_pieces(pieces, stopping: StopCondition):
+    """Pass streamed text through until stopping ends it, then close the stream."""
+    text, sent = '', 0
+    try:
+        for piece in pieces:
+            text += piece
+            end = stopping.cut(text)
+            if end is not None:
+                if end > sent:
+                    yield text[sent:end]
+                return
+            safe = len(text) - held_tail(text, stopping.stop)
+            if safe > sent:
+                yield text[sent:safe]
+                sent = safe
+        if len(text) > sent:
+            yield text[sent:]
+    finally:
+        if hasattr(pieces, 'close'):
+            pieces.close()
+
+
+class TokenBudget:
+    """max_tokens per feature from the lengths of its recent outputs.
+
+    Truncated outputs count at their cap, so a budget that is too tight shows up
+    in the percentile and grows back (never past what the caller asked for).
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = LLM_TOKEN_SAMPLES, headroom: float = LLM_TOKEN_HEADROOM, floor: int = 16):
+        self.window = window
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.floor = floor
+        self._lengths = {}  # feature -> deque of output token counts
+        self._lock = threading.Lock()
+
+    def observe(self, feature: str, tokens: int):
+        with self._lock:
+            self._lengths.setdefault(feature, deque(maxlen=self.window)).append(tokens)
+
+    def _p95(self, feature: str):
+        lengths = sorted(self._lengths.get(feature, ()))
+        return lengths[int(0.95 * (len(lengths) - 1))] if len(lengths) >= self.min_samples else None
+
+    def limit(self, feature: str, max_tokens: int) -> int:
+        with self._lock:
+            p95 = self._p95(feature)
+        if p95 is None:
+            return max_tokens
+        return min(max_tokens, max(self.floor, math.ceil(p95 * self.headroom)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {f: {'samples': len(lengths), 'p95_tokens': self._p95(f)} for f, lengths in self._lengths.items()}
+
+
+class GenerationRequest:
+    def __init__(self, prompt: str, max_tokens: int, feature: str = None, constraint=None):
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.constraint = constraint  # JSONConstraint or None
+        self.grammar = constraint.start() if constraint else None  # its state after the output so far
+        self.feature = feature or 'default'
+        # A constrained reply ends when its JSON closes
+        self.stopping = None if constraint else FEATURE_STOP.get(self.feature)
+        self.priority = FEATURE_PRIORITY.get(feature, DEFAULT_PRIORITY)
+        self.seq = next(_SEQ)
+        self.output = []   # token ids generated so far; kept when the request is preempted
+        self.text = ''     # text handed to the caller so far
+        self.visible = ''  # decoded output, cut at any stop string
+        self.pieces = queue.Queue()  # streamed text, then None
+        self.done = Future()
+        self.cancelled = False
+        self.submitted = time.time()
+        self.started = None
+
+    @property
+    def key(self):
+        return (self.priority, self.seq)
+
+    def emit(self, text: str):
+        if text:
+            self.text += text
+            self.pieces.put(text)
+
+    def finish(self, result: str):
+        if result.startswith(self.text):
+            self.emit(result[len(self.text):])
+        self.pieces.put(None)
+        if not self.done.done():
+            self.done.set_result(result)
+
+    def fail(self, error: Exception):
+        self.pieces.put(None)
+        if not self.done.done():
+            self.done.set_exception(error)
+
+
+class _Sequence:
+    """A running request plus the engine's decoding state for it."""
+    __slots__ = ('request', 'kv', 'logits')
+
+    def __init__(self, request: GenerationRequest, kv=None, logits=None):
+        self.request = request
+        self.kv = kv
+        self.logits = logits
+
+
+class _Engine:
+    stop = ()
+    strip_output = False
+    temperature = 1.0
+    top_k = 50
+    top_p = 1.0
+    _texts = None
+
+    def token_texts(self) -> List[str]:
+        """Text of every token id, for constrained decoding (None for tokens never allowed)."""
+        raise NotImplementedError
+
+    def _fitting(self, request: GenerationRequest, tokens, first: bool = False):
+        """[(token, grammar state)] for the tokens whose text can follow the output so far."""
+        if self._texts is None:
+            self._texts = self.token_texts()
+        allowed = []
+        for token in tokens:
+            # The model's output layer may be padded past the tokenizer's vocabulary
+            text = self._texts[token] if token < len(self._texts) else None
+            state = request.constraint.feed(request.grammar, text) if text else None
+            if state is not None:
+                allowed.append((token, state))
+                if first:
+                    break
+        return allowed
+
+    def _constrained(self, request: GenerationRequest, top, score):
+        """Sample a token that keeps the output within request.constraint: (token, grammar state), or None.
+
+        top(k) gives the k best token ids (all of them for k=None), score(token) its logit.
+        Sampling is over the top_k that fit; when none of them does, the best token that fits is taken.
+        """
+        allowed = self._fitting(request, top(self.top_k)) or self._fitting(request, top(None), first=True)
+        if not allowed:
+            return None
+        best = score(allowed[0][0])
+        weights = [math.exp((score(token) - best) / self.temperature) for token, _ in allowed]
+        if self.top_p < 1.0:
+            # Smallest set of the most likely tokens holding top_p of the mass
+            total, kept, mass = sum(weights), 0, 0.0
+            for w in weights:
+                kept += 1
+                mass += w
+                if mass >= self.top_p * total:
+                    break
+            allowed, weights = allowed[:kept], weights[:kept]
+        return random.choices(allowed, weights)[0]
+
+    def _advance(self, seq: _Sequence, text: str) -> bool:
+        """Hand newly decoded text to the request. True once the reply is over (a stop string or its StopCondition)."""
+        if text.endswith('\ufffd'):
+            # Incomplete multi-byte character; wait for the next token
+            return False
+        request = seq.request
+        # Stop strings could be legitimate text inside constrained JSON
+        stop = () if request.constraint else self.stop
+        cuts = [text.find(s) for s in stop if s in text]
+        if request.stopping:
+            end = request.stopping.cut(text)
+            if end is not None:
+                cuts.append(end)
+            stop += request.stopping.stop
+        if cuts:
+            text = text[:min(cuts)]
+        request.visible = text
+        safe = len(text) if cuts else len(text) - held_tail(text, stop)
+        if safe > len(request.text) and text.startswith(request.text):
+            request.emit(text[len(request.text):safe])
+        return bool(cuts)
+
+    def result(self, seq: _Sequence) -> str:
+        visible = seq.request.visible
+        return visible.strip() if self.strip_output else visible
+
+    @staticmethod
+    def _closed(request: GenerationRequest) -> bool:
+        """True once a constrained request's root JSON value is complete."""
+        return bool(request.constraint) and request.constraint.complete(request.grammar)
+
+    def release(self, seq: _Sequence):
+        seq.kv = seq.logits = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class TransformersEngine(_Engine):
+    """Continuous batching on a Hugging Face causal LM.
+
+    Each sequence keeps its own KV cache; a decode step left-pads the caches to
+    the longest one and runs the whole batch through the model once. Sampling
+    matches HFTransformersProvider (temperature 0.3, top-k 50).
+
+    The KV cache of each system prompt (see system_prefix) is computed once and
+    kept in an LRU, so prefill only runs over the user turn and context.
+    """
+    strip_output = True
+
+    def __init__(self, model, tokenizer, temperature: float = 0.3, top_k: int = 50, prefix_cache_size: int = LLM_PREFIX_CACHE_SIZE):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.temperature = temperature
+        self.top_k = top_k
+        self.eos_token_id = tokenizer.eos_token_id
+        self.prefix_cache_size = prefix_cache_size
+        self._prefixes = OrderedDict()  # prefix token ids -> KV cache for them
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+
+    @staticmethod
+    def _legacy(kv):
+        # Newer transformers return Cache objects; we slice and pad the tuple form
+        return kv.to_legacy_cache() if hasattr(kv, 'to_legacy_cache') else kv
+
+    def _prefix_kv(self, prompt: str, ids):
+        """(cached KV, its length) for the prompt's system block, computing it on first use; (None, 0) if it has none."""
+        prefix = system_prefix(prompt)
+        if not prefix or not self.prefix_cache_size:
+            return None, 0
+        prefix_ids = self.tokenizer(prefix, return_tensors='pt').input_ids
+        n = prefix_ids.shape[1]
+        # Only when the full prompt tokenizes to the same ids there; keep a token to prefill
+        if n >= ids.shape[1] or not torch.equal(ids[0, :n], prefix_ids[0]):
+            return None, 0
+        key = tuple(prefix_ids[0].tolist())
+        kv = self._prefixes.get(key)
+        if kv is not None:
+            self._prefixes.move_to_end(key)
+            self.prefix_hits += 1
+            self.reused_tokens += n
+            return kv, n
+        self.prefix_misses += 1
+        with torch.inference_mode():
+            kv = self._legacy(self.model(input_ids=prefix_ids, use_cache=True).past_key_values)
+        self._prefixes[key] = kv
+        while len(self._prefixes) > self.prefix_cache_size:
+            self._prefixes.popitem(last=False)
+        self.prefill_tokens += n
+        return kv, n
+
+    def start(self, request: GenerationRequest) -> _Sequence:
+        ids = self.tokenizer(request.prompt, return_tensors='pt').input_ids
+        if request.output:
+            ids = torch.cat([ids, torch.tensor([request.output], dtype=ids.dtype)], dim=1)
+        past, n = self._prefix_kv(request.prompt, ids)
+        with torch.inference_mode():
+            # Forward passes build new cache tensors, so the cached prefix stays intact
+            out = self.model(input_ids=ids[:, n:], past_key_values=past, use_cache=True)
+        self.prefill_tokens += ids.shape[1] - n
+        # clone: a view would keep the logits of every prompt position alive
+        return _Sequence(request, self._legacy(out.past_key_values), out.logits[0, -1].clone())
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.prefix_hits + self.prefix_misses
+        return {
+            'prefix_cache_entries': len(self._prefixes),
+            'prefix_hit_rate': round(self.prefix_hits / lookups, 4) if lookups else 0.0,
+            'prefill_tokens': self.prefill_tokens,
+            'prefix_tokens_reused': self.reused_tokens,
+        }
+
+    def token_texts(self) -> List[str]:
+        pieces = self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer))))
+        special = set(self.tokenizer.all_special_ids)
+        texts = []
+        for token, piece in enumerate(pieces):
+            byte = BYTE_TOKEN.fullmatch(piece or '')
+            if token in special or not piece:
+                texts.append(None)
+            elif byte:
+                value = int(byte.group(1), 16)
+                texts.append(chr(value) if value < 0x80 else NON_ASCII)
+            else:
+                texts.append(piece.replace('\u2581', ' '))
+        return texts
+
+    def _sample(self, seq: _Sequence):
+        """The next token for seq, or None when its constraint allows none."""
+        logits = seq.logits.float()
+        request = seq.request
+        if request.constraint:
+            picked = self._constrained(
+                request,
+                lambda k: (torch.topk(logits, k).indices if k else torch.argsort(logits, descending=True)).tolist(),
+                lambda token: float(logits[token]),
+            )
+            if picked is None:
+                return None
+            token, request.grammar = picked
+            return token
+        values, indices = torch.topk(logits / self.temperature, min(self.top_k, logits.shape[-1]))
+        choice = torch.multinomial(torch.softmax(values, dim=-1), 1)
+        return int(indices[choice])
+
+    def step(self, seqs: List[_Sequence]) -> List[_Sequence]:
+        """Sample one token for every sequence, then run the survivors forward together. Returns the finished ones."""
+        finished, active, tokens = [], [], []
+        for seq in seqs:
+            request = seq.request
+            token = self._sample(seq)
+            if token is None or token == self.eos_token_id:
+                finished.append(seq)
+                continue
+            request.output.append(token)
+            stopped = self._advance(seq, self.tokenizer.decode(request.output, skip_special_tokens=True))
+            if stopped or self._closed(request) or len(request.output) >= request.max_tokens:
+                finished.append(seq)
+                continue
+            active.append(seq)
+            tokens.append(token)
+        if not active:
+            return finished
+
+        lengths = [seq.kv[0][0].shape[2] for seq in active]
+        longest = max(lengths)
+        if len(active) == 1:
+            past = active[0].kv
+        else:
+            pad = torch.nn.functional.pad
+            past = tuple(
+                tuple(torch.cat([pad(layer[n][part], (0, 0, longest - length, 0)) for n, length in enumerate(lengths)])
+                      for part in range(2))
+                for layer in zip(*(seq.kv for seq in active))
+            )
+        mask = torch.zeros((len(active), longest + 1), dtype=torch.long)
+        for n, length in enumerate(lengths):
+            mask[n, longest - length:] = 1
+        with torch.inference_mode():
+            out = self.model(
+                input_ids=torch.tensor(tokens).unsqueeze(1),
+                attention_mask=mask,
+                position_ids=torch.tensor(lengths).unsqueeze(1),
+                past_key_values=past,
+                use_cache=True,
+            )
+        kv = self._legacy(out.past_key_values)
+        for n, (seq, length) in enumerate(zip(active, lengths)):
+            # Drop this sequence's left padding again
+            seq.kv = tuple(tuple(t[n:n + 1, :, longest - length:, :] for t in layer) for layer in kv)
+            seq.logits = out.logits[n, -1]
+        return finished
+
+
+class GGUFEngine(_Engine):
+    """One ctransformers model decoding one sequence at a time, token by token.
+
+    Sampling and stop strings match CTransformersProvider.
+
+    The model's context is rewound to the prefix it shares with the next prompt
+    rather than cleared, so a system prompt evaluated for the previous request
+    is not evaluated again.
+    """
+
+    top_k = 40  # ctransformers' default
+
+    def __init__(self, llm, temperature: float = 0.3, top_p: float = 0.9, stop=("</s>", "<|user|>", "User:")):
+        self.llm = llm
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = tuple(stop)
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+
+    def start(self, request: GenerationRequest) -> _Sequence:
+        tokens = self.llm.tokenize(request.prompt) + request.output
+        prepare = getattr(self.llm, 'prepare_inputs_for_generation', None)
+        if prepare is None:
+            # ctransformers < 0.2.27 cannot rewind its context
+            self.llm.reset()
+            todo = tokens
+        else:
+            todo = prepare(tokens, reset=True)
+        self.reused_tokens += len(tokens) - len(todo)
+        self.prefill_tokens += len(todo)
+        self.llm.eval(todo)
+        return _Sequence(request)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'prefill_tokens': self.prefill_tokens, 'prefix_tokens_reused': self.reused_tokens}
+
+    def token_texts(self) -> List[str]:
+        texts = []
+        for token in range(self.llm.vocab_size):
+            if self.llm.is_eos_token(token) or token == self.llm.bos_token_id:
+                texts.append(None)
+                continue
+            try:
+                texts.append(self.llm.detokenize([token], decode=False).decode('utf-8') or None)
+            except UnicodeDecodeError:
+                texts.append(NON_ASCII)
+        return texts
+
+    def _sample(self, request: GenerationRequest):
+        """The next token, or None when the request's constraint allows none."""
+        if not request.constraint:
+            return self.llm.sample(temperature=self.temperature, top_p=self.top_p)
+        # ctransformers samples internally; constrained requests sample from its logits here
+        logits = np.fromiter(self.llm.logits, dtype=np.float32)
+
+        def top(k):
+            if k is None or k >= len(logits):
+                return np.argsort(-logits).tolist()
+            best = np.argpartition(-logits, k)[:k]
+            return best[np.argsort(-logits[best])].tolist()
+
+        picked = self._constrained(request, top, lambda token: float(logits[token]))
+        if picked is None:
+            return None
+        token, request.grammar = picked
+        return token
+
+    def step(self, seqs: List[_Sequence]) -> List[_Sequence]:
+        finished = []
+        for seq in seqs:
+            request = seq.request
+            token = self._sample(request)
+            if token is None or self.llm.is_eos_token(token):
+                finished.append(seq)
+                continue
+            request.output.append(token)
+            text = self.llm.detokenize(request.output, decode=False).decode('utf-8', errors='replace')
+            if self._advance(seq, text) or self._closed(request) or len(request.output) >= request.max_tokens:
+                finished.append(seq)
+                continue
+            self.llm.eval([token])
+        return finished
+
+
+class LLMScheduler:
+    def __init__(self, engines: List[_Engine], max_batch: int = 1):
+        self.engines = engines
+        self.max_batch = max_batch
+        self._queue = []  # heap of (request.key, request)
+        self._cond = threading.Condition()
+        self._idle = 0
+        self._running = {}  # worker -> sequences in flight
+        self.completed = 0
+        self.preemptions = 0
+        self.steps = 0
+        self.step_sequences = 0
+        self._waits = {}  # feature -> [requests, total wait ms]
+        self.budget = TokenBudget() if LLM_ADAPTIVE_TOKENS else None
+        for n, engine in enumerate(engines):
+            threading.Thread(target=self._run, args=(engine,), name=f'llm-scheduler-{n}', daemon=True).start()
+
+    def submit(self, prompt: str, max_tokens: int = 200, feature: str = None, constraint=None) -> GenerationRequest:
+        # Constrained output must be allowed to reach its closing brace
+        if self.budget and constraint is None:
+            max_tokens = self.budget.limit(feature or 'default', max_tokens)
+        request = GenerationRequest(prompt, max_tokens, feature, constraint)
+        self._push(request)
+        return request
+
+    def _push(self, request: GenerationRequest):
+        with self._cond:
+            heapq.heappush(self._queue, (request.key, request))
+            self._cond.notify()
+
+    def generate(self, prompt: str, max_tokens: int = 200, feature: str = None, constraint=None) -> str:
+        return self.submit(prompt, max_tokens, feature, constraint).done.result()
+
+    def stream(self, prompt: str, max_tokens: int = 200, feature: str = None):
+        request = self.submit(prompt, max_tokens, feature)
+        try:
+            while True:
+                piece = request.pieces.get()
+                if piece is None:
+                    break
+                yield piece
+            request.done.result()  # re-raise a generation error
+        finally:
+            # The caller stopped reading: free the slot at the next step
+            request.cancelled = True
+
+    def _next_batch(self, running: List[_Sequence]):
+        """Requests to start on this worker, and the running sequence they preempt (or None)."""
+        with self._cond:
+            while not running and not self._queue:
+                self._idle += 1
+                self._cond.wait()
+                self._idle -= 1
+            admitted = []
+            while self._queue and len(running) + len(admitted) < self.max_batch:
+                admitted.append(heapq.heappop(self._queue)[1])
+            victim = None
+            if self._queue and not admitted and not self._idle:
+                worst = max(running, key=lambda seq: seq.request.key)
+                if self._queue[0][1].priority < worst.request.priority:
+                    victim = worst
+                    admitted.append(heapq.heappop(self._queue)[1])
+            return admitted, victim
+
+    def _run(self, engine: _Engine):
+        running = []
+        while True:
+            admitted, victim = self._next_batch(running)
+            if victim is not None:
+                running.remove(victim)
+                engine.release(victim)
+                self.preemptions += 1
+                print(f"[LLM] Preempted {victim.request.feature} request for {admitted[-1].feature} "
+                      f"({len(victim.request.output)} tokens kept)")
+                self._push(victim.request)
+            for request in admitted:
+                if request.cancelled:
+                    request.finish(request.text)
+                    continue
+                if request.started is None:
+                    request.started = time.time()
+                    wait = self._waits.setdefault(request.feature, [0, 0.0])
+                    wait[0] += 1
+                    wait[1] += (request.started - request.submitted) * 1000
+                try:
+                    running.append(engine.start(request))
+                except Exception as e:
+                    request.fail(e)
+            self._running[id(engine)] = len(running)
+            if not running:
+                continue
+
+            try:
+                finished = engine.step(running)
+            except Exception as e:
+                print(f"[LLM] Generation failed: {e}")
+                for seq in running:
+                    engine.release(seq)
+                    seq.request.fail(e)
+                running = []
+                continue
+            self.steps += 1
+            self.step_sequences += len(running)
+            for seq in running[:]:
+                if seq in finished or seq.request.cancelled:
+                    running.remove(seq)
+                    if self.budget and not seq.request.cancelled and not seq.request.constraint:
+                        self.budget.observe(seq.request.feature, len(seq.request.output))
+                    seq.request.finish(engine.result(seq))
+                    engine.release(seq)
+                    self.completed += 1
+            self._running[id(engine)] = len(running)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'workers': len(self.engines),
+            'max_batch': self.max_batch,
+            'queued': len(self._queue),
+            'running': sum(self._running.values()),
+            'completed': self.completed,
+            'preemptions': self.preemptions,
+            'mean_batch': round(self.step_sequences / self.steps, 2) if self.steps else 0.0,
+            'mean_wait_ms': {f: round(total / n, 1) for f, (n, total) in self._waits.items()},
+            'engines': [engine.stats() for engine in self.engines],
+            'token_budgets': self.budget.stats() if self.budget else None,
+        }
+
+
+def decode(engine: _Engine, request: GenerationRequest) -> str:
+    """Run one request to completion on the calling thread (the providers' path without a scheduler)."""
+    seq = engine.start(request)
+    try:
+        while not engine.step([seq]):
+            pass
+        return engine.result(seq)
+    finally:
+        engine.release(seq)
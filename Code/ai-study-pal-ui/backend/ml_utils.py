@@ -14,7 +14,12 @@ from sklearn.cluster import KMeans
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score
 from embeddings import get_embeddings_instance
-from llm_providers import get_provider
+from vector_store import TenantIndexes, FAISS_AVAILABLE, content_hash
+from reranker import get_reranker, RERANK_CANDIDATES
+from llm_providers import get_provider, get_tokenizer, CONTEXT_TOKENS
+from llm_scheduler import held_tail, FEATURE_STOP
+from response_cache import get_response_cache, cached_generate
+from json_grammar import JSONConstraint
 import data_manager
 import file_processor
 import metadata_manager
@@ -22,10 +27,7 @@ import supabase_client as supabase
 
 # --- LangChain Imports ---
 try:
-    from langchain_huggingface import HuggingFaceEmbeddings
-    from langchain_community.vectorstores import FAISS
     from langchain_text_splitters import RecursiveCharacterTextSplitter
-    from langchain_core.documents import Document
     LANGCHAIN_AVAILABLE = True
 except ImportError as e:
     LANGCHAIN_AVAILABLE = False
@@ -92,124 +94,348 @@ class QuizGenerator:
 
 # --- LangChain RAG System ---
 
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+RAG_INDEX_DIR = os.path.join(BACKEND_DIR, 'data', 'rag')
+
+# Chunk sizes and the prompt budget are counted in TinyLlama tokens
+RAG_CHUNK_TOKENS = int(os.environ.get('RAG_CHUNK_TOKENS', '200'))
+RAG_CHUNK_OVERLAP_TOKENS = int(os.environ.get('RAG_CHUNK_OVERLAP_TOKENS', '25'))
+RAG_ANSWER_TOKENS = 200
+# Context cap in tokens; 0 fills whatever the window leaves after the prompt and answer
+RAG_CONTEXT_TOKENS = int(os.environ.get('RAG_CONTEXT_TOKENS', '0'))
+RAG_CONTEXT_MAX_CHUNKS = int(os.environ.get('RAG_CONTEXT_MAX_CHUNKS', '2'))
+
 class RAGSystem:
-    def __init__(self, emb_model_name: str = 'all-MiniLM-L6-v2'):
-        if not LANGCHAIN_AVAILABLE:
-            self.vectorstore = None
+    def __init__(self, emb_model_name: str = 'all-MiniLM-L6-v2', index_dir: str = RAG_INDEX_DIR):
+        self.index_dir = index_dir
+        self.tokenizer = None
+        self.tenants = None  # TenantIndexes: one NoteIndex (per-bucket shards + manifest) per user
+        self.is_indexed = False
+
+        if not LANGCHAIN_AVAILABLE or not FAISS_AVAILABLE:
             return
 
         try:
             # Initialize Embeddings
-            self.embeddings = HuggingFaceEmbeddings(model_name=emb_model_name)
-            self.text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=800,
-                chunk_overlap=100,
-                length_function=len
-            )
-            self.vectorstore = None 
-            self.is_indexed = False
+            self.embeddings = get_embeddings_instance(emb_model_name)
+            try:
+                # Chunk in LLM tokens so chunk sizes line up with the prompt budget
+                self.tokenizer = get_tokenizer()
+                self.text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                    self.tokenizer,
+                    chunk_size=RAG_CHUNK_TOKENS,
+                    chunk_overlap=RAG_CHUNK_OVERLAP_TOKENS
+                )
+            except Exception as e:
+                print(f"[RAG] LLM tokenizer unavailable ({e}); chunking by characters.")
+                self.tokenizer = None
+                self.text_splitter = RecursiveCharacterTextSplitter(
+                    chunk_size=800,
+                    chunk_overlap=100,
+                    length_function=len
+                )
+            # User indexes are memory-mapped from disk on first use, not at startup
+            self.tenants = TenantIndexes(index_dir, dim=self.embeddings.dimension())
+            with self.tenants.use(None) as index:
+                self.is_indexed = index.ntotal > 0
         except Exception as e:
             print(f"Failed to init LangChain RAG: {e}")
-            self.vectorstore = None
+            self.tenants = None
 
-    def add_document(self, text: str, subject: str = "Uncategorized", original_filename: str = "Uploaded File"):
-        if not LANGCHAIN_AVAILABLE: return 0
-        
-        # Split Text
-        texts = self.text_splitter.split_text(text)
-        metadatas = [{"bucket": subject, "filename": original_filename} for _ in texts]
-        
-        # Create or Update Vector Store
-        if self.vectorstore is None:
-            self.vectorstore = FAISS.from_texts(texts, self.embeddings, metadatas=metadatas)
-        else:
-            self.vectorstore.add_texts(texts, metadatas=metadatas)
-             
-        self.is_indexed = True
-        return len(texts)
+    @property
+    def notes_index(self):
+        """The shared (no user) NoteIndex."""
+        if not self.tenants: return None
+        with self.tenants.use(None) as index:
+            return index
 
-    def query(self, query_text: str, subject_filter: str = None, llm_module=None, top_k: int = 3):
-        if not LANGCHAIN_AVAILABLE or not self.vectorstore:
-            return "RAG System Unavailable (LangChain missing or empty).", []
-        
-        # 1. Config Filters
-        search_kwargs = {"k": 5} # Fetch more initially for filtering
-        if subject_filter and subject_filter != 'All Notes':
-             search_kwargs["filter"] = {"bucket": subject_filter}
+    @property
+    def vectorstore(self):
+        """The shared NoteIndex, or None while nothing is indexed."""
+        return self.notes_index if self.is_indexed else None
 
-        # 2. Retrieve Documents with Scores
-        print(f"[RAG] Query: {query_text} | Filter: {search_kwargs}")
-        
-        # Use relevance scores (0-1) where possible. 
-        # Note: FAISS relevance scores + HuggingFace typically normalize L2 or Cosine.
-        # Threshold: 0.7 (Recommended)
-        docs_and_scores = self.vectorstore.similarity_search_with_relevance_scores(query_text, **search_kwargs)
+    @property
+    def manifest(self):
+        return self.notes_index.manifest if self.tenants else {}
+
+    def indexed_document(self, doc_id, user_id=None):
+        """The manifest entry (hash, bucket, filename, chunks) for doc_id in the user's index, or None."""
+        if not self.tenants: return None
+        with self.tenants.use(user_id) as index:
+            return index.manifest.get(str(doc_id))
+
+    def is_current(self, doc_id, text: str, user_id=None) -> bool:
+        if not self.tenants: return False
+        with self.tenants.use(user_id) as index:
+            return index.is_current(str(doc_id), text)
+
+    def add_document(self, text: str, subject: str = "Uncategorized", original_filename: str = "Uploaded File", doc_id=None, user_id=None,
+                     split=None, embed_fn=None):
+        """Upsert a document by identity (note id, or bucket + filename) in the user's index.
+
+        Chunks that went stale are removed, unchanged chunks are kept as-is and only
+        new chunk text is embedded. Returns the number of chunks embedded. The ingest
+        pipeline passes its own `split` (from _split) and `embed_fn` (precomputed vectors).
+        """
+        if not LANGCHAIN_AVAILABLE or not self.tenants: return 0
+
+        doc_id = str(doc_id) if doc_id is not None else f"{subject}/{original_filename}"
+        with self.tenants.use(user_id) as index:
+            entry = index.manifest.get(doc_id)
+            if index.is_current(doc_id, text) and entry.get('bucket') == subject and entry.get('filename') == original_filename:
+                return 0
+
+            chunks, offsets = split or self._split(text)
+            count = index.upsert(doc_id, text, chunks, subject, original_filename, embed_fn or self.embeddings.embed_documents,
+                                 chunk_fields=offsets)
+            if not user_id:
+                self.is_indexed = index.ntotal > 0
+        self._invalidate_answers(doc_id, user_id)
+        return count
+
+    def indexed_chunks(self, doc_id, user_id=None) -> set:
+        """Hashes of the chunks currently indexed for doc_id."""
+        if not self.tenants: return set()
+        with self.tenants.use(user_id) as index:
+            return set(index.chunk_ids(str(doc_id))[0])
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return len(text.split()) * 4 // 3  # rough words -> tokens
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def _truncate_tokens(self, text: str, n: int) -> str:
+        if self.tokenizer is None:
+            return " ".join(text.split()[:n * 3 // 4])
+        return self.tokenizer.decode(self.tokenizer.encode(text, add_special_tokens=False)[:n])
+
+    def _split(self, text: str):
+        """Split text into ({chunk_hash: chunk}, {chunk_hash: {"start", "end", "tokens"}}), one entry per distinct chunk.
+
+        Offsets are character positions of the chunk's first occurrence in text;
+        tokens is the chunk's LLM token count, stored so queries need not re-tokenize.
+        """
+        chunks, offsets = {}, {}
+        cursor = 0
+        for t in self.text_splitter.split_text(text):
+            # Chunks come back in order (overlapping), so search forward from the previous one
+            start = text.find(t, cursor)
+            if start < 0:
+                start = text.find(t)
+            h = content_hash(t)
+            if h not in chunks:
+                chunks[h] = t
+                offsets[h] = {"tokens": self.count_tokens(t)}
+                if start >= 0:
+                    offsets[h].update(start=start, end=start + len(t))
+            if start >= 0:
+                cursor = start + 1
+        return chunks, offsets
+
+    def delete_document(self, doc_id, user_id=None) -> int:
+        """Remove every chunk of a document from the user's index. Returns the number of chunks removed."""
+        if not self.tenants: return 0
+        with self.tenants.use(user_id) as index:
+            removed = index.delete(str(doc_id))
+            if not user_id:
+                self.is_indexed = index.ntotal > 0
+        self._invalidate_answers(doc_id, user_id)
+        return removed
+
+    @staticmethod
+    def _invalidate_answers(doc_id, user_id=None):
+        # Cached notes answers built on the old chunks
+        cache = get_response_cache()
+        if cache:
+            cache.invalidate_document(doc_id, user_id)
+
+    def index_report(self, user_id=None, benchmark: bool = False):
+        """Per-bucket index type/size, plus recall-vs-latency rows when benchmark is set."""
+        if not self.tenants: return {}
+        with self.tenants.use(user_id) as index:
+            return {
+                "buckets": index.index_report(benchmark=benchmark),
+                "tenants": self.tenants.stats(),
+                "query_cache": self.embeddings.query_cache.stats(),
+                "embedding_cache": self.embeddings.document_cache.stats() if self.embeddings.document_cache else None,
+                "embedding_batcher": self.embeddings.batcher.stats() if self.embeddings.batcher else None,
+                "reranker": get_reranker().stats() if get_reranker() else None,
+            }
+
+    def _search(self, query_text: str, subject_filter: str = None, k: int = 5, user_id=None):
+        """Embed the question and search the user's index. None if nothing is indexed."""
+        # A named bucket searches only its own shard, "All Notes" merges all
+        bucket = subject_filter if subject_filter and subject_filter != 'All Notes' else None
+        print(f"[RAG] Query: {query_text} | Shard: {bucket or 'all'} | k={k}")
+
+        # Scores are cosine similarities (normalized inner product) in [-1, 1].
+        with self.tenants.use(user_id) as index:
+            if not index.manifest:
+                return None
+            q_emb = self.embeddings.embed_query(query_text)
+            return index.search(q_emb, bucket=bucket, top_k=k, query_text=query_text)
+
+    def retrieve(self, query_text: str, subject_filter: str = None, top_k: int = 5, user_id=None):
+        """Top-k chunks for a question without calling the LLM (evidence highlighting).
+
+        Returns [{"text", "source", "score", "meta": {"doc_id", "bucket", "start", "end"}}];
+        start/end are character offsets into the note, None for chunks indexed before
+        offsets were recorded.
+        """
+        if not LANGCHAIN_AVAILABLE or not self.tenants:
+            return []
+        hits = self._search(query_text, subject_filter, k=top_k, user_id=user_id) or []
+        return [{
+            "text": h['metadata'].get('text', ''),
+            "source": h['metadata'].get('filename', 'Unknown'),
+            "score": h['score'],
+            "meta": {
+                "doc_id": h['metadata'].get('doc_id'),
+                "bucket": h['metadata'].get('bucket'),
+                "start": h['metadata'].get('start'),
+                "end": h['metadata'].get('end'),
+            },
+        } for h in hits]
+
+    @staticmethod
+    def _prompt(context_text: str, query_text: str) -> str:
+        # Tuned Prompt: Strict Answer Scope with ChatML
+        # Removed "Answer:" suffix as it's handled by LLM provider templates usually
+        return (
+            "<|system|>\n"
+            "You are an AI Study Pal. Answer the question based ONLY on the provided context.\n"
+            "If the context is missing or irrelevant, say 'NOT_IN_NOTES'.\n"
+            "Do NOT start your response with 'Question:'. Direct answer only.\n"
+            "</s>\n"
+            "<|user|>\n"
+            f"Context:\n{context_text}\n\n"
+            f"Question: {query_text}\n"
+            "</s>\n"
+            "<|assistant|>\n"
+        )
+
+    def _pack_context(self, query_text: str, docs):
+        """Fill the prompt's token budget with chunks in rank order. Returns (docs used, context text, tokens).
+
+        Uses each chunk's stored token count; only a chunk cut to fit the remaining
+        budget (or one indexed before counts were stored) is tokenized here.
+        """
+        budget = CONTEXT_TOKENS - RAG_ANSWER_TOKENS - self.count_tokens(self._prompt("", query_text))
+        if RAG_CONTEXT_TOKENS:
+            budget = min(budget, RAG_CONTEXT_TOKENS)
+        separator = self.count_tokens("\n\n")
+        used, parts, packed = 0, [], []
+        for doc in docs:
+            gap = separator if parts else 0
+            remaining = budget - used - gap
+            if remaining <= 0:
+                break
+            n = doc.get('tokens') or self.count_tokens(doc['text'])
+            packed.append(doc)
+            if n <= remaining:
+                parts.append(doc['text'])
+                used += gap + n
+            else:
+                parts.append(self._truncate_tokens(doc['text'], remaining))
+                used = budget
+                break
+        return packed, "\n\n".join(parts), used
+
+    def _answer_prompt(self, query_text: str, subject_filter: str = None, user_id=None):
+        """Steps 1-6 of query(): (prompt, docs in the context), or (final answer, None) when there is nothing to ask."""
+        if not LANGCHAIN_AVAILABLE or not self.tenants:
+            return "RAG System Unavailable (LangChain missing or empty).", None
         
-        # DEBUG: Bucket Filtering Check
-        # print(f"[RAG-DEBUG] Active bucket: {subject_filter}")
-        # print(f"[RAG-DEBUG] Applied filter: {search_kwargs.get('filter')}")
-        # print(f"[RAG-DEBUG] Retrieved metadata: {[d.metadata for d, _ in docs_and_scores]}")
+        # 1-2. Pick Shards & Retrieve Documents with Scores (a wider net when re-ranking)
+        reranker = get_reranker()
+        hits = self._search(query_text, subject_filter, k=RERANK_CANDIDATES if reranker else 5, user_id=user_id)
+        if hits is None:
+            return "RAG System Unavailable (LangChain missing or empty).", None
+        docs_and_scores = [(h['metadata'], h['score']) for h in hits]
         
         # 3. Strict Relevance Filtering
         SCORE_THRESHOLD = 0.0 # lowered to 0.0 to unblock retrieval; scores were negative
         filtered_docs = []
         for doc, score in docs_and_scores:
-            print(f"[RAG] Doc: {doc.metadata.get('filename')} | Score: {score:.3f}")
+            print(f"[RAG] Doc: {doc.get('filename')} | Score: {score:.3f}")
             if score >= SCORE_THRESHOLD:
                 filtered_docs.append((doc, score))
         
         # 4. Sorting & Truncation
-        # Sort by score desc
-        filtered_docs.sort(key=lambda x: x[1], reverse=True)
-        # Top 2 Chunks Only
-        filtered_docs = filtered_docs[:2]
+        # Hits arrive best-first: by score, or by fused dense + keyword rank in hybrid mode
+        if reranker and len(filtered_docs) > 1:
+            # Cross-encoder relevance decides which chunks reach the LLM
+            order = reranker.rerank(query_text, [d['text'] for d, _ in filtered_docs])
+            filtered_docs = [filtered_docs[n] for n, _ in order]
+        # Top 2 Chunks Only (RAG_CONTEXT_MAX_CHUNKS)
+        filtered_docs = filtered_docs[:RAG_CONTEXT_MAX_CHUNKS]
         
         # 5. Strict Failure Handling (Empty Context)
         if not filtered_docs:
             print("[RAG] No docs met threshold -> NOT_IN_NOTES")
-            return "NOT_IN_NOTES", []
-
-        # 6. Context Construction (Word Limit)
-        final_docs = [d[0] for d in filtered_docs]
-        raw_context = "\n\n".join([d.page_content for d in final_docs])
-        # Truncate to ~350 words
-        context_words = raw_context.split()
-        if len(context_words) > 350:
-            context_text = " ".join(context_words[:350]) + "..."
-        else:
-            context_text = raw_context
-            
-        print(f"[RAG] Final Context ({len(filtered_docs)} chunks, {len(context_text.split())} words): {context_text[:200]}...")
+            return "NOT_IN_NOTES", None
 
-        if llm_module:
-            # Tuned Prompt: Strict Answer Scope
-            # Removed "Answer:" suffix as it's handled by LLM provider templates usually
-            # Tuned Prompt: Strict Answer Scope with ChatML
-            prompt = (
-                "<|system|>\n"
-                "You are an AI Study Pal. Answer the question based ONLY on the provided context.\n"
-                "If the context is missing or irrelevant, say 'NOT_IN_NOTES'.\n"
-                "Do NOT start your response with 'Question:'. Direct answer only.\n"
-                "</s>\n"
-                "<|user|>\n"
-                f"Context:\n{context_text}\n\n"
-                f"Question: {query_text}\n"
-                "</s>\n"
-                "<|assistant|>\n"
-            )
+        # 6. Context Construction (Token Budget: TinyLlama window minus prompt and answer)
+        final_docs, context_text, context_tokens = self._pack_context(query_text, [d[0] for d in filtered_docs])
 
-            # Use existing provider
-            answer = llm_module.generate(prompt, max_tokens=200)
-        else:
-            answer = "LLM Provider Unavailable."
+        print(f"[RAG] Final Context ({len(final_docs)} chunks, {context_tokens} tokens): {context_text[:200]}...")
+        return self._prompt(context_text, query_text), final_docs
 
+    @staticmethod
+    def _verify(answer: str, final_docs):
         # 7. Verify Output
         if "NOT_IN_NOTES" in answer:
              return "NOT_IN_NOTES", []
 
-        sources = list(set([d.metadata.get('filename', 'Unknown') for d in final_docs]))
+        sources = list(set([d.get('filename', 'Unknown') for d in final_docs]))
         return answer, sources
 
+    @staticmethod
+    def _doc_ids(final_docs):
+        return {d['doc_id'] for d in final_docs if d.get('doc_id')}
+
+    def query(self, query_text: str, subject_filter: str = None, llm_module=None, top_k: int = 3, user_id=None):
+        prompt, final_docs = self._answer_prompt(query_text, subject_filter, user_id)
+        if final_docs is None:
+            return prompt, []
+
+        if llm_module:
+            # Use existing provider
+            answer = cached_generate(llm_module, prompt, RAG_ANSWER_TOKENS, 'notes', docs=self._doc_ids(final_docs), user_id=user_id)
+        else:
+            answer = "LLM Provider Unavailable."
+
+        return self._verify(answer, final_docs)
+
+    def query_stream(self, query_text: str, subject_filter: str = None, llm_module=None, user_id=None):
+        """query() while the answer is generated: yields ("token", text) pieces, then ("done", (answer, sources))."""
+        prompt, final_docs = self._answer_prompt(query_text, subject_filter, user_id)
+        if final_docs is None:
+            yield "done", (prompt, [])
+            return
+        if not llm_module:
+            yield "done", ("LLM Provider Unavailable.", [])
+            return
+
+        cache = get_response_cache()
+        key = cache.key(llm_module, prompt, RAG_ANSWER_TOKENS, 'notes') if cache else None
+        cached = cache.get(key) if key else None
+        pieces = [cached] if cached is not None else llm_module.stream(prompt, max_tokens=RAG_ANSWER_TOKENS, feature='notes')
+
+        answer, sent = "", 0
+        for piece in pieces:
+            answer += piece
+            if "NOT_IN_NOTES" in answer:
+                break
+            # Hold back anything that could still turn out to be NOT_IN_NOTES
+            safe = len(answer) - held_tail(answer, ["NOT_IN_NOTES"])
+            if safe > sent and answer[:safe].strip():
+                yield "token", answer[sent:safe]
+                sent = safe
+        if key and cached is None:
+            cache.put(key, answer, docs=self._doc_ids(final_docs), user_id=user_id)
+        yield "done", self._verify(answer, final_docs)
+
 class DLSummarizer:
     def __init__(self):
         if TF_AVAILABLE:
@@ -308,7 +534,7 @@ class QuizPipeline:
         
         try:
             # Generate
-            response = provider.generate(prompt, max_tokens=150)
+            response = provider.generate(prompt, max_tokens=150, feature='quiz')
             
             # Simple Text Parsing
             lines = response.split('\n')
@@ -497,7 +723,22 @@ dl_summarizer = DLSummarizer()
 nlp_tips = None
 
 class RAGPipeline:
-    def run_chat_rag(self, message, bucket_name, provider, provider_options):
+    @staticmethod
+    def _response(answer, sources, bucket_name):
+        # Explicit Failure Handling
+        confidence = "high" if sources else "none"
+
+        return {
+            "content": answer,
+            "sources": sources,
+            "metadata": {
+                "source": "notes",
+                "buckets_used": [bucket_name] if bucket_name else ["all"],
+                "confidence": confidence
+            }
+        }
+
+    def run_chat_rag(self, message, bucket_name, provider, provider_options, user_id=None):
         """Strict RAG pipeline. Using Notes ONLY."""
         print(f"[RAGPipeline] Query: {message}, Bucket: {bucket_name}")
         from llm_providers import get_provider
@@ -507,22 +748,121 @@ class RAGPipeline:
             return {"error": f"Provider Init Error: {e}"}, 500
 
         # RAG Search (Using LangChain)
-        answer, sources = rag_system.query(message, subject_filter=bucket_name, llm_module=llm)
-        
-        # Explicit Failure Handling
-        confidence = "high" if sources else "none"
+        answer, sources = rag_system.query(message, subject_filter=bucket_name, llm_module=llm, user_id=user_id)
+        return self._response(answer, sources, bucket_name), 200
+
+    def stream_chat_rag(self, message, bucket_name, provider, provider_options, user_id=None):
+        """run_chat_rag as events: {"type": "token", "content"} while generating, then
+        {"type": "done", ...response} (or {"type": "error"})."""
+        print(f"[RAGPipeline] Streaming query: {message}, Bucket: {bucket_name}")
+        from llm_providers import get_provider
+        try:
+            llm = get_provider(provider, **provider_options)
+        except Exception as e:
+            yield {"type": "error", "error": f"Provider Init Error: {e}"}
+            return
+
+        try:
+            for kind, value in rag_system.query_stream(message, subject_filter=bucket_name, llm_module=llm, user_id=user_id):
+                if kind == "token":
+                    yield {"type": "token", "content": value}
+                else:
+                    yield dict(self._response(*value, bucket_name), type="done")
+        except Exception as e:
+            yield {"type": "error", "error": f"RAG Generation Error: {e}"}
+
+# Post-processing for AI-only chat replies (TinyLlama rambles and role-plays past its turn)
+# The local model already stops decoding at these (FEATURE_STOP); cloud replies are cut here
+CHAT_STOP_MARKERS = list(FEATURE_STOP['chat'].stop)
+# Expanded Safety Net
+# Catches: "Sure, here is...", "Here's a script...", "Revised version..."
+BAD_STARTS = [
+    "sure, here",
+    "here is",
+    "here's",
+    "here are",
+    "revised version",
+    "chatbot script",
+    "python script",
+    "below is",
+    "certainly",
+]
+FALLBACK_REPLY = "Hey! 😊 How can I help you?"
+
+class ReplyTrimmer:
+    """Applies the chat reply trims as text arrives: keep the first paragraph, cut at
+    role markers, and replace canned openings with FALLBACK_REPLY.
+
+    feed() returns the part of the reply that is safe to show so far; `done` is set
+    once the rest of the generation would be cut anyway. result() is the final reply.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.sent = 0
+        self.done = False
+        self.rejected = False
+
+    def feed(self, piece: str) -> str:
+        if self.done:
+            return ""
+        # HARD TRIM
+        self.text = (self.text + piece).lstrip()
+        cuts = [self.text.find(m) for m in CHAT_STOP_MARKERS if m in self.text]
+        if cuts:
+            self.text = self.text[:min(cuts)]
+            self.done = True
+        lower = self.text.lower().strip()
+        if any(lower.startswith(b) for b in BAD_STARTS) or "revised version" in lower:
+            self.rejected = True
+            self.done = True
+            return ""
+        # Show nothing while the reply could still become a canned opening
+        if not self.done and any(b.startswith(lower) for b in BAD_STARTS):
+            return ""
+        safe = len(self.text) if self.done else len(self.text) - held_tail(self.text, CHAT_STOP_MARKERS)
+        out = self.text[self.sent:safe]
+        self.sent = max(self.sent, safe)
+        return out
+
+    def result(self) -> str:
+        return FALLBACK_REPLY if self.rejected else self.text.strip()
 
+class AIPipeline:
+    @staticmethod
+    def _prompt(message):
+        # Use POSITIVE instructions to avoid negative priming
+        return (
+            "<|system|>\n"
+            "You are AI Study Pal, a helpful student companion.\n"
+            "Respond to the user in a friendly, casual, and direct way.\n"
+            "Do NOT explain your behavior. Do NOT be verbose.\n"
+            "If the user says hello, just say 'Hey there! Ready to study?'.\n"
+            "Keep answers very short (1-2 sentences) unless asked to explain a concept.\n"
+            "</s>\n"
+            "<|user|>\n"
+            f"{message}</s>\n"
+            "<|assistant|>\n"
+        )
+
+    @staticmethod
+    def _cached(llm, prompt, message):
+        """(cache, key, reply) for a chat turn; reply is None on a miss."""
+        cache = get_response_cache()
+        key = cache.key(llm, prompt, 60, 'chat') if cache else None
+        return cache, key, cache.get(key, question=message) if key else None
+
+    @staticmethod
+    def _response(reply, provider):
         return {
-            "content": answer,
-            "sources": sources,
+            "content": reply,
             "metadata": {
-                "source": "notes",
-                "buckets_used": [bucket_name] if bucket_name else ["all"],
-                "confidence": confidence
+                "source": "ai",
+                "provider": provider,
+                "confidence": "low"
             }
-        }, 200
+        }
 
-class AIPipeline:
     def run_chat_ai(self, message, provider, provider_options):
         """Strict AI-only chat pipeline. No RAG."""
         print(f"[AIPipeline] Query: {message}")
@@ -530,62 +870,55 @@ class AIPipeline:
 
         try:
             llm = get_provider(provider, **provider_options)
-
-            # Use POSITIVE instructions to avoid negative priming
-            prompt = (
-                "<|system|>\n"
-                "You are AI Study Pal, a helpful student companion.\n"
-                "Respond to the user in a friendly, casual, and direct way.\n"
-                "Do NOT explain your behavior. Do NOT be verbose.\n"
-                "If the user says hello, just say 'Hey there! Ready to study?'.\n"
-                "Keep answers very short (1-2 sentences) unless asked to explain a concept.\n"
-                "</s>\n"
-                "<|user|>\n"
-                f"{message}</s>\n"
-                "<|assistant|>\n"
-            )
+            prompt = self._prompt(message)
+            cache, key, reply = self._cached(llm, prompt, message)
+            if reply is not None:
+                return self._response(reply, provider), 200
 
             # Request few tokens
-            reply = llm.generate(prompt, max_tokens=60)
-
-            # HARD TRIM
-            reply = reply.strip()
-            reply = reply.split("\n\n")[0]
-            for token in ["User:", "<|user|>", "Assistant:", "<|assistant|>"]:
-                if token in reply:
-                    reply = reply.split(token)[0].strip()
-
-            # Expanded Safety Net
-            # Catches: "Sure, here is...", "Here's a script...", "Revised version..."
-            BAD_STARTS = [
-                "sure, here",
-                "here is",
-                "here's",
-                "here are",
-                "revised version",
-                "chatbot script",
-                "python script",
-                "below is",
-                "certainly",
-            ]
-            
-            # Check lowercase start
-            lower_reply = reply.lower()
-            if any(lower_reply.startswith(b) for b in BAD_STARTS) or "revised version" in lower_reply:
-                 reply = "Hey! 😊 How can I help you?"
+            reply = llm.generate(prompt, max_tokens=60, feature='chat')
 
-            return {
-                "content": reply,
-                "metadata": {
-                    "source": "ai",
-                    "provider": provider,
-                    "confidence": "low"
-                }
-            }, 200
+            trimmer = ReplyTrimmer()
+            trimmer.feed(reply)
+            if key:
+                cache.put(key, trimmer.result(), question=message)
+            return self._response(trimmer.result(), provider), 200
 
         except Exception as e:
             return {"error": f"AI Generation Error: {e}"}, 500
 
+    def stream_chat_ai(self, message, provider, provider_options):
+        """run_chat_ai as events: {"type": "token", "content"} while generating, then
+        {"type": "done", ...response} with the final trimmed reply (or {"type": "error"})."""
+        print(f"[AIPipeline] Streaming query: {message}")
+        from llm_providers import get_provider
+
+        try:
+            llm = get_provider(provider, **provider_options)
+            prompt = self._prompt(message)
+            cache, key, reply = self._cached(llm, prompt, message)
+            if reply is not None:
+                yield {"type": "token", "content": reply}
+                yield dict(self._response(reply, provider), type="done")
+                return
+
+            trimmer = ReplyTrimmer()
+            pieces = llm.stream(prompt, max_tokens=60, feature='chat')
+            for piece in pieces:
+                text = trimmer.feed(piece)
+                if text:
+                    yield {"type": "token", "content": text}
+                if trimmer.done:
+                    # Nothing past the cut is shown; stop generating
+                    pieces.close()
+                    break
+            if key:
+                cache.put(key, trimmer.result(), question=message)
+            yield dict(self._response(trimmer.result(), provider), type="done")
+
+        except Exception as e:
+            yield {"type": "error", "error": f"AI Generation Error: {e}"}
+
 rag_pipeline = RAGPipeline()
 ai_pipeline = AIPipeline()
 
@@ -613,7 +946,7 @@ class NLPTipsGenerator:
             )
             
             # Generate
-            response = llm.generate(prompt, max_tokens=400)
+            response = cached_generate(llm, prompt, 400, 'tips')
             
             # Parse Response
             tips = []
@@ -641,6 +974,25 @@ class NLPTipsGenerator:
              return ["Could not generate specific tips. Try simplifying the text.", "Focus on active recall of the main topics."]
 nlp_tips = NLPTipsGenerator()
 
+# generate_plan output, enforced token by token on the local model (sized to fit 1200 tokens)
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "plan": {
+            "type": "array",
+            "minItems": 7,
+            "maxItems": 7,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "day": {"type": "string", "maxLength": 20},
+                    "tasks": {"type": "array", "items": {"type": "string", "maxLength": 80}, "minItems": 1, "maxItems": 4},
+                },
+            },
+        },
+    },
+}
+
 class StudyPlanGenerator:
     def generate_plan(self, subject, hours, goal, grade="10", syllabus="General"):
         print(f"[StudyPlan] Generating plan for {subject} ({hours}h/day) - {goal}...")
@@ -665,7 +1017,8 @@ class StudyPlanGenerator:
                 "<|assistant|>\n"
             )
             
-            response = llm.generate(prompt, max_tokens=1200)
+            response = cached_generate(llm, prompt, 1200, 'plan', keep=lambda r: '"plan"' in r,
+                                       constraint=JSONConstraint(PLAN_SCHEMA))
             
             # Clean Markdown
             clean_json = response.strip()
@@ -0,0 +1,139 @@
+"""Cross-encoder re-ranking of retrieved chunks.
+
+Scores every (question, chunk) candidate pair in one batched CrossEncoder call,
+so the few chunks sent to the local LLM are the most relevant ones rather than
+the closest embeddings. Pair scores are cached, and pairs that would not fit in
+the latency budget keep their retrieval order after the scored ones.
+
+Enabled with RAG_RERANK=1 (needs sentence-transformers).
+
+API:
+ - get_reranker() -> CrossEncoderReranker | None
+ - CrossEncoderReranker.rerank(query: str, texts: list[str]) -> list[(index, score | None)]
+    best first; score is None for candidates left unscored by the budget.
+"""
+from typing import List, Dict, Any, Optional, Tuple
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    from sentence_transformers import CrossEncoder
+    ST_CE_AVAILABLE = True
+except Exception:
+    ST_CE_AVAILABLE = False
+
+RERANK = os.environ.get('RAG_RERANK', '0') == '1'
+RERANK_MODEL = os.environ.get('RAG_RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+# Candidates fetched from the index for re-ranking (the LLM still gets the top 2)
+RERANK_CANDIDATES = int(os.environ.get('RAG_RERANK_CANDIDATES', '10'))
+RERANK_BUDGET_MS = float(os.environ.get('RAG_RERANK_BUDGET_MS', '300'))
+RERANK_CACHE_SIZE = int(os.environ.get('RAG_RERANK_CACHE_SIZE', '4096'))
+
+
+def _pair_key(query: str, text: str) -> Tuple[str, str]:
+    normalized = re.sub(r'\s+', ' ', query).strip().lower()
+    return normalized, hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name: str = RERANK_MODEL, budget_ms: float = RERANK_BUDGET_MS, cache_size: int = RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.budget_ms = budget_ms
+        self.cache_size = cache_size
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._cache = OrderedDict()  # (query, chunk sha256) -> score
+        self._cache_lock = threading.Lock()
+        self.ms_per_pair = None  # running estimate used to fit the budget
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+        self.skipped = 0
+
+    def _load(self):
+        with self._model_lock:
+            if self._model is None:
+                started = time.time()
+                self._model = CrossEncoder(self.model_name)
+                print(f"[Rerank] Loaded {self.model_name} in {time.time() - started:.1f}s")
+        return self._model
+
+    def _cached(self, key):
+        with self._cache_lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _store(self, pairs: Dict[Tuple[str, str], float]):
+        with self._cache_lock:
+            self._cache.update(pairs)
+            for key in pairs:
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def rerank(self, query: str, texts: List[str]) -> List[Tuple[int, Optional[float]]]:
+        keys = [_pair_key(query, t) for t in texts]
+        scores = {}
+        todo = []
+        for n, key in enumerate(keys):
+            score = self._cached(key)
+            if score is None:
+                todo.append(n)
+            else:
+                scores[n] = score
+        self.hits += len(scores)
+        self.misses += len(todo)
+
+        # Keep the best-retrieved pairs that fit the budget at the observed cost per pair
+        if todo and self.ms_per_pair:
+            fits = max(1, int(self.budget_ms / self.ms_per_pair))
+            self.skipped += max(0, len(todo) - fits)
+            todo = todo[:fits]
+
+        if todo:
+            model = self._load()
+            started = time.time()
+            predicted = model.predict([(query, texts[n]) for n in todo], batch_size=len(todo), show_progress_bar=False)
+            elapsed_ms = (time.time() - started) * 1000
+            per_pair = elapsed_ms / len(todo)
+            self.ms_per_pair = per_pair if self.ms_per_pair is None else 0.8 * self.ms_per_pair + 0.2 * per_pair
+            self.calls += 1
+            fresh = {n: float(s) for n, s in zip(todo, predicted)}
+            scores.update(fresh)
+            self._store({keys[n]: s for n, s in fresh.items()})
+            print(f"[Rerank] Scored {len(todo)} pairs in {elapsed_ms:.0f}ms ({len(texts) - len(todo)} cached/skipped)")
+
+        scored = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        unscored = [(n, None) for n in range(len(texts)) if n not in scores]
+        return scored + unscored
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'model': self.model_name,
+            'calls': self.calls,
+            'cache_size': len(self._cache),
+            'cache_hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'ms_per_pair': round(self.ms_per_pair, 2) if self.ms_per_pair else None,
+            'skipped_over_budget': self.skipped,
+        }
+
+
+_RERANKER = None
+_RERANKER_LOCK = threading.Lock()
+
+def get_reranker():
+    """The shared reranker, or None when RAG_RERANK is off or CrossEncoder is missing."""
+    global _RERANKER
+    if not RERANK or not ST_CE_AVAILABLE:
+        return None
+    with _RERANKER_LOCK:
+        if _RERANKER is None:
+            _RERANKER = CrossEncoderReranker()
+    return _RERANKER
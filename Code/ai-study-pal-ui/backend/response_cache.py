@@ -0,0 +1,198 @@
+"""Cache of LLM replies, so a repeated question is answered without generating.
+
+Exact tier: keyed on the provider, its model and sampling settings, max_tokens,
+the feature and a hash of the full prompt. A notes answer's prompt contains the
+retrieved chunks, so the same question over changed notes is a different key.
+
+Semantic tier (LLM_CACHE_SEMANTIC=1, chat only): a question whose embedding is
+within LLM_CACHE_SIMILARITY cosine of a cached one, asked of the same provider
+and settings, gets that reply.
+
+Entries built from notes are tagged with their source documents and dropped
+when a document is re-indexed or deleted (RAGSystem.add_document / delete_document).
+
+API:
+ - get_response_cache() -> ResponseCache | None
+ - ResponseCache.key(llm, prompt, max_tokens, feature, constraint=None) -> str
+ - ResponseCache.get(key, question=None) -> str | None
+ - ResponseCache.put(key, text, question=None, docs=(), user_id=None)
+ - ResponseCache.invalidate_document(doc_id, user_id=None) -> int
+ - cached_generate(llm, prompt, max_tokens, feature, docs=(), user_id=None, keep=None, constraint=None) -> str
+"""
+from typing import Dict, Any, Optional
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+LLM_CACHE = os.environ.get('LLM_CACHE', '1') == '1'
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', '1024'))
+# Quiz generation is left out: repeated runs should give different questions
+LLM_CACHE_FEATURES = set(os.environ.get('LLM_CACHE_FEATURES', 'chat,notes,summary,tips,plan').split(','))
+LLM_CACHE_SEMANTIC = os.environ.get('LLM_CACHE_SEMANTIC', '0') == '1'
+LLM_CACHE_SIMILARITY = float(os.environ.get('LLM_CACHE_SIMILARITY', '0.95'))
+
+# Replies that report a failure instead of an answer are never cached
+ERROR_REPLY = re.compile(r'^\s*(LLM|GGUF|HF|Gemini|OpenAI) Error:')
+
+
+def _scope(llm, max_tokens: int, feature, constraint=None) -> str:
+    """Everything but the prompt that decides a reply: backend, model, sampling, length, feature, JSON constraint."""
+    backend = getattr(llm, 'backend', llm)
+    parts = [type(backend).__name__, getattr(backend, 'model_id', None), getattr(backend, 'sampling', {}), max_tokens, feature]
+    if constraint is not None:
+        parts += [constraint.schema, constraint.prefix]
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = LLM_CACHE_SIZE, features=LLM_CACHE_FEATURES, embed_fn=None,
+                 similarity: float = LLM_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.features = set(features)
+        self.embed_fn = embed_fn  # question -> vector; None disables the semantic tier
+        self.similarity = similarity
+        self._entries = OrderedDict()  # key -> (scope, text, tags)
+        self._tags = {}                # (user_id, doc_id) -> keys built from that document
+        self._questions = {}           # scope -> OrderedDict(key -> unit question vector)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def key(self, llm, prompt: str, max_tokens: int, feature=None, constraint=None) -> Optional[str]:
+        """Cache key for a generation, or None when the feature is not cached."""
+        if feature not in self.features:
+            return None
+        scope = _scope(llm, max_tokens, feature, constraint)
+        return scope + ':' + hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    def _embed(self, question: str):
+        vector = np.asarray(self.embed_fn(question), dtype='float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, key: Optional[str], question: str = None) -> Optional[str]:
+        """The cached reply for key, else (with a question) the reply to a close enough question."""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            scope = key.split(':', 1)[0]
+            asked = self._questions.get(scope)
+        if question and asked and self.embed_fn is not None:
+            vector = self._embed(question)
+            with self._lock:
+                keys = list(asked)
+                if keys:
+                    scores = np.vstack([asked[k] for k in keys]) @ vector
+                    best = int(np.argmax(scores))
+                    entry = self._entries.get(keys[best]) if scores[best] >= self.similarity else None
+                    if entry is not None:
+                        self._entries.move_to_end(keys[best])
+                        self.semantic_hits += 1
+                        return entry[1]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: Optional[str], text: str, question: str = None, docs=(), user_id=None):
+        """Store a reply. docs are the doc_ids of the notes in its prompt."""
+        if key is None or self.max_size <= 0 or not text or ERROR_REPLY.match(text):
+            return
+        vector = self._embed(question) if question and self.embed_fn is not None else None
+        scope = key.split(':', 1)[0]
+        tags = {(user_id, str(d)) for d in docs}
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (scope, text, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            if vector is not None:
+                self._questions.setdefault(scope, OrderedDict())[key] = vector
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        scope, _, tags = entry
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        asked = self._questions.get(scope)
+        if asked is not None:
+            asked.pop(key, None)
+            if not asked:
+                del self._questions[scope]
+
+    def invalidate_document(self, doc_id, user_id=None) -> int:
+        """Drop every reply whose prompt held chunks of the document. Returns how many."""
+        with self._lock:
+            keys = self._tags.pop((user_id, str(doc_id)), set())
+            for key in keys:
+                self._drop(key)
+            self.invalidated += len(keys)
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.semantic_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+                'invalidated': self.invalidated,
+            }
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def get_response_cache():
+    """The shared response cache, or None when LLM_CACHE is off."""
+    global _CACHE
+    if not LLM_CACHE:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            embed_fn = None
+            if LLM_CACHE_SEMANTIC:
+                from ml_utils import rag_system
+                embeddings = getattr(rag_system, 'embeddings', None)
+                if embeddings is not None and embeddings.model is not None:
+                    embed_fn = embeddings.embed_query
+                else:
+                    print("[LLMCache] No embedding model; semantic tier disabled.")
+            _CACHE = ResponseCache(embed_fn=embed_fn)
+    return _CACHE
+
+
+def cached_generate(llm, prompt: str, max_tokens: int, feature=None, docs=(), user_id=None, keep=None, constraint=None) -> str:
+    """llm.generate(prompt, max_tokens, feature, constraint) through the response cache.
+
+    keep(text) -> bool rejects replies not worth serving again (e.g. unparseable JSON).
+    """
+    cache = get_response_cache()
+    key = cache.key(llm, prompt, max_tokens, feature, constraint) if cache else None
+    text = cache.get(key) if key else None
+    if text is None:
+        text = llm.generate(prompt, max_tokens=max_tokens, feature=feature, constraint=constraint)
+        if key and (keep is None or keep(text)):
+            cache.put(key, text, docs=docs, user_id=user_id)
+    return text
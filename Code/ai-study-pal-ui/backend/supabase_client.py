@@ -125,7 +125,7 @@ def fetch_notes(bucket_id: str = None):
     url = SUPABASE_URL.rstrip('/') + "/rest/v1/notes"
     headers = _auth_headers()
     params = {
-        "select": "id,title,content,bucket_id,user_id",
+        "select": "id,title,content,bucket_id,user_id,file_path",
         "order": "created_at.desc"
     }
     if bucket_id:
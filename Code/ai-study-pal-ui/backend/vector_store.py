@@ -1,6 +1,17 @@
 from typing import List, Dict, Any
 import os
+import re
 import json
+import math
+import time
+import base64
+import atexit
+import weakref
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import ExitStack, contextmanager
 import numpy as np
 
 try:
@@ -10,79 +21,1168 @@ except Exception:
     FAISS_AVAILABLE = False
 
 from embeddings import get_embeddings_instance
+from chunk_store import ChunkStore
+import background
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Index factory: shards start as exact Flat search and are promoted to an ANN index
+# ('ivfpq', 'hnsw' or 'flat' to never promote) once they pass RAG_ANN_THRESHOLD chunks.
+ANN_INDEX = os.environ.get('RAG_ANN_INDEX', 'ivfpq').lower()
+ANN_THRESHOLD = int(os.environ.get('RAG_ANN_THRESHOLD', '20000'))
+IVF_NPROBE = int(os.environ.get('RAG_IVF_NPROBE', '16'))
+HNSW_EF_SEARCH = int(os.environ.get('RAG_HNSW_EF_SEARCH', '64'))
+
+# Vector storage: 'float' keeps 4 bytes per dimension, 'sq8' scalar-quantizes to 1 byte.
+# Quantized indexes (sq8, IVF-PQ) over-fetch RAG_RESCORE_FACTOR x top_k candidates and
+# re-score them against a full-precision copy kept on disk (RAG_RESCORE=0 to disable).
+VECTOR_STORAGE = os.environ.get('RAG_VECTOR_STORAGE', 'float').lower()
+RESCORE = os.environ.get('RAG_RESCORE', '1') == '1'
+RESCORE_FACTOR = int(os.environ.get('RAG_RESCORE_FACTOR', '4'))
+
+# Writes are appended to a per-store log; the full index + metadata snapshot is only
+# rewritten (checkpointed) once the log passes this size, on compaction/promotion and at exit.
+WAL_CHECKPOINT_MB = float(os.environ.get('RAG_WAL_CHECKPOINT_MB', '32'))
+
+# Hybrid retrieval: BM25 keyword hits are fused with dense hits by reciprocal-rank fusion
+HYBRID_SEARCH = os.environ.get('RAG_HYBRID', '1') == '1'
+RRF_K = int(os.environ.get('RAG_RRF_K', '60'))
+
+
+def index_factory_string(kind: str, dim: int, n: int, storage: str = None) -> str:
+    """faiss.index_factory description for an index of `kind` sized for n vectors."""
+    storage = storage or VECTOR_STORAGE
+    if kind == 'hnsw':
+        return 'HNSW32_SQ8' if storage == 'sq8' else 'HNSW32'
+    if kind == 'ivfpq':
+        # ~4*sqrt(n) lists, keeping >= 39 training points per centroid
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        m = next(m for m in (48, 32, 24, 16, 8, 4, 2, 1) if dim % m == 0)
+        return f'IVF{nlist},PQ{m}'
+    return 'SQ8' if storage == 'sq8' else 'Flat'
+
+
+# Write batches go into the index this many vectors at a time, so searches are never
+# held up for longer than one slice (HNSW inserts are slow)
+ADD_SLICE = 1024
+
+
+class ReadWriteLock:
+    """Any number of readers, or one writer. Reentrant for both; a waiting writer
+    keeps new readers out so a stream of queries cannot starve it.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self._local, 'reads', 0)
+        if depth or self._writer == threading.get_ident():
+            # Already inside read() or write() on this thread
+            self._local.reads = depth + 1
+            try:
+                yield
+            finally:
+                self._local.reads = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                if getattr(self._local, 'reads', 0):
+                    raise RuntimeError('cannot upgrade a read lock to a write lock')
+                self._writers_waiting += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+# What searches see: the index object, the tombstones and the id bound as of the last
+# commit. Vectors added since (ids >= next_id) are skipped until persist() publishes them.
+Generation = namedtuple('Generation', 'index tombstones next_id')
+
+
+def _temp_path_for(path: str, suffix: str = '.tmp'):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix=suffix)
+    os.close(fd)
+    return tmp_path
+
+
+def write_json_atomic(path: str, data: Any):
+    """Write JSON to a temp file in the same directory, then swap it in with os.replace."""
+    tmp_path = _temp_path_for(path)
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_index_atomic(index, path: str):
+    """Same as write_json_atomic, for a FAISS index."""
+    tmp_path = _temp_path_for(path)
+    try:
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FloatVectorFile:
+    """Full-precision copy of a store's vectors: one float32 row per vector id, read via memmap.
+
+    Quantized indexes re-score their candidates from here, and compaction/promotion
+    rebuild from it instead of reconstructing lossy codes.
+    """
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self._map = None
+        self._lock = threading.Lock()
+
+    @property
+    def rows(self) -> int:
+        return os.path.getsize(self.path) // self.row_bytes if os.path.exists(self.path) else 0
+
+    def write(self, start_id: int, vectors: np.ndarray):
+        """Write vectors at rows start_id.. (the file grows as needed)."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+            f.seek(start_id * self.row_bytes)
+            f.write(np.ascontiguousarray(vectors, dtype='float32').tobytes())
+        with self._lock:
+            self._map = None  # remap on the next read
+
+    def read(self, ids):
+        """Rows for ids, or None if any of them was never written."""
+        ids = np.asarray(ids, dtype='int64')
+        if len(ids) == 0:
+            return np.zeros((0, self.dim), dtype='float32')
+        with self._lock:
+            if self._map is None or ids.max() >= self._map.shape[0]:
+                rows = self.rows
+                if rows == 0:
+                    return None
+                self._map = np.memmap(self.path, dtype='float32', mode='r', shape=(rows, self.dim))
+            vectors = self._map
+        if ids.max() >= vectors.shape[0]:
+            return None
+        return np.array(vectors[ids])
+
+    def remove(self):
+        with self._lock:
+            self._map = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 
 class FaissStore:
-    def __init__(self, dim: int = 384, index_path: str = 'backend/data/faiss.index', meta_path: str = 'backend/data/faiss_meta.json'):
+    def __init__(self, dim: int = 384, index_path: str = 'backend/data/faiss.index', meta_path: str = 'backend/data/faiss_meta.json', mmap: bool = True):
         self.dim = dim
         self.index_path = index_path
         self.meta_path = meta_path
         self.index = None
-        self.metadatas = {}  # id -> metadata
+        # id -> chunk metadata, on disk next to the index
+        self.metadatas = ChunkStore(os.path.splitext(meta_path)[0] + '.sqlite')
+        self.next_id = 0
+        self.tombstones = set()  # ids removed from metadata but still physically in the index
+        self._mmapped = False
+        # Exact vectors for re-scoring quantized search results
+        self.vectors = FloatVectorFile(os.path.splitext(index_path)[0] + '.vectors.f32', dim) if RESCORE else None
+        self.wal_path = os.path.splitext(index_path)[0] + '.wal'
+        self._pending = []  # log records not yet written by persist()
+        # Serializes mutations. Searches take the read side of _rw and use the published
+        # generation; writers take its write side only to mutate that index object in
+        # place or to publish, never while embedding or rebuilding.
+        self._write_lock = threading.RLock()
+        self._rw = ReadWriteLock()
+        self._generation = Generation(None, frozenset(), 0)
         if FAISS_AVAILABLE:
-            self._init_index()
+            self._init_index(mmap)
+            self._publish()
+            _OPEN_STORES.add(self)
 
-    def _init_index(self):
-        if os.path.exists(self.index_path):
-            try:
-                self.index = faiss.read_index(self.index_path)
-            except Exception:
-                self.index = faiss.IndexFlatIP(self.dim)
-        else:
-            self.index = faiss.IndexFlatIP(self.dim)
+    def _build_inner(self, spec: str):
+        inner = faiss.index_factory(self.dim, spec, faiss.METRIC_INNER_PRODUCT)
+        if isinstance(inner, faiss.IndexScalarQuantizer) and not inner.is_trained:
+            # Normalized embeddings lie in [-1, 1]: fix the SQ8 range instead of learning it
+            inner.train(np.vstack([-np.ones(self.dim), np.ones(self.dim)]).astype('float32'))
+        return inner
 
-        # load metadata
+    def _new_index(self, spec: str = None):
+        # IDMap2 keeps vector ids stable across saves/loads and lets us reconstruct by id
+        return faiss.IndexIDMap2(self._build_inner(spec or index_factory_string('flat', self.dim, 0)))
+
+    def _empty_like(self):
+        """An empty index of the current type, keeping any trained IVF/PQ state."""
+        inner = faiss.clone_index(faiss.downcast_index(self.index.index))
+        inner.reset()
+        return faiss.IndexIDMap2(inner)
+
+    @property
+    def kind(self) -> str:
+        inner = faiss.downcast_index(self.index.index)
+        if isinstance(inner, faiss.IndexIVF):
+            return 'ivfpq'
+        if isinstance(inner, faiss.IndexHNSW):
+            return 'hnsw'
+        return 'flat'
+
+    @property
+    def storage(self) -> str:
+        """How vectors are encoded in the index: 'float', 'sq8' or 'pq'."""
+        inner = faiss.downcast_index(self.index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            inner = faiss.downcast_index(inner.storage)
+        if isinstance(inner, faiss.IndexIVFPQ):
+            return 'pq'
+        if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+            return 'sq8'
+        return 'float'
+
+    def _apply_search_params(self, nprobe: int = None, ef_search: int = None, index=None):
+        inner = faiss.downcast_index((index or self.index).index)
+        if isinstance(inner, faiss.IndexIVF):
+            inner.nprobe = nprobe or IVF_NPROBE
+            # reconstruct() (compaction, re-ranking) needs the id -> list offset map
+            if inner.direct_map.type == faiss.DirectMap.NoMap:
+                inner.make_direct_map()
+        elif isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = ef_search or HNSW_EF_SEARCH
+
+    def _as_id_map(self, index):
+        """Wrap a legacy positional IndexFlatIP (ids 0..n-1) in an IndexIDMap2."""
+        if isinstance(index, faiss.IndexIDMap):
+            return index
+        wrapped = self._new_index()
+        if index.ntotal:
+            vectors = index.reconstruct_n(0, index.ntotal)
+            wrapped.add_with_ids(vectors, np.arange(index.ntotal, dtype='int64'))
+        return wrapped
+
+    def _init_index(self, mmap: bool = True):
+        # load id counter + tombstones (chunk metadata lives in the ChunkStore)
         if os.path.exists(self.meta_path):
             try:
                 with open(self.meta_path, 'r', encoding='utf-8') as f:
-                    self.metadatas = json.load(f)
-            except Exception:
-                self.metadatas = {}
+                    meta = json.load(f)
+                if 'next_id' in meta:
+                    self.next_id = int(meta.get('next_id', 0))
+                    self.tombstones = set(int(i) for i in meta.get('tombstones', []))
+                    legacy = meta.get('metadatas')
+                else:
+                    # Legacy format: the file is the id -> metadata dict itself
+                    self.next_id = len(meta)
+                    legacy = meta
+                if legacy:
+                    self._import_metadatas(legacy)
+            except Exception as e:
+                print(f"Warning: failed to read {self.meta_path} ({e})")
+
+        self.index = self._new_index()
+        if os.path.exists(self.index_path):
+            try:
+                # Memory-map the snapshot so boot does not copy every vector into RAM up front
+                flags = faiss.IO_FLAG_MMAP if mmap else 0
+                index = faiss.read_index(self.index_path, flags)
+                self._mmapped = bool(mmap)
+                if not isinstance(index, faiss.IndexIDMap):
+                    self._mmapped = False
+                    index = self._as_id_map(index)
+                self.index = index
+                self._apply_search_params()
+            except Exception as e:
+                print(f"Warning: failed to load faiss index ({e}); starting empty.")
+                self.index = self._new_index()
+                self._mmapped = False
+                self.metadatas.clear()
+                self.next_id = 0
+                self.tombstones = set()
+
+        self._replay_wal()
+        self._reconcile()
+        self._backfill_vectors()
+
+    def _import_metadatas(self, metadatas: Dict[str, Any]):
+        """Move metadata from a JSON-era meta file into the ChunkStore, then drop it from the JSON."""
+        self.metadatas.put_many([int(i) for i in metadatas], list(metadatas.values()))
+        self.metadatas.commit()
+        write_json_atomic(self.meta_path, {'next_id': self.next_id, 'tombstones': sorted(self.tombstones)})
+        print(f"[FaissStore] Moved {len(metadatas)} chunk records from {self.meta_path} into {self.metadatas.path}")
+
+    def _replay_wal(self):
+        """Re-apply writes logged since the last checkpoint. Stops at a torn final record."""
+        if not os.path.exists(self.wal_path):
+            return
+        snapshot_next_id = self.next_id
+        stored = None
+        replayed = 0
+        with open(self.wal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    print(f"Warning: ignoring torn record at the end of {self.wal_path}")
+                    break
+                op, ids = record['op'], record['ids']
+                if op == 'add':
+                    # Ids below the snapshot's next_id are already in the checkpoint
+                    fresh = [n for n, i in enumerate(ids) if i >= snapshot_next_id]
+                    if not fresh:
+                        continue
+                    self._ensure_writable()
+                    if stored is None:
+                        stored = set(int(i) for i in faiss.vector_to_array(self.index.id_map))
+                    vectors = np.frombuffer(base64.b64decode(record['vectors']), dtype='float32').reshape(len(ids), -1)
+                    # A crash mid-checkpoint can leave vectors in the index that the meta file lacks
+                    missing = [pos for pos, n in enumerate(fresh) if ids[n] not in stored]
+                    self._apply_add(np.array([ids[n] for n in fresh], dtype='int64'), vectors[fresh],
+                                    [record['metas'][n] for n in fresh], index_rows=missing)
+                    stored.update(ids[fresh[pos]] for pos in missing)
+                elif op == 'remove':
+                    self._apply_remove(ids)
+                elif op == 'update':
+                    self._apply_update(ids, record['fields'])
+                replayed += 1
+        if replayed:
+            print(f"[FaissStore] Replayed {replayed} logged writes for {self.index_path}")
+
+    def _backfill_vectors(self):
+        """Create the float copy for an index saved before it existed (exact indexes only)."""
+        if self.vectors is None or self.vectors.rows >= self.next_id or self.index.ntotal == 0:
+            return
+        if self.storage != 'float':
+            print(f"[FaissStore] {self.index_path} has no float copy; quantized results are not re-scored.")
+            return
+        stored_ids = faiss.vector_to_array(self.index.id_map)
+        full = np.zeros((self.next_id, self.dim), dtype='float32')
+        full[stored_ids] = self.index.index.reconstruct_n(0, self.index.ntotal)
+        self.vectors.write(0, full)
+
+    def _reconcile(self):
+        """Tombstone vectors that have no metadata (e.g. a crash between the index and meta writes)."""
+        if self.index.ntotal == len(self.metadatas) + len(self.tombstones):
+            return
+        stored_ids = faiss.vector_to_array(self.index.id_map)
+        if len(stored_ids):
+            self.next_id = max(self.next_id, int(stored_ids.max()) + 1)
+        live = set(int(i) for i in stored_ids)
+        with_meta = set(int(i) for i in self.metadatas.ids())
+        orphans = np.array([i for i in live if i not in with_meta and i not in self.tombstones], dtype='int64')
+        # Metadata committed for vectors that never reached the index
+        self.metadatas.delete_many(with_meta - live)
+        self.metadatas.commit()
+        self.tombstones = {i for i in self.tombstones if i in live}
+        if len(orphans):
+            # HNSW cannot remove_ids; tombstone them and let compaction rebuild
+            print(f"Warning: tombstoning {len(orphans)} faiss vectors without metadata.")
+            self.tombstones.update(int(i) for i in orphans)
+
+    def _ensure_writable(self):
+        # Memory-mapped indexes can be read-only (e.g. IVF on-disk lists); reload fully before mutating
+        if self._mmapped:
+            self.index = self._as_id_map(faiss.read_index(self.index_path))
+            self._apply_search_params()
+            self._mmapped = False
+
+    @property
+    def ntotal(self) -> int:
+        """Number of live (non-tombstoned) vectors."""
+        return self.index.ntotal - len(self.tombstones) if self.index is not None else 0
+
+    def _bytes_per_vector(self) -> int:
+        inner = faiss.downcast_index(self.index.index)
+        if isinstance(inner, faiss.IndexIVF):
+            code = inner.code_size + 8  # PQ/SQ code + inverted-list id
+        elif isinstance(inner, faiss.IndexHNSW):
+            storage = faiss.downcast_index(inner.storage)
+            code = getattr(storage, 'code_size', self.dim * 4) + 32 * 2 * 4  # vector + level-0 neighbour links
+        else:
+            code = getattr(inner, 'code_size', self.dim * 4)
+        return code + 16  # IDMap2 forward + reverse id maps
+
+    def memory_bytes(self) -> int:
+        """Rough resident size of the stored vectors (chunk metadata stays on disk)."""
+        if self.index is None:
+            return 0
+        return self.index.ntotal * self._bytes_per_vector()
+
+    @property
+    def tombstone_ratio(self) -> float:
+        if self.index is None or self.index.ntotal == 0:
+            return 0.0
+        return len(self.tombstones) / self.index.ntotal
 
-    def add(self, embeddings: np.ndarray, metadatas: List[Dict[str, Any]]):
+    def add(self, embeddings: np.ndarray, metadatas: List[Dict[str, Any]], persist: bool = True) -> List[int]:
         if not FAISS_AVAILABLE:
             raise RuntimeError('FAISS not available')
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
         if embeddings.ndim == 1:
             embeddings = embeddings.reshape(1, -1)
 
         # normalize for inner product similarity if desired
         faiss.normalize_L2(embeddings)
 
-        start_id = len(self.metadatas)
-        ids = list(range(start_id, start_id + embeddings.shape[0]))
-        # faiss IndexFlat does not store ids; for simple case append vectors
-        self.index.add(embeddings.astype('float32'))
+        with self._write_lock:
+            self._ensure_writable()
+            ids = np.arange(self.next_id, self.next_id + embeddings.shape[0], dtype='int64')
+            self._apply_add(ids, embeddings, metadatas)
+            self._pending.append({
+                'op': 'add',
+                'ids': [int(i) for i in ids],
+                'vectors': base64.b64encode(embeddings.tobytes()).decode('ascii'),
+                'metas': list(metadatas),
+            })
+            if persist:
+                self.persist()
+        return [int(i) for i in ids]
 
-        # store metadata mapped to integer id (string keys for JSON)
-        for i, m in zip(ids, metadatas):
-            self.metadatas[str(i)] = m
+    def _apply_add(self, ids: np.ndarray, vectors: np.ndarray, metadatas: List[Dict[str, Any]], index_rows=None):
+        # index_rows: which rows still need adding to the index (replay after a partial checkpoint)
+        if self.vectors is not None:
+            for start, stop in _runs(ids):
+                self.vectors.write(int(ids[start]), vectors[start:stop])
+        rows = np.arange(len(ids)) if index_rows is None else np.asarray(index_rows, dtype='int64')
+        for start in range(0, len(rows), ADD_SLICE):
+            part = rows[start:start + ADD_SLICE]
+            # The published index may be this same object; searches wait only for one slice
+            with self._rw.write():
+                self.index.add_with_ids(np.ascontiguousarray(vectors[part]), ids[part])
+        self.next_id = max(self.next_id, int(ids.max()) + 1)
 
-        self._persist()
+        self.metadatas.put_many(ids, metadatas)
+
+    def remove(self, ids: List[int]) -> int:
+        """Tombstone vectors by id. They stop matching immediately; compact() frees them.
+
+        Call persist() afterwards to save.
+        """
+        ids = [int(i) for i in ids]
+        with self._write_lock:
+            removed = self._apply_remove(ids)
+            if removed:
+                self._pending.append({'op': 'remove', 'ids': ids})
+        return removed
+
+    def _apply_remove(self, ids: List[int]) -> int:
+        removed = self.metadatas.delete_many(ids)
+        self.tombstones.update(removed)
+        return len(removed)
+
+    def compact(self) -> int:
+        """Rebuild the index from live vectors, dropping tombstones. Returns vectors dropped.
+
+        Searches keep using the old index until the rebuilt one is published.
+        """
+        with self._write_lock:
+            if not self.tombstones:
+                return 0
+            self._ensure_writable()
+            live_ids = self.metadatas.ids()
+            rebuilt = self._empty_like()
+            if len(live_ids):
+                # Stored vectors are already normalized
+                rebuilt.add_with_ids(self.exact_vectors(live_ids), live_ids)
+            dropped = len(self.tombstones)
+            self.index = rebuilt
+            self._apply_search_params()
+            self.tombstones = set()
+            self.checkpoint()
+        print(f"[FaissStore] Compacted {self.index_path}: dropped {dropped} tombstoned vectors.")
+        return dropped
+
+    def should_promote(self) -> bool:
+        return ANN_INDEX != 'flat' and self.kind == 'flat' and self.ntotal >= ANN_THRESHOLD
+
+    def promote(self, kind: str = None) -> str:
+        """Rebuild this Flat store as an ANN index. IVF training runs outside the write
+        lock, so adds continue meanwhile and are picked up before the swap. Returns the spec."""
+        kind = kind or ANN_INDEX
+        with self._write_lock:
+            self._ensure_writable()
+            sample_ids = self.metadatas.ids()
+        spec = index_factory_string(kind, self.dim, len(sample_ids))
+        inner = self._build_inner(spec)
+        if not inner.is_trained:
+            started = time.time()
+            inner.train(self.exact_vectors(sample_ids))
+            print(f"[FaissStore] Trained {spec} on {len(sample_ids)} vectors in {time.time() - started:.1f}s")
+
+        with self._write_lock:
+            live_ids = self.metadatas.ids()
+            promoted = faiss.IndexIDMap2(inner)
+            if len(live_ids):
+                promoted.add_with_ids(self.exact_vectors(live_ids), live_ids)
+            self.index = promoted
+            self._apply_search_params()
+            self.tombstones = set()
+            self.checkpoint()
+        print(f"[FaissStore] Promoted {self.index_path} to {spec} ({len(live_ids)} vectors).")
+        return spec
+
+    def recall_latency_report(self, k: int = 5, n_queries: int = 100, sweep=None) -> List[Dict[str, Any]]:
+        """Recall@k and mean search latency against exact search, per nprobe/efSearch value.
+
+        Stored vectors are used as queries. Returns one row per parameter value so we
+        can pick the cheapest setting that still meets a recall target; quantized
+        indexes also report recall and latency with exact re-scoring.
+        """
+        with self._rw.read():
+            generation = self._generation
+            live_ids = self.metadatas.ids()
+            live_ids = live_ids[live_ids < generation.next_id]
+            if len(live_ids) == 0:
+                return []
+            vectors = self.exact_vectors(live_ids, index=generation.index)
+            # Sweep search parameters on a copy, not on the index live queries are using
+            generation = generation._replace(index=faiss.clone_index(generation.index))
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(len(live_ids), size=min(n_queries, len(live_ids)), replace=False)]
+
+        started = time.time()
+        exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :k]
+        exact_ms = (time.time() - started) * 1000 / len(queries)
+        truth = [set(live_ids[row]) for row in exact]
+
+        kind = self.kind
+        if sweep is None:
+            sweep = {'ivfpq': [1, 4, 8, 16, 32, 64], 'hnsw': [16, 32, 64, 128, 256]}.get(kind, [None])
+        modes = [False, True] if self._can_rescore() else [False]
+        rows = []
+        for value in sweep:
+            self._apply_search_params(nprobe=value, ef_search=value, index=generation.index)
+            row = {
+                'index': kind,
+                'storage': self.storage,
+                'param': {'ivfpq': 'nprobe', 'hnsw': 'efSearch'}.get(kind),
+                'value': value,
+                'exact_ms': round(exact_ms, 3),
+            }
+            for rescore in modes:
+                started = time.time()
+                results = self._search(queries, k, rescore=rescore, generation=generation)
+                ann_ms = (time.time() - started) * 1000 / len(queries)
+                hits = sum(len(expected.intersection(i for i, _ in found)) for found, expected in zip(results, truth))
+                suffix = '_rescored' if rescore else ''
+                row['recall_at_k' + suffix] = round(hits / (k * len(queries)), 4)
+                row['ann_ms' + suffix] = round(ann_ms, 3)
+            rows.append(row)
+        return rows
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'index': self.kind,
+            'storage': self.storage,
+            'vectors': self.ntotal,
+            'tombstones': len(self.tombstones),
+            'wal_mb': round(self.wal_bytes() / (1024 * 1024), 2),
+            'memory_mb': round(self.memory_bytes() / (1024 * 1024), 2),
+        }
+
+    def reconstruct(self, ids, index=None) -> np.ndarray:
+        """Return the stored (normalized) vectors for ids, in order."""
+        index = index or self.index
+        if len(ids) == 0:
+            return np.zeros((0, self.dim), dtype='float32')
+        return np.vstack([index.reconstruct(int(i)) for i in ids]).astype('float32')
+
+    def exact_vectors(self, ids, index=None) -> np.ndarray:
+        """Full-precision vectors for ids, from the float copy when it has them (else from `index`)."""
+        if self.vectors is not None:
+            vectors = self.vectors.read(ids)
+            if vectors is not None:
+                return vectors
+        return self.reconstruct(ids, index=index)
+
+    def _can_rescore(self) -> bool:
+        return self.vectors is not None and self.storage != 'float'
+
+    def _search(self, queries: np.ndarray, top_k: int, rescore: bool = None, generation: Generation = None):
+        """[(id, score), ...] per normalized query row, skipping tombstones and unpublished ids.
+
+        Quantized indexes over-fetch and re-rank the candidates by exact inner product.
+        Call with the read lock held (or a generation nobody mutates).
+        """
+        index, tombstones, visible = generation or self._generation
+        if rescore is None:
+            rescore = self._can_rescore()
+        fetch = top_k * RESCORE_FACTOR if rescore else top_k
+        # Over-fetch so tombstoned and not-yet-published hits do not eat into top_k
+        k = min(fetch + len(tombstones) + max(0, self.next_id - visible), index.ntotal)
+        if k <= 0:
+            return [[] for _ in queries]
+        D, I = index.search(queries, k)
+        results = []
+        for q, scores, ids in zip(queries, D, I):
+            hits = [(int(i), float(d)) for d, i in zip(scores, ids)
+                    if 0 <= i < visible and int(i) not in tombstones][:fetch]
+            if rescore and hits:
+                floats = self.vectors.read([i for i, _ in hits])
+                if floats is not None:
+                    hits = sorted(zip([i for i, _ in hits], (floats @ q).tolist()), key=lambda h: h[1], reverse=True)
+            results.append(hits[:top_k])
+        return results
+
+    def update_metadata(self, ids: List[int], fields: Dict[str, Any]):
+        """Merge `fields` into the metadata of existing ids. Call persist() afterwards to save."""
+        ids = [int(i) for i in ids]
+        with self._write_lock:
+            if self._apply_update(ids, fields):
+                self._pending.append({'op': 'update', 'ids': ids, 'fields': fields})
+
+    def _apply_update(self, ids: List[int], fields: Dict[str, Any]) -> int:
+        return self.metadatas.update_many(ids, fields)
 
     def query(self, q_emb: np.ndarray, top_k: int = 5):
         if not FAISS_AVAILABLE:
             raise RuntimeError('FAISS not available')
-        faiss.normalize_L2(q_emb)
+        # Copy: normalize_L2 works in place and callers may reuse the query vector
+        q_emb = np.array(q_emb, dtype='float32')
         if q_emb.ndim == 1:
             q_emb = q_emb.reshape(1, -1)
-        D, I = self.index.search(q_emb.astype('float32'), top_k)
-        results = []
-        for score, idx in zip(D[0], I[0]):
-            if idx < 0:
-                continue
-            meta = self.metadatas.get(str(idx), {})
-            results.append({'score': float(score), 'metadata': meta, 'id': idx})
-        return results
+        faiss.normalize_L2(q_emb)
+        with self._rw.read():
+            hits = self._search(q_emb[:1], top_k)[0]
+            metas = self.metadatas.get_many([idx for idx, _ in hits], committed=True)
+        return [{'score': score, 'metadata': metas[idx], 'id': idx} for idx, score in hits if idx in metas]
+
+    def keyword_search(self, query_text: str, q_emb: np.ndarray, top_k: int = 5):
+        """BM25 hits from the chunk text index, scored (like query) by cosine similarity to q_emb."""
+        with self._rw.read():
+            ranked = self.metadatas.keyword_search(query_text, top_k)
+            if not ranked:
+                return []
+            ids = [i for i, _ in ranked]
+            metas = self.metadatas.get_many(ids, committed=True)
+            vectors = self.exact_vectors(ids, index=self._generation.index)
+        q = np.array(q_emb, dtype='float32').reshape(-1)
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        cosine = vectors @ q
+        return [{'score': float(c), 'bm25': bm25, 'metadata': metas[i], 'id': i}
+                for (i, bm25), c in zip(ranked, cosine) if i in metas]
+
+    def _commit(self):
+        """Commit the chunk table and publish the index state to searches, as one step for readers."""
+        with self._rw.write():
+            self.metadatas.commit()
+            self._publish()
+
+    def _publish(self):
+        self._generation = Generation(self.index, frozenset(self.tombstones), self.next_id)
 
-    def _persist(self):
+    def reading(self):
+        """Hold one generation (index + committed chunks) across several searches."""
+        return self._rw.read()
+
+    def wal_bytes(self) -> int:
+        return os.path.getsize(self.wal_path) if os.path.exists(self.wal_path) else 0
+
+    def persist(self):
+        """Make writes since the last call durable by appending them to the log.
+
+        Costs only the new data; the snapshot is rewritten once the log passes
+        RAG_WAL_CHECKPOINT_MB.
+        """
         try:
-            faiss.write_index(self.index, self.index_path)
+            with self._write_lock:
+                if self._pending:
+                    os.makedirs(os.path.dirname(self.wal_path) or '.', exist_ok=True)
+                    with open(self.wal_path, 'a', encoding='utf-8') as f:
+                        for record in self._pending:
+                            f.write(json.dumps(record) + '\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+                    self._pending = []
+                    # After the log, so the chunk table never holds a write the log lacks
+                    self._commit()
+                if self.wal_bytes() > WAL_CHECKPOINT_MB * 1024 * 1024:
+                    self.checkpoint()
         except Exception as e:
-            print(f"Warning: failed to persist faiss index: {e}")
+            print(f"Warning: failed to persist faiss store: {e}")
+
+    def checkpoint(self):
+        """Rewrite the index + metadata snapshot and truncate the log."""
+        # Index first, then metadata: a crash in between leaves orphan vectors that _reconcile drops
         try:
-            with open(self.meta_path, 'w', encoding='utf-8') as f:
-                json.dump(self.metadatas, f)
+            with self._write_lock:
+                write_index_atomic(self.index, self.index_path)
+                self._commit()
+                write_json_atomic(self.meta_path, {
+                    'next_id': self.next_id,
+                    'tombstones': sorted(self.tombstones),
+                })
+                # Everything logged is now in the snapshot (replay skips it if we crash before this)
+                self._pending = []
+                if os.path.exists(self.wal_path):
+                    os.remove(self.wal_path)
         except Exception as e:
-            print(f"Warning: failed to persist faiss metadata: {e}")
+            print(f"Warning: failed to checkpoint faiss store: {e}")
+
+
+def _runs(ids: np.ndarray):
+    """(start, stop) positions of runs of consecutive ids."""
+    start = 0
+    for n in range(1, len(ids) + 1):
+        if n == len(ids) or ids[n] != ids[n - 1] + 1:
+            yield start, n
+            start = n
+
+
+# Every open store, so pending logs are folded into snapshots on shutdown
+_OPEN_STORES = weakref.WeakSet()
+
+
+@atexit.register
+def checkpoint_all():
+    for store in list(_OPEN_STORES):
+        if store.wal_bytes() or store._pending:
+            store.checkpoint()
+
+
+def reciprocal_rank_fusion(rankings: List[List[Dict[str, Any]]], k: int = None) -> List[Dict[str, Any]]:
+    """Merge ranked hit lists: each hit scores sum(1 / (k + rank)) over the lists it appears in."""
+    k = RRF_K if k is None else k
+    fused = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            key = (hit['metadata'].get('bucket'), hit['id'])
+            entry = fused.setdefault(key, dict(hit, rrf=0.0))
+            entry['rrf'] += 1.0 / (k + rank)
+            if 'bm25' in hit:
+                entry['bm25'] = hit['bm25']
+    return sorted(fused.values(), key=lambda h: h['rrf'], reverse=True)
+
+
+def _safe_dirname(name: str) -> str:
+    safe = re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_')[:40] or 'index'
+    return f"{safe}-{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+
+
+class NoteIndex:
+    """An index directory holding one FaissStore shard per bucket plus a document manifest.
+
+    Searching a bucket only scans that bucket's vectors; "All Notes" merges the
+    per-shard results. The manifest maps doc_id -> {"hash", "bucket", "filename",
+    "chunks": {chunk_hash: vector_id}} and is written after the shards it describes.
+
+    One writer at a time (upsert/delete); searches take no NoteIndex lock. The manifest
+    is copy-on-write: writers publish a new dict, so readers never see it change under them.
+    """
+
+    # Rebuild a shard once this share of its vectors are tombstones (deleted/stale chunks)
+    COMPACT_TOMBSTONE_RATIO = float(os.environ.get('RAG_COMPACT_RATIO', '0.2'))
+    COMPACT_MIN_TOMBSTONES = int(os.environ.get('RAG_COMPACT_MIN', '64'))
+
+    def __init__(self, index_dir: str, dim: int = 384):
+        self.index_dir = index_dir
+        self.dim = dim
+        self.manifest_path = os.path.join(index_dir, 'manifest.json')
+        self.manifest = {}
+        self.shards = {}  # bucket -> FaissStore, opened lazily
+        self._shards_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._maintenance_tasks = {}
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    self.manifest = json.load(f)
+            except Exception as e:
+                print(f"[RAG] Manifest unreadable ({e}); notes will be re-embedded.")
+                self.manifest = {}
+        self._migrate_single_index()
+
+    def _migrate_single_index(self):
+        """Split a pre-sharding index (index_dir/faiss.index) into bucket shards without re-embedding."""
+        legacy_index = os.path.join(self.index_dir, 'faiss.index')
+        legacy_meta = os.path.join(self.index_dir, 'faiss_meta.json')
+        if not os.path.exists(legacy_index):
+            return
+        legacy = FaissStore(dim=self.dim, index_path=legacy_index, meta_path=legacy_meta, mmap=False)
+        by_bucket = {}
+        for i, meta in legacy.metadatas.where():
+            by_bucket.setdefault(meta.get('bucket', 'Uncategorized'), []).append(i)
+
+        id_map = {}
+        for bucket, ids in by_bucket.items():
+            metas = legacy.metadatas.get_many(ids)
+            new_ids = self.shard(bucket).add(legacy.exact_vectors(ids), [metas[i] for i in ids])
+            id_map.update(zip(ids, new_ids))
+        for entry in self.manifest.values():
+            if 'chunks' in entry:
+                entry['chunks'] = {h: id_map[int(i)] for h, i in entry['chunks'].items() if int(i) in id_map}
+        self._save_manifest()
+
+        os.remove(legacy_index)
+        for path in (legacy_meta, legacy.wal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        if legacy.vectors is not None:
+            legacy.vectors.remove()
+        legacy.metadatas.remove()
+        print(f"[RAG] Migrated single index into {len(by_bucket)} bucket shards.")
+
+    def _save_manifest(self):
+        write_json_atomic(self.manifest_path, self.manifest)
+
+    def shard(self, bucket: str) -> FaissStore:
+        store = self.shards.get(bucket)
+        if store is None:
+            # Two threads opening one shard would give two stores writing the same files
+            with self._shards_lock:
+                store = self.shards.get(bucket)
+                if store is None:
+                    shard_dir = os.path.join(self.index_dir, 'shards', _safe_dirname(bucket))
+                    store = FaissStore(
+                        dim=self.dim,
+                        index_path=os.path.join(shard_dir, 'faiss.index'),
+                        meta_path=os.path.join(shard_dir, 'faiss_meta.json'),
+                    )
+                    self.shards[bucket] = store
+        return store
+
+    def buckets(self) -> List[str]:
+        return sorted({e.get('bucket', 'Uncategorized') for e in self.manifest.values()})
+
+    def _publish_manifest(self, doc_id: str, entry: Dict[str, Any] = None):
+        """Save and swap in a copy of the manifest with doc_id set to entry (removed when None)."""
+        manifest = dict(self.manifest)
+        if entry is None:
+            manifest.pop(doc_id, None)
+        else:
+            manifest[doc_id] = entry
+        write_json_atomic(self.manifest_path, manifest)
+        self.manifest = manifest
+
+    @property
+    def ntotal(self) -> int:
+        """Live vectors. Shards not opened yet are counted from the manifest, so this loads nothing."""
+        with self._shards_lock:
+            opened = dict(self.shards)
+        total = sum(store.ntotal for store in opened.values())
+        legacy = set()
+        for entry in self.manifest.values():
+            bucket = entry.get('bucket', 'Uncategorized')
+            if bucket in opened:
+                continue
+            if 'chunks' in entry:
+                total += len(entry['chunks'])
+            else:
+                legacy.add(bucket)  # older manifest without chunk ids: only the shard knows
+        return total + sum(self.shard(b).ntotal for b in legacy)
+
+    def is_current(self, doc_id: str, text: str) -> bool:
+        entry = self.manifest.get(doc_id)
+        return bool(entry) and entry.get('hash') == content_hash(text)
+
+    def chunk_ids(self, doc_id: str):
+        """Return ({chunk_hash: vector_id}, [duplicate ids]) for what is indexed under doc_id."""
+        entry = self.manifest.get(doc_id)
+        if not entry:
+            return {}, []
+        if 'chunks' in entry:
+            return {h: int(i) for h, i in entry['chunks'].items()}, []
+        # Older manifests did not track chunks: recover them from the stored metadata
+        by_hash, duplicates = {}, []
+        for i, meta in self.shard(entry.get('bucket', 'Uncategorized')).metadatas.where(doc_id=doc_id):
+            h = content_hash(meta.get('text', ''))
+            if h in by_hash:
+                duplicates.append(i)
+            else:
+                by_hash[h] = i
+        return by_hash, duplicates
+
+    @staticmethod
+    def _holding(*stores):
+        """Hold the shards' write locks across a document's remove + add, so a background
+        compaction or promotion cannot checkpoint (and publish) the update half done."""
+        held = ExitStack()
+        for store in {id(s): s for s in stores if s is not None}.values():
+            held.enter_context(store._write_lock)
+        return held
+
+    def upsert(self, doc_id: str, text: str, chunks: Dict[str, str], bucket: str, filename: str, embed_fn,
+               chunk_fields: Dict[str, Dict[str, Any]] = None) -> int:
+        """Bring doc_id in line with `chunks` ({chunk_hash: text}). Returns the number of chunks embedded.
+
+        chunk_fields ({chunk_hash: {...}}) adds per-chunk metadata such as character offsets.
+        """
+        with self._write_lock:
+            chunk_fields = chunk_fields or {}
+            entry = self.manifest.get(doc_id)
+            old_store = self.shard(entry.get('bucket', 'Uncategorized')) if entry else None
+            store = self.shard(bucket)
+
+            existing, duplicates = self.chunk_ids(doc_id)
+            kept = {h: i for h, i in existing.items() if h in chunks}
+            stale = [i for h, i in existing.items() if h not in chunks] + duplicates
+            new = [(h, t) for h, t in chunks.items() if h not in kept]
+
+            fields = {"bucket": bucket, "filename": filename, "doc_id": doc_id}
+            vectors, hashes = [], []
+            if old_store is not None and old_store is not store and kept:
+                # Bucket changed: move unchanged vectors to the new shard instead of re-embedding
+                vectors.append(old_store.exact_vectors(list(kept.values())))
+                hashes += list(kept.keys())
+                stale += list(kept.values())
+                kept = {}
+            if new:
+                vectors.append(embed_fn([t for _, t in new]))
+                hashes += [h for h, _ in new]
+
+            with self._holding(old_store, store):
+                if old_store is not None:
+                    old_store.remove(stale)
+                    if old_store is not store:
+                        old_store.persist()
+                if chunk_fields:
+                    # Kept chunks may have moved within the document
+                    for h, i in kept.items():
+                        store.update_metadata([i], dict(fields, **chunk_fields.get(h, {})))
+                else:
+                    store.update_metadata(list(kept.values()), fields)
+                if vectors:
+                    metas = [dict(fields, text=chunks[h], **chunk_fields.get(h, {})) for h in hashes]
+                    ids = store.add(np.vstack(vectors), metas, persist=False)
+                    kept.update(zip(hashes, ids))
+                store.persist()
+
+            self._publish_manifest(doc_id, {"hash": content_hash(text), "bucket": bucket, "filename": filename, "chunks": kept})
+
+        print(f"[RAG] Upsert {doc_id} -> {bucket}: {len(new)} embedded, {len(kept) - len(new)} reused, {len(stale)} removed")
+        for s in {id(old_store): old_store, id(store): store}.values():
+            self._maybe_compact(s)
+        self._maybe_promote(store)
+        return len(new)
+
+    def delete(self, doc_id: str) -> int:
+        """Tombstone every chunk of a document. Returns the number of chunks removed."""
+        with self._write_lock:
+            entry = self.manifest.get(doc_id)
+            if not entry:
+                return 0
+            existing, duplicates = self.chunk_ids(doc_id)
+            ids = list(existing.values()) + duplicates
+            store = self.shard(entry.get('bucket', 'Uncategorized'))
+            with self._holding(store):
+                store.remove(ids)
+                store.persist()
+            self._publish_manifest(doc_id)
+
+        print(f"[RAG] Deleted {doc_id}: {len(ids)} chunks tombstoned")
+        self._maybe_compact(store)
+        return len(ids)
+
+    def search(self, q_emb: np.ndarray, bucket: str = None, top_k: int = 5, query_text: str = None):
+        """Search one bucket's shard, or every shard (merged by score) when bucket is None.
+
+        With query_text (and RAG_HYBRID on), BM25 keyword hits are fused with the dense
+        hits by reciprocal-rank fusion; hits then come back in fused order with an
+        'rrf' value, and 'score' stays the cosine similarity.
+        """
+        buckets = self.buckets()
+        if bucket is not None:
+            buckets = [bucket] if bucket in buckets else []
+        dense, keyword = [], []
+        for b in buckets:
+            store = self.shard(b)
+            # Dense and keyword hits from the same published state of the shard
+            with store.reading():
+                dense.extend(store.query(q_emb, top_k=top_k))
+                if query_text and HYBRID_SEARCH:
+                    keyword.extend(store.keyword_search(query_text, q_emb, top_k=top_k))
+        dense.sort(key=lambda h: h['score'], reverse=True)
+        if not keyword:
+            return dense[:top_k]
+        keyword.sort(key=lambda h: h['bm25'], reverse=True)
+        return reciprocal_rank_fusion([dense[:top_k], keyword[:top_k]])[:top_k]
+
+    def compact(self) -> int:
+        return sum(self.shard(b).compact() for b in list(self.shards))
+
+    def memory_bytes(self) -> int:
+        return sum(store.memory_bytes() for store in list(self.shards.values()))
+
+    def maintenance_pending(self) -> bool:
+        """True while a compaction or ANN promotion is queued or running on one of the shards."""
+        return any(background.get_task_status(task_id)['status'] in ('pending', 'running')
+                   for task_id in list(self._maintenance_tasks.values()))
+
+    def _schedule(self, store, job: str, fn):
+        """Run a maintenance job for a shard in the background, at most one per (shard, job)."""
+        key = (store.index_path, job)
+        task_id = self._maintenance_tasks.get(key)
+        if task_id and background.get_task_status(task_id)['status'] in ('pending', 'running'):
+            return
+        self._maintenance_tasks[key] = background.submit_task(fn)
+        print(f"[RAG] Scheduled {job} of {store.index_path}")
+
+    def _maybe_compact(self, store):
+        """Schedule a background rebuild once a shard's tombstones pass the threshold."""
+        if store is None or len(store.tombstones) < self.COMPACT_MIN_TOMBSTONES:
+            return
+        if store.tombstone_ratio < self.COMPACT_TOMBSTONE_RATIO:
+            return
+        self._schedule(store, 'compaction', store.compact)
+
+    def _maybe_promote(self, store):
+        """Switch a shard from exact to ANN search once it passes RAG_ANN_THRESHOLD chunks."""
+        if store.should_promote():
+            self._schedule(store, 'ANN promotion', store.promote)
+
+    def index_report(self, benchmark: bool = False) -> Dict[str, Any]:
+        report = {}
+        for bucket in self.buckets():
+            store = self.shard(bucket)
+            report[bucket] = store.stats()
+            if benchmark:
+                report[bucket]['recall_latency'] = store.recall_latency_report()
+        return report
+
+
+class TenantIndexes:
+    """Per-user NoteIndexes, loaded from disk on first use and evicted LRU-first over a memory budget.
+
+    user_id None is the shared index at the root of index_dir (notes indexed without
+    an owner); each user gets index_dir/users/<user>/. Indexes are persisted on every
+    write, so eviction just drops the in-memory copy. Use `with tenants.use(user_id)`
+    so an index is not evicted (and reloaded as a second copy) while it is being used.
+    An index with background compaction or ANN promotion still pending also stays:
+    that task checkpoints the shard, which would overwrite a reloaded copy's writes.
+    """
+
+    MEMORY_BUDGET_MB = float(os.environ.get('RAG_MEMORY_BUDGET_MB', '512'))
+
+    def __init__(self, index_dir: str, dim: int = 384, memory_budget_mb: float = None):
+        self.index_dir = index_dir
+        self.dim = dim
+        budget = memory_budget_mb if memory_budget_mb is not None else self.MEMORY_BUDGET_MB
+        self.budget_bytes = int(budget * 1024 * 1024)
+        self._resident = OrderedDict()  # user key -> NoteIndex, least recently used first
+        self._pins = {}
+        self._loading = {}  # user key -> Event set when its cold load finishes
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+
+    def _dir_for(self, key):
+        if key is None:
+            return self.index_dir
+        return os.path.join(self.index_dir, 'users', _safe_dirname(key))
+
+    @contextmanager
+    def use(self, user_id=None):
+        key = str(user_id) if user_id else None
+        index = self._pin(key)
+        try:
+            yield index
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+                self._evict()
+
+    def _pin(self, key):
+        """Pin the index for key, loading it if needed. A cold load (disk, log replay,
+        migration) runs outside self._lock, so other users' indexes stay usable meanwhile;
+        other threads wanting the same user wait for that one load."""
+        while True:
+            with self._lock:
+                index = self._resident.get(key)
+                if index is not None:
+                    self._resident.move_to_end(key)
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                    return index
+                loading = self._loading.get(key)
+                loader = loading is None
+                if loader:
+                    loading = self._loading[key] = threading.Event()
+            if not loader:
+                loading.wait()
+                continue
+            try:
+                index = NoteIndex(self._dir_for(key), dim=self.dim)
+                with self._lock:
+                    self._resident[key] = index
+                    self.loads += 1
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                    self._evict()
+                return index
+            finally:
+                with self._lock:
+                    del self._loading[key]
+                loading.set()
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(index.memory_bytes() for index in self._resident.values())
+
+    def _evict(self):
+        while self.memory_bytes() > self.budget_bytes:
+            # Oldest index nobody is using and no maintenance task holds; the most recent one always stays
+            victims = [k for k in list(self._resident)[:-1]
+                       if k not in self._pins and not self._resident[k].maintenance_pending()]
+            if not victims:
+                return
+            del self._resident[victims[0]]
+            self.evictions += 1
+            print(f"[RAG] Evicted index for user {victims[0]} (budget {self.budget_bytes // (1024 * 1024)}MB)")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "resident": len(self._resident),
+                "memory_mb": round(self.memory_bytes() / (1024 * 1024), 1),
+                "budget_mb": self.budget_bytes // (1024 * 1024),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
 
 
 # Simple singleton wrapper
@@ -1,10 +1,12 @@
 import { useState } from "react";
 import { DashboardLayout } from "@/components/DashboardLayout";
+import { useAuth } from "@/contexts/AuthContext";
 import { MessageSquare, Loader2, FileStack, Send } from "lucide-react";
 
 const subjects = ["All Notes", "Mathematics", "Physics", "Chemistry", "Biology", "History"];
 
 const AskNotesPage = () => {
+  const { user } = useAuth();
   const [question, setQuestion] = useState("");
   const [subject, setSubject] = useState("All Notes");
   const [isLoading, setIsLoading] = useState(false);
@@ -21,7 +23,7 @@ const AskNotesPage = () => {
       const response = await fetch('/api/ask-notes', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ question: currentQuestion, subject })
+        body: JSON.stringify({ question: currentQuestion, subject, userId: user?.id })
       });
       const data = await response.json();
 
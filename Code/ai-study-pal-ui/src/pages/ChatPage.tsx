@@ -172,7 +172,6 @@ const ChatPage = () => {
       const apiKeys = storedKeys ? JSON.parse(storedKeys) : {};
       const key = provider === "gemini" ? apiKeys.gemini : (provider === "openai" ? apiKeys.openai : undefined);
 
-      // Use streaming is NOT supported by Flask simple backend yet, so standard fetch
       const activeBucketId = bucketId || bucketIdFromUrl;
       const activeBucket = buckets.find(b => b.id === activeBucketId);
 
@@ -192,20 +191,50 @@ const ChatPage = () => {
           useNotes,
           bucketId: activeBucketId,
           bucketName: safeBucketName, // Send safe name
+          userId: user?.id,
           history: messages.slice(-10).map((m) => ({
             role: m.role,
             content: m.content,
           })),
           provider,
-          provider_options: { api_key: key }
+          provider_options: { api_key: key },
+          stream: true
         })
       });
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         throw new Error(`HTTP ${response.status}`);
       }
 
-      const data = await response.json();
+      // Server-Sent Events: "token" events as the model generates, then one "done"
+      // event carrying the final (trimmed) reply and sources
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let streamed = "";
+      let data: { content?: string; sources?: Message["sources"] } | null = null;
+      while (!data) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split("\n\n");
+        buffer = events.pop() || "";
+        for (const raw of events) {
+          if (!raw.startsWith("data: ")) continue;
+          const event = JSON.parse(raw.slice(6));
+          if (event.type === "token") {
+            streamed += event.content;
+            setStreamingContent(streamed);
+          } else if (event.type === "done") {
+            data = event;
+          } else if (event.type === "error") {
+            throw new Error(event.error);
+          }
+        }
+      }
+      if (!data) {
+        throw new Error("Stream ended without a reply");
+      }
 
       // Finalize message
       const aiMessage: Message = {
@@ -155,7 +155,9 @@ const NotesPage = () => {
           body: JSON.stringify({
             title: newNoteTitle.trim(),
             content: newNoteContent.trim(),
-            bucket: selectedBucket.name
+            bucket: selectedBucket.name,
+            noteId: data.id,
+            userId: user.id
           })
         });
       } catch (err) {
@@ -210,10 +212,30 @@ const NotesPage = () => {
 
         if (uploadError) throw uploadError;
 
+        // Create the note first so the index is keyed by its id (DELETE /api/notes/<id> finds its chunks)
+        const { data, error } = await supabase
+          .from('notes')
+          .insert([{
+            title: file.name.replace(/\.[^/.]+$/, ""),
+            content: `[Indexed for AI] ${file.name}`,
+            file_path: filePath,
+            bucket_id: selectedBucket.id,
+            user_id: user.id
+          }])
+          .select()
+          .single();
+
+        if (error) throw error;
+
+        setNotes([data, ...notes]);
+        toast.success("File uploaded!");
+
         // --- NEW: Send to Python Backend for RAG Indexing ---
         const formData = new FormData();
         formData.append('file', file);
         formData.append('bucketName', selectedBucket.name);
+        formData.append('userId', user.id);
+        formData.append('noteId', data.id);
 
         try {
           const indexRes = await fetch('/api/upload', {
@@ -232,23 +254,6 @@ const NotesPage = () => {
         }
         // ----------------------------------------------------
 
-        const { data, error } = await supabase
-          .from('notes')
-          .insert([{
-            title: file.name.replace(/\.[^/.]+$/, ""),
-            content: `[Indexed for AI] ${file.name}`,
-            file_path: filePath,
-            bucket_id: selectedBucket.id,
-            user_id: user.id
-          }])
-          .select()
-          .single();
-
-        if (error) throw error;
-
-        setNotes([data, ...notes]);
-        toast.success("File uploaded!");
-
         // We can skip the supabase function 'parse-document' if we rely on local python now.
         // But keeping it logic-free for now to avoid breaking existing flow if any.
 
@@ -278,6 +283,13 @@ const NotesPage = () => {
       toast.error("Failed to delete note");
       console.error(error);
     } else {
+      // Drop the note's vectors from the RAG index
+      try {
+        await fetch(`/api/notes/${note.id}?userId=${encodeURIComponent(user?.id ?? '')}`, { method: 'DELETE' });
+      } catch (err) {
+        console.error("Failed to remove note from index:", err);
+      }
+
       setNotes(notes.filter(n => n.id !== note.id));
       toast.success("Note deleted");
     }
@@ -507,7 +519,7 @@ const NotesPage = () => {
                           const res = await fetch('/api/reprocess', {
                             method: 'POST',
                             headers: { 'Content-Type': 'application/json' },
-                            body: JSON.stringify({ filePath: note.file_path, noteId: note.id })
+                            body: JSON.stringify({ filePath: note.file_path, noteId: note.id, userId: user?.id })
                           });
                           if (!res.ok) throw new Error("Reprocess failed");
 
@@ -0,0 +1,102 @@
+import sys
+import os
+import json
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+class StubProvider:
+    """Streams scripted pieces and records how far the consumer read."""
+    def __init__(self, pieces, fail=False):
+        self.model_id = "stub-chat"
+        self.sampling = {"temperature": 0.3}
+        self.pieces = pieces
+        self.fail = fail
+        self.streams = 0
+        self.pulled = 0
+        self.closed = False
+    def stream(self, prompt, max_tokens=200, feature=None, constraint=None):
+        self.streams += 1
+        if self.fail:
+            raise RuntimeError("model not loaded")
+        try:
+            for piece in self.pieces:
+                self.pulled += 1
+                yield piece
+        except GeneratorExit:
+            self.closed = True
+            raise
+    def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
+        return ''.join(self.stream(prompt, max_tokens, feature, constraint))
+
+def read_events(response):
+    body = response.get_data(as_text=True)
+    return [json.loads(line[len("data: "):]) for line in body.split("\n\n") if line.startswith("data: ")]
+
+def test_chat_stream():
+    print("\n--- Testing Streaming Chat (SSE) ---")
+    try:
+        import llm_providers
+        from app import app
+
+        client = app.test_client()
+        provider = StubProvider(["Hi", " there", "!", "\n\n", "User:", " what else", " can", " I", " ask?"])
+        llm_providers.get_provider = lambda name, **options: provider
+
+        # 1. Tokens arrive as events and add up to the trimmed reply; the rest is never generated
+        print("1. Testing Token Events...")
+        response = client.post('/api/chat', json={"message": "Say hi to the stream check", "stream": True})
+        events = read_events(response)
+        tokens = ''.join(e["content"] for e in events if e["type"] == "token")
+        done = events[-1] if events else {}
+        if (response.mimetype == 'text/event-stream' and tokens == "Hi there!" and done.get("type") == "done"
+                and done.get("content") == "Hi there!" and done["metadata"]["source"] == "ai"):
+            print(f"PASS: {len(events) - 1} token events, done event carries the same reply.")
+        else:
+            print(f"FAIL: mimetype={response.mimetype} tokens={tokens!r} done={done}")
+        if provider.closed and provider.pulled == 4:
+            print("PASS: Stream closed at the paragraph break.")
+        else:
+            print(f"FAIL: closed={provider.closed} pulled={provider.pulled}")
+
+        # 2. Accept: text/event-stream selects the same path; a repeated message comes from the cache
+        print("\n2. Testing Accept Header + Cache...")
+        from response_cache import get_response_cache
+        response = client.post('/api/chat', json={"message": "Say hi to the stream check"},
+                               headers={"Accept": "text/event-stream"})
+        events = read_events(response)
+        if get_response_cache() is None:
+            print("SKIP: LLM_CACHE=0")
+        elif provider.streams == 1 and [e["type"] for e in events] == ["token", "done"] and events[-1]["content"] == "Hi there!":
+            print("PASS: Repeat served from the cache without streaming.")
+        else:
+            print(f"FAIL: streams={provider.streams} events={events}")
+
+        # 3. A canned opening is replaced by the fallback, and nothing of it is shown
+        print("\n3. Testing Canned Openings...")
+        provider = StubProvider(["Sure", ", here", " is a", " script:", " print('hi')"])
+        from ml_utils import FALLBACK_REPLY
+        events = read_events(client.post('/api/chat', json={"message": "Write me a greeting script", "stream": True}))
+        if [e["type"] for e in events] == ["done"] and events[0]["content"] == FALLBACK_REPLY:
+            print("PASS: Canned opening replaced before any token was sent.")
+        else:
+            print(f"FAIL: events={events}")
+
+        # 4. Provider failures end the stream with an error event
+        print("\n4. Testing Error Events...")
+        provider = StubProvider([], fail=True)
+        events = read_events(client.post('/api/chat', json={"message": "Anything failing?", "stream": True}))
+        if len(events) == 1 and events[0]["type"] == "error" and "model not loaded" in events[0]["error"]:
+            print("PASS: Error reported as an event.")
+        else:
+            print(f"FAIL: events={events}")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_chat_stream()
@@ -0,0 +1,73 @@
+import sys
+import os
+import hashlib
+import tempfile
+import threading
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+def fake_embed(texts):
+    # Stable per-text vectors; the check is about visibility, not ranking
+    import numpy as np
+    return np.vstack([
+        np.random.default_rng(int(hashlib.sha256(t.encode('utf-8')).hexdigest()[:8], 16)).standard_normal(384)
+        for t in texts
+    ]).astype('float32')
+
+def chunks_of(version):
+    texts = [f"{version}: chunk {i} of the Krebs cycle note." for i in range(4)]
+    return {hashlib.sha256(t.encode('utf-8')).hexdigest(): t for t in texts}
+
+def test_compaction_during_upsert():
+    print("\n--- Testing Compaction During Upsert ---")
+    try:
+        from vector_store import NoteIndex
+
+        index = NoteIndex(tempfile.mkdtemp(prefix="rag_generations_"))
+        for version in ("v1", "v2"):
+            index.upsert("note-1", version, chunks_of(version), "Biology", "krebs.txt", fake_embed)
+        store = index.shard("Biology")
+        query = fake_embed(["Krebs cycle"])[0]
+
+        # 1. Start a compaction between the upsert's remove and add, and look at what searches see
+        print("1. Compacting mid-upsert...")
+        seen = {}
+        add = store.add
+
+        def add_during_compaction(*args, **kwargs):
+            compaction = threading.Thread(target=store.compact)
+            compaction.start()
+            compaction.join(timeout=0.5)
+            seen['compaction'] = compaction
+            seen['blocked'] = compaction.is_alive()
+            seen['visible'] = {h['metadata']['text'][:2] for h in index.search(query, "Biology", top_k=10)}
+            return add(*args, **kwargs)
+
+        store.add = add_during_compaction
+        index.upsert("note-1", "v3", chunks_of("v3"), "Biology", "krebs.txt", fake_embed)
+        store.add = add
+        seen['compaction'].join()
+
+        if seen['blocked'] and seen['visible'] == {"v2"}:
+            print("PASS: Compaction waited; searches saw the previous version, not a half-applied update.")
+        else:
+            print(f"FAIL: blocked={seen['blocked']} visible={seen['visible']}")
+
+        # 2. Once both finish, only the new version is searchable and the tombstones are gone
+        print("\n2. After the upsert...")
+        visible = {h['metadata']['text'][:2] for h in index.search(query, "Biology", top_k=10)}
+        if visible == {"v3"} and not store.tombstones:
+            print("PASS: New version published, compaction dropped the tombstones.")
+        else:
+            print(f"FAIL: visible={visible} tombstones={len(store.tombstones)}")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_compaction_during_upsert()
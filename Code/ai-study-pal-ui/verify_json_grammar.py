@@ -0,0 +1,53 @@
+import sys
+import os
+import json
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+def accepts(constraint, text):
+    state = constraint.feed(constraint.start(), text)
+    return state is not None and constraint.complete(state)
+
+def test_json_grammar():
+    print("\n--- Testing JSON Constraint ---")
+    try:
+        from json_grammar import JSONConstraint
+
+        # 1. Integers: no leading zeros, so everything accepted is valid JSON
+        print("1. Testing Integers...")
+        number = JSONConstraint({"type": "integer"})
+        good = ["0", "-0", "7", "12", "-305"]
+        bad = ["012", "-012", "00", "-", "1-"]
+        wrong = [t for t in good if not accepts(number, t)] + [t for t in bad if accepts(number, t)]
+        if not wrong and all(json.loads(t) == int(t) for t in good):
+            print("PASS: Leading zeros rejected.")
+        else:
+            print(f"FAIL: misjudged {wrong}")
+
+        # 2. A document ending in an integer is complete without a closing character
+        print("\n2. Testing Root Integer Completion...")
+        started = number.feed(number.start(), "-")
+        if number.complete(number.feed(number.start(), "42")) and not number.complete(started):
+            print("PASS: Root integer completes once it has a digit.")
+        else:
+            print("FAIL: Root integer completion.")
+
+        # 3. Integers inside an object still hand the next character to the object
+        print("\n3. Testing Nested Integers...")
+        schema = {"type": "object", "properties": {"day": {"type": "integer"}, "done": {"type": "boolean"}}}
+        record = JSONConstraint(schema)
+        if accepts(record, '{"day": 10, "done": true}') and not accepts(record, '{"day": 010, "done": true}'):
+            print("PASS: Nested integers follow JSON.")
+        else:
+            print("FAIL: Nested integers.")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_json_grammar()
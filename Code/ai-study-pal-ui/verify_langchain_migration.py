@@ -26,7 +26,7 @@ def test_langchain_migration():
         print("\n2. Testing Positive Query (Bucket: AI Frameworks)...")
         
         class MockProvider:
-            def generate(self, p, max_tokens=200):
+            def generate(self, p, max_tokens=200, feature=None, constraint=None):
                 return "LangChain is an AI framework."
         
         res, sources = rag_system.query("What is LangChain?", subject_filter="AI Frameworks", llm_module=MockProvider())
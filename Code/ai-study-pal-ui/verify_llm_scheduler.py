@@ -0,0 +1,178 @@
+import sys
+import os
+import time
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+def stub_engine(delay=0.01, words=None):
+    """An engine whose 'model' emits token n as words[n] (else 'w<n> '), one per step, until max_tokens."""
+    from llm_scheduler import _Engine, _Sequence
+
+    class StubEngine(_Engine):
+        def __init__(self):
+            self.batches = []  # features in each decode step
+            self.starts = []   # (feature, tokens already generated) per start
+            self.generated = {}
+
+        def start(self, request):
+            self.starts.append((request.feature, len(request.output)))
+            return _Sequence(request)
+
+        def step(self, seqs):
+            time.sleep(delay)
+            self.batches.append([seq.request.feature for seq in seqs])
+            finished = []
+            for seq in seqs:
+                request = seq.request
+                request.output.append(len(request.output))
+                self.generated[request.feature] = self.generated.get(request.feature, 0) + 1
+                text = ''.join(words[t] if words and t < len(words) else f"w{t} " for t in request.output)
+                if self._advance(seq, text) or len(request.output) >= request.max_tokens:
+                    finished.append(seq)
+            return finished
+
+    return StubEngine()
+
+class FakeGGUF:
+    """Just enough of a ctransformers model: one context, rewound to the shared prefix by prepare."""
+    def __init__(self, reply):
+        self.context = []
+        self.reply = reply
+        self.n = 0
+        self.logits = []
+    def tokenize(self, text):
+        return [ord(c) for c in text]
+    def detokenize(self, tokens, decode=True):
+        text = ''.join(chr(t) for t in tokens)
+        return text if decode else text.encode('utf-8')
+    def prepare_inputs_for_generation(self, tokens, reset=True):
+        shared = 0
+        while shared < min(len(tokens), len(self.context)) and tokens[shared] == self.context[shared]:
+            shared += 1
+        self.context = self.context[:shared]
+        self.n = 0
+        return tokens[shared:]
+    def eval(self, tokens):
+        self.context += list(tokens)
+    def sample(self, temperature=0.3, top_p=0.9):
+        token = ord(self.reply[self.n]) if self.n < len(self.reply) else 0
+        self.n += 1
+        return token
+    def is_eos_token(self, token):
+        return token == 0
+
+def test_llm_scheduler():
+    print("\n--- Testing Local LLM Scheduler ---")
+    try:
+        from llm_scheduler import LLMScheduler, TokenBudget, GGUFEngine, GenerationRequest, decode, system_prefix
+
+        # 1. Continuous batching: requests join a running batch and leave it as they finish
+        print("1. Testing Continuous Batching...")
+        engine = stub_engine()
+        scheduler = LLMScheduler([engine], max_batch=4)
+        long_one = scheduler.submit("long", max_tokens=30, feature="tips")
+        short_one = scheduler.submit("short", max_tokens=3, feature="summary")
+        wait_for(lambda: len(long_one.output) >= 5)
+        late = scheduler.submit("late", max_tokens=5, feature="plan")
+        results = [r.done.result(timeout=10) for r in (long_one, short_one, late)]
+        joined = any(set(b) == {"tips", "plan"} for b in engine.batches)
+        left = short_one.done.done() and any(b == ["tips"] for b in engine.batches[:10])
+        if joined and left and len(long_one.output) == 30 and results[1] == "w0 w1 w2 ":
+            print(f"PASS: Late request joined mid-run, finished ones left (mean batch {scheduler.stats()['mean_batch']}).")
+        else:
+            print(f"FAIL: joined={joined} left={left} batches={engine.batches[:12]}")
+
+        # 2. Preemption: a chat arriving while a quiz holds the only slot runs first; the quiz resumes
+        print("\n2. Testing Preemption + Resume...")
+        engine = stub_engine()
+        scheduler = LLMScheduler([engine], max_batch=1)
+        quiz = scheduler.submit("quiz", max_tokens=40, feature="quiz")
+        wait_for(lambda: len(quiz.output) >= 5)
+        chat = scheduler.submit("hi", max_tokens=4, feature="chat")
+        chat.done.result(timeout=10)
+        quiz_running = not quiz.done.done()
+        quiz.done.result(timeout=10)
+        resumed = [kept for feature, kept in engine.starts if feature == "quiz"]
+        if (quiz_running and scheduler.stats()['preemptions'] == 1 and len(resumed) == 2 and resumed[1] >= 5
+                and engine.generated["quiz"] == 40 and len(quiz.output) == 40):
+            print(f"PASS: Chat preempted the quiz, which resumed with its {resumed[1]} tokens kept.")
+        else:
+            print(f"FAIL: preemptions={scheduler.stats()['preemptions']} starts={engine.starts} generated={engine.generated}")
+
+        # 3. Early stop: a chat reply ends at the paragraph break instead of at max_tokens
+        print("\n3. Testing Feature Stop...")
+        engine = stub_engine(delay=0, words=["Hi", " there", "!", "\n\n", "User:", " more"])
+        scheduler = LLMScheduler([engine], max_batch=1)
+        reply = scheduler.generate("hi", max_tokens=50, feature="chat")
+        if reply == "Hi there!" and engine.generated["chat"] == 4:
+            print("PASS: Chat stopped at the paragraph break.")
+        else:
+            print(f"FAIL: reply={reply!r} generated={engine.generated}")
+
+        # 4. Prefix reuse: a second prompt with the same system block only evaluates its user turn
+        print("\n4. Testing System-Prompt Prefix Reuse (GGUF)...")
+        system = "<|system|>\nYou are AI Study Pal, a helpful student companion.\n</s>\n<|user|>\n"
+        engine = GGUFEngine(FakeGGUF("Hello."))
+        first = decode(engine, GenerationRequest(system + "What is osmosis?</s>\n<|assistant|>\n", max_tokens=20))
+        engine.llm.n = 0
+        second_prompt = system + "Define mitosis.</s>\n<|assistant|>\n"
+        decode(engine, GenerationRequest(second_prompt, max_tokens=20))
+        stats = engine.stats()
+        reused = stats['prefix_tokens_reused']
+        if first == "Hello." and reused >= len(system_prefix(second_prompt)) and reused < len(second_prompt):
+            print(f"PASS: {reused} prompt tokens reused, {stats['prefill_tokens']} prefilled in total.")
+        else:
+            print(f"FAIL: first={first!r} stats={stats}")
+
+        # 5. Token budget: max_tokens follows the feature's recent output lengths
+        print("\n5. Testing Adaptive Token Budget...")
+        budget = TokenBudget(min_samples=20, headroom=1.5, floor=16)
+        before = budget.limit("tips", 400)
+        for n in range(10, 30):
+            budget.observe("tips", n)
+        budget.observe("quiz", 2)
+        # p95 of 10..29 is 28 -> 42 tokens; never above the caller's cap, never below the floor
+        limits = (budget.limit("tips", 400), budget.limit("tips", 30), budget.limit("quiz", 400))
+        if before == 400 and limits == (42, 30, 400) and budget.stats()["tips"]["p95_tokens"] == 28:
+            print("PASS: Budget is 1.5x p95 once there are enough samples, capped by the caller.")
+        else:
+            print(f"FAIL: before={before} limits={limits} stats={budget.stats()}")
+        small = TokenBudget(min_samples=2, floor=16)
+        small.observe("chat", 1)
+        small.observe("chat", 2)
+        if small.limit("chat", 60) == 16:
+            print("PASS: Budget never drops below the floor.")
+        else:
+            print(f"FAIL: floor limit={small.limit('chat', 60)}")
+
+        # The scheduler applies it on submit, except to constrained (JSON) requests
+        from json_grammar import JSONConstraint
+        scheduler = LLMScheduler([stub_engine(delay=0)], max_batch=1)
+        if scheduler.budget is not None:
+            scheduler.budget = budget
+            limited = scheduler.submit("tips", max_tokens=400, feature="tips")
+            constrained = scheduler.submit("plan", max_tokens=400, feature="tips", constraint=JSONConstraint({"type": "boolean"}))
+            constrained.cancelled = True
+            if limited.max_tokens == 42 and constrained.max_tokens == 400:
+                print("PASS: Scheduler limits unconstrained requests only.")
+            else:
+                print(f"FAIL: limited={limited.max_tokens} constrained={constrained.max_tokens}")
+        else:
+            print("SKIP: LLM_ADAPTIVE_TOKENS=0")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_llm_scheduler()
@@ -0,0 +1,102 @@
+import sys
+import os
+import time
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+# Mean top-k overlap the int8 ONNX backend must keep against PyTorch
+TOP_K = 5
+MIN_OVERLAP = float(os.environ.get('ONNX_PARITY_MIN_OVERLAP', '0.8'))
+
+CORPUS = [
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "Chlorophyll absorbs mostly red and blue light and reflects green.",
+    "Mitochondria produce ATP through cellular respiration.",
+    "Mitosis produces two genetically identical daughter cells.",
+    "Meiosis produces four haploid gametes with half the chromosome count.",
+    "DNA replication is semi-conservative: each new helix keeps one old strand.",
+    "Enzymes lower the activation energy of chemical reactions.",
+    "The French Revolution began in 1789 with the storming of the Bastille.",
+    "Napoleon crowned himself Emperor of the French in 1804.",
+    "The Treaty of Versailles ended the First World War in 1919.",
+    "The Industrial Revolution started in Britain in the late 18th century.",
+    "Newton's second law states that force equals mass times acceleration.",
+    "Kinetic energy is one half of mass times velocity squared.",
+    "Ohm's law relates voltage, current and resistance: V = IR.",
+    "The speed of light in a vacuum is about 300,000 kilometres per second.",
+    "A derivative measures the instantaneous rate of change of a function.",
+    "The integral of a function gives the area under its curve.",
+    "Pythagoras' theorem: the square of the hypotenuse equals the sum of the squares of the other sides.",
+    "A prime number has exactly two divisors: one and itself.",
+    "Supply and demand determine the equilibrium price in a market.",
+    "Inflation is a general rise in prices that reduces purchasing power.",
+    "Python lists are mutable while tuples are immutable.",
+    "A hash table gives average constant-time lookups by key.",
+    "Binary search finds an item in a sorted array in logarithmic time.",
+]
+
+QUERIES = [
+    "How do plants make glucose?",
+    "What produces ATP in the cell?",
+    "How many gametes does meiosis produce?",
+    "When did the French Revolution start?",
+    "What ended World War One?",
+    "What is Newton's second law?",
+    "How is kinetic energy calculated?",
+    "What does a derivative measure?",
+    "What sets the market price?",
+    "How fast is a lookup in a hash table?",
+]
+
+
+def top_k(embeddings, queries, k):
+    import numpy as np
+    docs = embeddings.embed_documents(CORPUS)
+    docs = docs / np.linalg.norm(docs, axis=1, keepdims=True)
+    results = []
+    for q in queries:
+        v = embeddings.embed_query(q)
+        v = v / np.linalg.norm(v)
+        results.append(set(np.argsort(-(docs @ v))[:k].tolist()))
+    return results
+
+
+def test_onnx_parity():
+    print("\n--- Testing ONNX int8 Embedding Parity ---")
+    try:
+        import embeddings as emb
+        # Cached vectors would hide what each backend actually computes
+        emb.EMBED_CACHE = False
+
+        started = time.time()
+        torch_emb = emb.Embeddings(backend='torch')
+        onnx_emb = emb.Embeddings(backend='onnx')
+        print(f"Backends loaded in {time.time() - started:.1f}s: torch={torch_emb.backend} onnx={onnx_emb.backend}")
+        if onnx_emb.backend != 'onnx':
+            print("FAIL: ONNX backend did not load (onnxruntime missing or export failed).")
+            return
+
+        started = time.time()
+        expected = top_k(torch_emb, QUERIES, TOP_K)
+        torch_s = time.time() - started
+        started = time.time()
+        actual = top_k(onnx_emb, QUERIES, TOP_K)
+        onnx_s = time.time() - started
+
+        overlap = sum(len(e & a) for e, a in zip(expected, actual)) / (TOP_K * len(QUERIES))
+        print(f"Top-{TOP_K} overlap: {overlap:.3f} (min {MIN_OVERLAP}) | torch {torch_s:.2f}s, onnx {onnx_s:.2f}s")
+        if overlap >= MIN_OVERLAP:
+            print("PASS: ONNX int8 retrieval matches PyTorch.")
+        else:
+            print("FAIL: ONNX int8 retrieval drifted from PyTorch.")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_onnx_parity()
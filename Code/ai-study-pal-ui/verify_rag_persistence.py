@@ -0,0 +1,193 @@
+import sys
+import os
+import tempfile
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+def test_rag_persistence():
+    print("\n--- Testing RAG Snapshot Persistence ---")
+    try:
+        from ml_utils import RAGSystem
+
+        index_dir = tempfile.mkdtemp(prefix="rag_snapshot_")
+
+        # 1. Index a note and make sure it lands on disk (appended to the shard's write log)
+        print("1. Adding Document...")
+        rag = RAGSystem(index_dir=index_dir)
+        text = "Photosynthesis converts light energy into chemical energy stored in glucose."
+        count = rag.add_document(text, subject="Biology", original_filename="photo.txt", doc_id="note-1")
+        shard_dirs = os.listdir(os.path.join(index_dir, "shards"))
+        files = set(os.listdir(index_dir)) | set(os.listdir(os.path.join(index_dir, "shards", shard_dirs[0])))
+        print(f"Chunks: {count} | Files: {sorted(files)}")
+        if count > 0 and {"faiss.wal", "manifest.json"} <= files:
+            print("PASS: Write log written.")
+        else:
+            print("FAIL: Write log missing.")
+
+        # 2. A fresh instance (simulated restart) replays the log instead of re-embedding
+        print("\n2. Reloading Snapshot...")
+        rag2 = RAGSystem(index_dir=index_dir)
+        if rag2.vectorstore is not None and rag2.vectorstore.ntotal == rag.vectorstore.ntotal:
+            print("PASS: Index reloaded from disk.")
+        else:
+            print("FAIL: Index not reloaded.")
+
+        # 3. Unchanged notes are skipped, changed notes are embedded
+        print("\n3. Testing Manifest...")
+        skipped = rag2.add_document(text, subject="Biology", original_filename="photo.txt", doc_id="note-1")
+        changed = rag2.add_document(text + " Chlorophyll absorbs red and blue light.", subject="Biology", original_filename="photo.txt", doc_id="note-1")
+        if skipped == 0 and changed > 0:
+            print("PASS: Only changed notes re-embedded.")
+        else:
+            print(f"FAIL: skipped={skipped} changed={changed}")
+
+        # Upsert replaces the stale chunk instead of appending a duplicate
+        doc_chunks = list(rag2.notes_index.shard("Biology").metadatas.where(doc_id="note-1"))
+        if len(doc_chunks) == len(rag2.manifest["note-1"]["chunks"]):
+            print("PASS: No duplicate chunks after upsert.")
+        else:
+            print(f"FAIL: {len(doc_chunks)} chunks stored for note-1.")
+
+        # 4. Query still works against the reloaded index
+        class MockProvider:
+            def generate(self, p, max_tokens=200, feature=None, constraint=None):
+                return "Photosynthesis makes glucose."
+
+        res, sources = rag2.query("What is photosynthesis?", subject_filter="Biology", llm_module=MockProvider())
+        print(f"\nResult: {res} | Sources: {sources}")
+        if "photo.txt" in sources:
+            print("PASS: Retrieval from reloaded snapshot.")
+        else:
+            print("FAIL: Retrieval mismatch.")
+
+        # Bucket shards: a small bucket is not crowded out by a large one
+        for i in range(20):
+            rag2.add_document(f"History fact {i}: the French Revolution began in 1789 and reshaped Europe.", subject="History", original_filename=f"history_{i}.txt")
+        res, sources = rag2.query("When did photosynthesis research begin?", subject_filter="Biology", llm_module=MockProvider())
+        res_all, sources_all = rag2.query("French Revolution", subject_filter="All Notes", llm_module=MockProvider())
+        if sources == ["photo.txt"] and sources_all and all(s.startswith("history_") for s in sources_all):
+            print("PASS: Per-bucket shards and All Notes merge.")
+        else:
+            print(f"FAIL: bucket={sources} all={sources_all}")
+
+        # 5. Deleting a note tombstones its chunks and compaction frees them
+        print("\n5. Testing Delete + Compaction...")
+        removed = rag2.delete_document("note-1")
+        res, sources = rag2.query("What is photosynthesis?", subject_filter="Biology", llm_module=MockProvider())
+        if removed > 0 and res == "NOT_IN_NOTES" and "note-1" not in rag2.manifest:
+            print("PASS: Deleted note no longer retrieved.")
+        else:
+            print(f"FAIL: removed={removed} result={res}")
+        dropped = rag2.notes_index.compact()
+        if dropped >= removed and not rag2.notes_index.shard("Biology").tombstones:
+            print("PASS: Compaction dropped tombstones.")
+        else:
+            print(f"FAIL: dropped={dropped} tombstones={len(rag2.vectorstore.tombstones)}")
+
+        # 6. Tenant isolation: another user's notes are never searched
+        print("\n6. Testing Per-User Indexes...")
+        rag2.add_document("Mitochondria is the powerhouse of the cell.", subject="Biology", original_filename="alice.txt", doc_id="a-1", user_id="alice")
+        res_a, src_a = rag2.query("What is the powerhouse of the cell?", subject_filter="All Notes", llm_module=MockProvider(), user_id="alice")
+        res_b, src_b = rag2.query("What is the powerhouse of the cell?", subject_filter="All Notes", llm_module=MockProvider(), user_id="bob")
+        if src_a == ["alice.txt"] and not src_b:
+            print("PASS: User indexes are isolated.")
+        else:
+            print(f"FAIL: alice={src_a} bob={src_b}")
+        print(f"Tenant stats: {rag2.tenants.stats()}")
+
+        # 7. Evidence: retrieval-only path returns offsets into the original note
+        print("\n7. Testing Evidence Offsets...")
+        note = "Cells divide by mitosis. " * 60 + "Meiosis produces four haploid gametes."
+        rag2.add_document(note, subject="Biology", original_filename="cells.txt", doc_id="a-2", user_id="alice")
+        evidence = rag2.retrieve("How many gametes does meiosis produce?", subject_filter="Biology", top_k=3, user_id="alice")
+        top = evidence[0] if evidence else {}
+        start, end = top.get("meta", {}).get("start"), top.get("meta", {}).get("end")
+        if top.get("source") == "cells.txt" and start is not None and note[start:end] == top["text"]:
+            print(f"PASS: Evidence offsets [{start}:{end}] match the note.")
+        else:
+            print(f"FAIL: evidence={evidence[:1]}")
+
+        # 8. Hybrid retrieval: an exact acronym is found through the keyword index
+        print("\n8. Testing Hybrid (BM25 + Dense) Retrieval...")
+        rag2.add_document("Oxidative phosphorylation happens on the inner membrane.", subject="Biology", original_filename="oxphos.txt", doc_id="a-3", user_id="alice")
+        rag2.add_document("The TCA cycle oxidises acetyl-CoA to carbon dioxide.", subject="Biology", original_filename="tca.txt", doc_id="a-4", user_id="alice")
+        evidence = rag2.retrieve("TCA", subject_filter="Biology", top_k=2, user_id="alice")
+        if evidence and evidence[0]["source"] == "tca.txt":
+            print("PASS: Keyword match ranked first.")
+        else:
+            print(f"FAIL: evidence={[e['source'] for e in evidence]}")
+
+        # 9. Concurrent reads: queries during re-indexing see the old or the new note, never a mix
+        print("\n9. Testing Concurrent Reads During Ingest...")
+        import threading
+        versions = [f"Version {v}: the Krebs cycle runs in the mitochondrial matrix. " * 20 for v in range(6)]
+        rag2.add_document(versions[0], subject="Biology", original_filename="krebs.txt", doc_id="a-5", user_id="alice")
+        seen, errors, done = [], [], threading.Event()
+
+        def reader():
+            while not done.is_set():
+                try:
+                    hits = rag2.retrieve("Krebs cycle", subject_filter="Biology", top_k=10, user_id="alice")
+                    seen.append({h["text"][:9] for h in hits if h["text"].startswith("Version")})
+                except Exception as e:
+                    errors.append(e)
+
+        readers = [threading.Thread(target=reader) for _ in range(4)]
+        for t in readers:
+            t.start()
+        for text in versions[1:]:
+            rag2.add_document(text, subject="Biology", original_filename="krebs.txt", doc_id="a-5", user_id="alice")
+        done.set()
+        for t in readers:
+            t.join()
+        mixed = [s for s in seen if len(s) > 1]
+        if seen and not errors and not mixed:
+            print(f"PASS: {len(seen)} concurrent queries, none saw a half-updated note.")
+        else:
+            print(f"FAIL: errors={errors[:1]} mixed={mixed[:1]}")
+
+        # 10. Answer cache: a repeated question is not regenerated; re-indexing a source drops it
+        print("\n10. Testing Answer Cache...")
+        from response_cache import get_response_cache
+
+        class CountingLLM:
+            calls = 0
+            def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
+                CountingLLM.calls += 1
+                return f"Answer {CountingLLM.calls}"
+
+        llm = CountingLLM()
+        first = rag2.query("What does the TCA cycle oxidise?", subject_filter="Biology", llm_module=llm, user_id="alice")
+        again = rag2.query("What does the TCA cycle oxidise?", subject_filter="Biology", llm_module=llm, user_id="alice")
+        rag2.add_document("The TCA cycle oxidises acetyl-CoA, releasing CO2.", subject="Biology", original_filename="tca.txt", doc_id="a-4", user_id="alice")
+        invalidated = get_response_cache().stats()["invalidated"]
+        if CountingLLM.calls == 1 and first == again and invalidated >= 1:
+            print("PASS: Repeat served from cache, dropped on re-index.")
+        else:
+            print(f"FAIL: calls={CountingLLM.calls} invalidated={invalidated}")
+
+        # 11. Uploaded files: a restart's rehydration must not replace the file's text with the note's placeholder
+        print("\n11. Testing Restart With An Uploaded Note...")
+        from ingest import IngestPipeline
+        lecture = "Lecture 4: the electron transport chain pumps protons across the inner mitochondrial membrane. " * 10
+        rag2.add_document(lecture, subject="Biology", original_filename="lecture4.pdf", doc_id="up-1", user_id="alice")
+        rag3 = RAGSystem(index_dir=index_dir)
+        upload_note = {"id": "up-1", "user_id": "alice", "title": "lecture4", "bucket_id": "b-bio",
+                       "content": "[Indexed for AI] lecture4.pdf", "file_path": "alice/b-bio/1700000000_lecture4.pdf"}
+        jobs, unchanged, skipped = IngestPipeline(rag3).rehydrate([upload_note], {"b-bio": "Biology"})
+        evidence = rag3.retrieve("electron transport chain", subject_filter="Biology", top_k=1, user_id="alice")
+        if not jobs and skipped == 1 and evidence and evidence[0]["source"] == "lecture4.pdf" and "proton" in evidence[0]["text"]:
+            print("PASS: Uploaded note kept its file text across restart.")
+        else:
+            print(f"FAIL: jobs={len(jobs)} skipped={skipped} evidence={evidence[:1]}")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_rag_persistence()
@@ -22,7 +22,7 @@ def test_rag_upgrade():
         # But our code says: if llm_module, wrap it. Else pass.
         # Let's mock a simple provider object
         class MockProvider:
-            def generate(self, p, max_tokens=200):
+            def generate(self, p, max_tokens=200, feature=None, constraint=None):
                 return "LlamaIndex is a framework."
         
         res, sources = rag_system.query("What is LlamaIndex?", subject_filter="Tech Stack", llm_module=MockProvider())
@@ -0,0 +1,134 @@
+import sys
+import os
+import re
+import hashlib
+import tempfile
+
+# Ensure backend in path
+sys.path.append(os.path.join(os.getcwd(), 'backend'))
+
+class CountingLLM:
+    """A provider that numbers its replies, so a cached reply is recognisable."""
+    def __init__(self, model_id="stub-model", reply="Answer"):
+        self.model_id = model_id
+        self.sampling = {"temperature": 0.3}
+        self.reply = reply
+        self.calls = 0
+    def generate(self, prompt, max_tokens=200, feature=None, constraint=None):
+        self.calls += 1
+        return f"{self.reply} {self.calls}"
+
+def bag_of_words(text):
+    # Toy embedding for the semantic tier: hashed word counts
+    import numpy as np
+    vector = np.zeros(64, dtype='float32')
+    for word in re.findall(r'\w+', text.lower()):
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % 64] += 1
+    return vector
+
+class StubEmbeddings:
+    """Registered in place of the sentence-transformer, so RAGSystem runs without a model download."""
+    def dimension(self):
+        return 64
+    def embed_documents(self, texts):
+        import numpy as np
+        return np.vstack([bag_of_words(t) + 0.01 for t in texts])
+    def embed_query(self, text):
+        return bag_of_words(text) + 0.01
+
+def test_response_cache():
+    print("\n--- Testing LLM Response Cache ---")
+    try:
+        from response_cache import ResponseCache
+
+        # 1. Exact tier: same provider, settings and prompt -> no second generation
+        print("1. Testing Exact Hits...")
+        cache = ResponseCache(max_size=3, features={"chat", "notes"})
+        llm = CountingLLM()
+        key = cache.key(llm, "What is osmosis?", 60, "chat")
+        cache.put(key, llm.generate("What is osmosis?"))
+        other_model = cache.key(CountingLLM(model_id="other-model"), "What is osmosis?", 60, "chat")
+        if (cache.get(key) == "Answer 1" and cache.get(cache.key(llm, "What is osmosis?", 120, "chat")) is None
+                and cache.get(other_model) is None and cache.key(llm, "Quiz me", 60, "quiz") is None):
+            print("PASS: Hit on the same scope; max_tokens, model and uncached features miss.")
+        else:
+            print("FAIL: Exact tier keys.")
+
+        # 2. Failures are never served again
+        print("\n2. Testing Error Replies...")
+        error_key = cache.key(llm, "Explain entropy", 60, "chat")
+        cache.put(error_key, "LLM Error: model not loaded")
+        if cache.get(error_key) is None:
+            print("PASS: Error reply not cached.")
+        else:
+            print("FAIL: Error reply cached.")
+
+        # 3. Entries built from notes are dropped when that note changes, for that user only
+        print("\n3. Testing Document Invalidation...")
+        alice = cache.key(llm, "notes prompt A", 200, "notes")
+        bob = cache.key(llm, "notes prompt B", 200, "notes")
+        cache.put(alice, "From note-1", docs=["note-1"], user_id="alice")
+        cache.put(bob, "From bob's note-1", docs=["note-1"], user_id="bob")
+        dropped = cache.invalidate_document("note-1", user_id="alice")
+        if dropped == 1 and cache.get(alice) is None and cache.get(bob) == "From bob's note-1":
+            print("PASS: Only the edited user's answers were dropped.")
+        else:
+            print(f"FAIL: dropped={dropped}")
+
+        # 4. LRU: the least recently used entry goes first, and its document tags with it
+        print("\n4. Testing LRU Eviction...")
+        for n in range(4):
+            cache.put(cache.key(llm, f"filler {n}", 60, "chat"), f"Filler {n}")
+        if cache.stats()["size"] == 3 and cache.get(bob) is None and not cache._tags:
+            print("PASS: Oldest entries evicted, tags cleaned up.")
+        else:
+            print(f"FAIL: stats={cache.stats()} tags={cache._tags}")
+
+        # 5. Semantic tier: a close paraphrase of a cached chat question is served its reply
+        print("\n5. Testing Semantic Hits...")
+        semantic = ResponseCache(features={"chat"}, embed_fn=bag_of_words, similarity=0.8)
+        question = "what is the powerhouse of the cell"
+        semantic.put(semantic.key(llm, f"prompt: {question}", 60, "chat"), "Mitochondria.", question=question)
+        paraphrase = "What is the powerhouse of the cell?!"
+        hit = semantic.get(semantic.key(llm, f"prompt: {paraphrase}", 60, "chat"), question=paraphrase)
+        unrelated = semantic.get(semantic.key(llm, "prompt: who wrote hamlet", 60, "chat"), question="who wrote hamlet")
+        other_scope = semantic.get(semantic.key(llm, f"prompt: {paraphrase}", 120, "chat"), question=paraphrase)
+        if hit == "Mitochondria." and unrelated is None and other_scope is None and semantic.stats()["semantic_hits"] == 1:
+            print("PASS: Paraphrase served; unrelated question and other settings missed.")
+        else:
+            print(f"FAIL: hit={hit} unrelated={unrelated} other_scope={other_scope}")
+
+        # 6. RAG answers: re-indexing or deleting a source note drops the cached answer
+        print("\n6. Testing Notes Answers On Re-index / Delete...")
+        import embeddings
+        from ml_utils import RAGSystem
+        from response_cache import get_response_cache
+        embeddings._INSTANCES["stub-embeddings"] = StubEmbeddings()
+        rag = RAGSystem(emb_model_name="stub-embeddings", index_dir=tempfile.mkdtemp(prefix="rag_cache_"))
+        if rag.tenants is None or get_response_cache() is None:
+            print("SKIP: RAG index or LLM_CACHE unavailable.")
+            return
+        notes_llm = CountingLLM(reply="Glycolysis answer")
+        ask = lambda: rag.query("Where does glycolysis happen?", subject_filter="Biology", llm_module=notes_llm, user_id="carol")
+        rag.add_document("Glycolysis happens in the cytoplasm of the cell.", subject="Biology", original_filename="glyco.txt", doc_id="g-1", user_id="carol")
+        first, again = ask(), ask()
+        rag.add_document("Glycolysis happens in the cytosol and yields two ATP.", subject="Biology", original_filename="glyco.txt", doc_id="g-1", user_id="carol")
+        after_edit = ask()
+        invalidated = get_response_cache().stats()["invalidated"]
+        rag.delete_document("g-1", user_id="carol")
+        after_delete = ask()
+        dropped = get_response_cache().stats()["invalidated"] - invalidated
+        if first == again and notes_llm.calls == 2 and after_edit != first and dropped == 1 and after_delete not in (first, after_edit):
+            print("PASS: Repeat served from cache; edit and delete dropped the answer.")
+        else:
+            print(f"FAIL: calls={notes_llm.calls} first={first} after_edit={after_edit} after_delete={after_delete}")
+
+    except ImportError as e:
+        print(f"FAIL: Import Error: {e}")
+    except Exception as e:
+        print(f"FAIL: Exception: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    test_response_cache()